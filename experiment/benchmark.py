@@ -0,0 +1,222 @@
+from grid_manager.device_gen import DeviceFrame
+from grid_manager.grid_manager import GridManager
+from grid_manager.backends import SPARK_BACKENDS
+
+import argparse
+import cProfile
+import itertools
+import json
+import multiprocessing
+import pickle
+import pstats
+import resource
+import sys
+import time
+import traceback
+import numpy
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+DEFAULT_SWEEP = {
+    'devices': [1000, 8000],
+    'cells': [6, 24, 96],
+    'accuracy': [3.0],
+    'backend': ['local', 'process'],
+    'method': ['numpy', 'shapely'],
+}
+
+CASE_KEYS = ['devices', 'cells', 'accuracy', 'backend', 'method']
+
+def random_frames(n_frames, n_devices, dimensions, accuracy, seed):
+    random = numpy.random.RandomState(seed)
+    ids = numpy.array([str(n) for n in range(n_devices)])
+
+    frames = []
+    for i in range(n_frames):
+        positions = random.random_sample((n_devices, 2)) * dimensions
+        accuracies = random.random_sample(n_devices) * accuracy
+        frames.append(DeviceFrame(ids, positions, accuracies))
+
+    return frames
+
+def peak_rss():
+    # kilobytes on Linux, includes finished worker processes
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children)
+
+def run_case(case, options):
+    frames = random_frames(options['warmup'] + options['repetitions'], case['devices'],
+        options['dimensions'], case['accuracy'], options['seed'])
+
+    sc = None
+    if case['backend'] in SPARK_BACKENDS:
+        from pyspark import SparkContext
+        from pyspark import SparkConf
+
+        conf = SparkConf().setAppName('GridManagerBenchmark').setMaster(options['spark_master'])
+        sc = SparkContext(conf=conf)
+
+    profiler = cProfile.Profile() if options['profile'] else None
+    g_manager = GridManager(spark_context=sc, dimensions=options['dimensions'],
+        n_cells=(case['cells'], case['cells']), method=case['method'], backend=case['backend'],
+        profiler=profiler)
+
+    latencies = []
+    for i, frame in enumerate(frames):
+        start_time = time.time()
+        g_manager.update(frame)
+        elapsed_time = time.time() - start_time
+
+        if i >= options['warmup']:
+            latencies.append(elapsed_time)
+
+    g_manager.close()
+    if sc is not None:
+        sc.stop()
+
+    if profiler is not None:
+        # driver side only, executors and worker processes are not profiled
+        print('Profile of %s' % (case_key(case),))
+        pstats.Stats(profiler).strip_dirs().sort_stats('cumulative').print_stats(options['profile'])
+
+    p50, p95, p99 = numpy.percentile(latencies, [50, 95, 99])
+    result = dict(case)
+    result.update({
+        'repetitions': options['repetitions'],
+        'p50': p50,
+        'p95': p95,
+        'p99': p99,
+        'mean': numpy.mean(latencies),
+        'throughput': case['devices'] / numpy.mean(latencies),
+        'peak_rss_kb': peak_rss(),
+        'serialized_bytes': len(pickle.dumps(frames[0], pickle.HIGHEST_PROTOCOL)),
+    })
+
+    return result
+
+def run_isolated(case, options):
+    """
+    Runs a case in a fresh process so that configurations, caches and the
+    peak RSS of one case do not leak into the next one. Returns the result
+    and None, or None and the error if the case failed.
+    """
+    queue = multiprocessing.Queue()
+
+    def target():
+        try:
+            queue.put((run_case(case, options), None))
+        except BaseException:
+            queue.put((None, traceback.format_exc()))
+
+    process = multiprocessing.Process(target=target)
+    process.start()
+
+    # the process may die without reporting (killed, out of memory)
+    while True:
+        try:
+            outcome = queue.get(timeout=1.0)
+            break
+        except Empty:
+            if not process.is_alive():
+                outcome = (None, 'Process exited with code %s' % process.exitcode)
+                break
+
+    process.join()
+    return outcome
+
+def cases(sweep):
+    for values in itertools.product(*[sweep[key] for key in CASE_KEYS]):
+        yield dict(zip(CASE_KEYS, values))
+
+def case_key(result):
+    return tuple(result[key] for key in CASE_KEYS)
+
+def compare(results, baseline, tolerance):
+    """
+    Returns the results whose median latency is more than tolerance (as a
+    fraction) above the median latency of the same case in the baseline.
+    """
+    baseline = dict((case_key(result), result) for result in baseline)
+
+    regressions = []
+    for result in results:
+        reference = baseline.get(case_key(result))
+        if reference is not None and result['p50'] > reference['p50'] * (1 + tolerance):
+            regressions.append((result, reference))
+
+    return regressions
+
+def print_result(result):
+    print('%(devices)6d devices %(cells)4d cells acc %(accuracy)5.1f %(backend)-7s %(method)-7s '
+        'p50 %(p50).4f s p95 %(p95).4f s p99 %(p99).4f s %(throughput)12.1f devices/s '
+        'rss %(peak_rss_kb)d kB %(serialized_bytes)d bytes' % result)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices", type=int, nargs='+', default=DEFAULT_SWEEP['devices'])
+    parser.add_argument("--cells", type=int, nargs='+', default=DEFAULT_SWEEP['cells'], help="cells per side")
+    parser.add_argument("--accuracy", type=float, nargs='+', default=DEFAULT_SWEEP['accuracy'], help="maximum accuracy")
+    parser.add_argument("--backend", nargs='+', default=DEFAULT_SWEEP['backend'])
+    parser.add_argument("--method", nargs='+', default=DEFAULT_SWEEP['method'])
+    parser.add_argument("--dimensions", type=float, nargs=2, default=(138, 138))
+    parser.add_argument("--warmup", type=int, default=2, help="untimed frames per case")
+    parser.add_argument("--repetitions", type=int, default=10, help="timed frames per case")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--spark-master", default='local[*]')
+    parser.add_argument("--profile", type=int, default=0, metavar='N',
+        help="print the N functions with the largest cumulative time of each case")
+    parser.add_argument("--output", default='benchmark.json', help="file to write the results")
+    parser.add_argument("--baseline", help="results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed p50 slowdown against the baseline")
+
+    args = parser.parse_args()
+
+    sweep = {
+        'devices': args.devices,
+        'cells': args.cells,
+        'accuracy': args.accuracy,
+        'backend': args.backend,
+        'method': args.method,
+    }
+
+    options = {
+        'dimensions': tuple(args.dimensions),
+        'warmup': args.warmup,
+        'repetitions': args.repetitions,
+        'seed': args.seed,
+        'spark_master': args.spark_master,
+        'profile': args.profile,
+    }
+
+    results = []
+    failures = []
+    for case in cases(sweep):
+        result, error = run_isolated(case, options)
+        if result is None:
+            print('FAILED %s\n%s' % (case_key(case), error))
+            failures.append(case)
+            continue
+
+        print_result(result)
+        results.append(result)
+
+    with open(args.output, 'w') as output_file:
+        json.dump({'options': options, 'results': results}, output_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+
+        regressions = compare(results, baseline, args.tolerance)
+        for result, reference in regressions:
+            print('REGRESSION %s: p50 %.4f s (baseline %.4f s)' % (case_key(result), result['p50'], reference['p50']))
+
+        if regressions:
+            sys.exit(1)
+
+    if failures:
+        sys.exit(1)
@@ -1,5 +1,5 @@
 from experiment.basic_conf import configuration as basic_conf
 
-configuration = basic_conf
+configuration = dict(basic_conf)
 configuration['devices'] = 8000
 configuration['cells'] = (96, 96)
@@ -1,6 +1,10 @@
 from grid_manager.device_gen import devices_generator
-from pymobility.models.mobility import RandomWaypoint
+from grid_manager.recording import record_frames, replay_generator
+from grid_manager.mobility import RandomWaypoint, RandomWalk
 from grid_manager.grid_manager import GridManager
+from grid_manager.metrics import FrameStats, TIMERS, COUNTERS
+from grid_manager.pipeline import FramePipeline, PipelineStats
+from grid_manager.store import DensityWriter
 
 from pyspark import SparkContext
 from pyspark import SparkConf
@@ -8,7 +12,6 @@ from pyspark import SparkConf
 import time
 import csv
 import os.path
-import sys
 import argparse
 import importlib
 import numpy
@@ -18,8 +21,9 @@ def save_data(data, file_name):
         'devices', 'dimensions', 'velocity',
         'accuracy', 'max_pause_time', 'cells', 'iterations',
         'sim_total_time', 'threads', 'avg_matrix_comp_time', 'total_data_size',
-        'mean_matrix_comp_time', 'std_matrix_comp_time'
-    ]
+        'mean_matrix_comp_time', 'std_matrix_comp_time', 'seed', 'backend', 'pipeline_depth', 'mobility'
+    ] + ['avg_time_' + stage for stage in TIMERS] + ['avg_' + counter for counter in COUNTERS] \
+      + sorted(PipelineStats().as_dict())
 
     file_exists = os.path.isfile(file_name)
     if file_exists:
@@ -35,15 +39,17 @@ def save_data(data, file_name):
 
         writer.writerow(data)
 
-def get_size(device):
-    return sys.getsizeof(device.id) + device.position.nbytes + sys.getsizeof(device.accuracy)
-
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--threads", help="number of threads used in this experiment")
     parser.add_argument("--output", help="file to append the experiment data")
     parser.add_argument("--conf", help="configuration used for this experiment")
     parser.add_argument("--name", help="experiment name")
+    parser.add_argument("--record", help="recording directory to write the generated frames to before running")
+    parser.add_argument("--replay", help="recording directory to read the frames from instead of generating them")
+    parser.add_argument("--store", help="directory to archive the occupation and density matrices of every frame")
+    parser.add_argument("--metrics", action="store_true",
+        help="record the time of every stage (adds the measuring cost to the computation times)")
 
     args = parser.parse_args()
 
@@ -71,53 +77,83 @@ if __name__ == '__main__':
     print 'Starting simulation %s' % exp_name
     print data
 
-    model = RandomWaypoint(nr_nodes=data['devices'], dimensions=data['dimensions'],
-        velocity=data['velocity'], wt_max=data['max_pause_time'])
+    if args.replay:
+        devices_gen = replay_generator(args.replay, loop=True)
+    else:
+        if data.get('mobility', 'random_waypoint') == 'random_walk':
+            model = RandomWalk(nr_nodes=data['devices'], dimensions=data['dimensions'],
+                velocity=data['velocity'], seed=data['seed'])
+        else:
+            model = RandomWaypoint(nr_nodes=data['devices'], dimensions=data['dimensions'],
+                velocity=data['velocity'], wt_max=data['max_pause_time'], seed=data['seed'])
+
+        devices_gen = devices_generator(model, accuracy=data['accuracy'], seed=data['seed'])
 
-    devices_gen = devices_generator(model, accuracy=data['accuracy'])
+        if args.record:
+            # the timed run uses the recorded frames, not the generator
+            record_frames(devices_gen, args.record, data['iterations'])
+            devices_gen = replay_generator(args.record)
 
     conf = SparkConf().setAppName(exp_name)
     sc = SparkContext(conf=conf)
 
-    g_manager = GridManager(spark_context=sc, dimensions=data['dimensions'], n_cells=data['cells'])
-
-    sim_time = 0
-
-    elapsed_time_sum = 0
-    iteration = 0
+    g_manager = GridManager(spark_context=sc, dimensions=data['dimensions'], n_cells=data['cells'],
+        backend=data.get('backend', 'spark'), metrics=args.metrics)
 
-    device_size = None
-    total_data_size = 0
+    # values updated by the consumer thread of the pipeline
+    totals = {'sim_time': 0.0, 'elapsed_time_sum': 0.0, 'total_data_size': 0}
+    computed = [0]
 
     values = []
+    stats = FrameStats()
 
-    while iteration < data['iterations']:
-        devices = next(devices_gen)
+    store = None
+    if args.store:
+        store = DensityWriter(args.store, data['cells'])
 
-        if device_size is None:
-            device_size = get_size(devices.values()[0])
-
-        total_data_size += device_size * len(devices)
-
-        print 'Computing matrix for iteration %d/%d' % (iteration, data['iterations'])
+    def compute(devices):
+        print 'Computing matrix for iteration %d/%d' % (computed[0], data['iterations'])
+        computed[0] += 1
 
         start_time = time.time()
-        g_manager.update(devices.values())
+        g_manager.update(devices)
         elapsed_time = time.time() - start_time
 
+        # new matrices are created on every update, so they can be printed
+        # and stored while the next frame is computed
+        return (devices.nbytes, elapsed_time, g_manager.stats, g_manager.occupation_matrix,
+            g_manager.density_matrix, time.time())
+
+    def write(result):
+        data_size, elapsed_time, frame_stats, occupation_matrix, density_matrix, timestamp = result
+
+        totals['total_data_size'] += data_size
         values.append(elapsed_time)
+        if frame_stats is not None:
+            stats.merge(frame_stats)
 
-        elapsed_time_sum += elapsed_time
-        iteration += 1
+        totals['elapsed_time_sum'] += elapsed_time
 
         print 'Density matrix computed in %.2f s' % elapsed_time
-
-        density_matrix = g_manager.density_matrix
         print density_matrix
 
-        sim_time += elapsed_time
-        print 'Current simulation time: %.2f s' % sim_time
+        if store is not None:
+            store.write(occupation_matrix, density_matrix, timestamp)
+
+        totals['sim_time'] += elapsed_time
+        print 'Current simulation time: %.2f s' % totals['sim_time']
+
+    pipeline = FramePipeline(devices_gen, compute, write, depth=data.get('pipeline_depth', 2))
+    try:
+        pipeline_stats = pipeline.run(data['iterations'])
+    finally:
+        if store is not None:
+            store.close()
+
+    elapsed_time_sum = totals['elapsed_time_sum']
+    total_data_size = totals['total_data_size']
 
+    g_manager.close()
     sc.stop()
 
     avg_time = elapsed_time_sum / float(data['iterations'])
@@ -128,10 +164,22 @@ if __name__ == '__main__':
     print 'Avg. matrix computation time (seconds): %.2f' % avg_time
     print 'Total data size (bytes): %d' % total_data_size
 
+    if args.metrics:
+        for stage in TIMERS:
+            print 'Avg. %s time (seconds): %.4f' % (stage, stats.times.get(stage, 0.0) / float(data['iterations']))
+
+    for name, value in sorted(pipeline_stats.as_dict().items()):
+        print 'Pipeline %s: %.4f' % (name, value)
+
     data['avg_matrix_comp_time'] = avg_time
     data['sim_total_time'] = elapsed_time_sum
     data['total_data_size'] = total_data_size
     data['mean_matrix_comp_time'] = numpy.mean(values)
     data['std_matrix_comp_time'] = numpy.std(values)
 
+    for name, value in stats.as_dict().items():
+        data['avg_' + name] = value / float(data['iterations'])
+
+    data.update(pipeline_stats.as_dict())
+
     save_data(data, file_name)
@@ -0,0 +1,515 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import reduce
+import multiprocessing
+import pickle
+import copy
+import numpy
+
+from .metrics import FrameStats, NO_STATS
+from .sparse import densify
+from .device_gen import DeviceFrame
+from .sparse import SparseMatrix
+from .tiles import Tiling, default_tiles
+
+try:
+    from pyspark.accumulators import AccumulatorParam
+except ImportError:
+    AccumulatorParam = object
+
+LOCAL_BACKEND = 'local'
+PROCESS_BACKEND = 'process'
+SPARK_BACKEND = 'spark'
+DATAFRAME_BACKEND = 'dataframe'
+TILED_BACKEND = 'tiled'
+BACKENDS = (LOCAL_BACKEND, PROCESS_BACKEND, SPARK_BACKEND, DATAFRAME_BACKEND, TILED_BACKEND)
+
+# backends that need a spark_context
+SPARK_BACKENDS = (SPARK_BACKEND, DATAFRAME_BACKEND, TILED_BACKEND)
+
+WEIGHTS_SCHEMA = 'frame long, cell long, weight double'
+WEIGHTS_COLUMNS = ['frame', 'cell', 'weight']
+
+def sum_matrix(accum, n):
+    return accum + n
+
+def serialized_size(value):
+    return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+def empty_weights():
+    import pandas
+
+    return pandas.DataFrame(dict((column, numpy.zeros(0, dtype=dtype)) for column, dtype in
+        zip(WEIGHTS_COLUMNS, (numpy.int64, numpy.int64, float))), columns=WEIGHTS_COLUMNS)
+
+def frame_shards(frames, n_shards):
+    """
+    Splits every frame so that all the frames together give about n_shards
+    shards. Returns (frame index, shard) pairs.
+    """
+    shards_per_frame = max(1, -(-n_shards // max(1, len(frames))))
+    return [
+        (index, shard)
+        for index, frame in enumerate(frames)
+        for shard in frame.split(shards_per_frame)
+    ]
+
+def stack_matrices(results, n_frames, n_cells):
+    tensor = numpy.zeros((n_frames,) + tuple(n_cells))
+    for index, matrix in results:
+        tensor[index] += densify(matrix)
+
+    return tensor
+
+def compute_with_stats(compute, frame, layout):
+    stats = FrameStats()
+    return compute(frame, layout, stats), stats
+
+class StatsAccumulatorParam(AccumulatorParam):
+
+    def zero(self, value):
+        return FrameStats()
+
+    def addInPlace(self, value1, value2):
+        return value1.merge(value2)
+
+class StatsAccumulator(object):
+    """
+    Registers a single stats accumulator and resets it on the driver before
+    each job, instead of creating a new accumulator for every frame.
+    """
+
+    def __init__(self, spark_context):
+        self.sc = spark_context
+        self.accumulator = None
+
+    def get(self, stats):
+        if stats is NO_STATS:
+            return None
+
+        if self.accumulator is None:
+            self.accumulator = self.sc.accumulator(FrameStats(), StatsAccumulatorParam())
+        else:
+            self.accumulator.value = FrameStats()
+
+        return self.accumulator
+
+class LayoutBroadcasts(object):
+    """
+    Broadcasts each grid layout once and keeps the broadcast until closed.
+    """
+
+    def __init__(self, spark_context):
+        self.sc = spark_context
+        self.broadcasts = {}
+
+    def get(self, layout, stats=NO_STATS):
+        # the layout is kept with its broadcast so that its id is not reused
+        if id(layout) not in self.broadcasts:
+            with stats.timer('broadcast'):
+                self.broadcasts[id(layout)] = (layout, self.sc.broadcast(layout))
+
+            if stats is not NO_STATS:
+                stats.count('broadcast_bytes', serialized_size(layout))
+
+        return self.broadcasts[id(layout)][1]
+
+    def close(self):
+        for _, layout_broadcast in self.broadcasts.values():
+            layout_broadcast.destroy()
+
+        self.broadcasts = {}
+
+class LocalBackend(object):
+    """
+    Computes the occupation in the current thread.
+    """
+
+    def occupation(self, compute, layout, frame, stats=NO_STATS):
+        return compute(frame, layout, stats)
+
+    def occupation_many(self, compute, layout, frames, stats=NO_STATS):
+        return stack_matrices(
+            [(index, compute(frame, layout, stats)) for index, frame in enumerate(frames)],
+            len(frames), layout.n_cells
+        )
+
+    def close(self):
+        pass
+
+class ProcessPoolBackend(object):
+    """
+    Shards the device frame across a pool of worker processes and adds up
+    the partial occupation matrices. compute must be a module level function.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.executor = None
+
+    def occupation(self, compute, layout, frame, stats=NO_STATS):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+
+        with stats.timer('split'):
+            shards = frame.split(self.workers)
+
+        if len(shards) < 2:
+            return compute(frame, layout, stats)
+
+        stats.count('shards', len(shards))
+        if stats is not NO_STATS:
+            stats.count('shard_bytes', sum(shard.nbytes for shard in shards))
+
+        with stats.timer('job'):
+            futures = [self.executor.submit(compute_with_stats, compute, shard, layout) for shard in shards]
+            results = [future.result() for future in futures]
+
+        with stats.timer('merge'):
+            for _, shard_stats in results:
+                stats.merge(shard_stats)
+
+            return reduce(sum_matrix, [matrix for matrix, _ in results])
+
+    def occupation_many(self, compute, layout, frames, stats=NO_STATS):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+
+        with stats.timer('split'):
+            shards = frame_shards(frames, self.workers)
+
+        stats.count('shards', len(shards))
+
+        with stats.timer('job'):
+            futures = [(index, self.executor.submit(compute_with_stats, compute, shard, layout))
+                for index, shard in shards]
+            results = [(index, future.result()) for index, future in futures]
+
+        with stats.timer('merge'):
+            for _, (_, shard_stats) in results:
+                stats.merge(shard_stats)
+
+            return stack_matrices([(index, matrix) for index, (matrix, _) in results], len(frames), layout.n_cells)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+class SparkBackend(object):
+    """
+    Splits the device frame into one columnar shard per partition and
+    computes the occupation of each partition in the Spark executors. Each
+    grid layout is broadcast once and reused until the backend is closed.
+    """
+
+    def __init__(self, spark_context):
+        if spark_context is None:
+            raise ValueError('The Spark backend requires a spark_context')
+
+        self.sc = spark_context
+        self.layout_broadcasts = LayoutBroadcasts(spark_context)
+        self.stats_accumulator = StatsAccumulator(spark_context)
+
+    def occupation(self, compute, layout, frame, stats=NO_STATS):
+
+        def update_partition(frames):
+            layout = layoutBroadcast.value
+            current_matrix = layout.zeros()
+            partition_stats = FrameStats() if statsAccumulator is not None else NO_STATS
+
+            for frame in frames:
+                current_matrix += compute(frame, layout, partition_stats)
+
+            if statsAccumulator is not None:
+                partition_stats.count('result_bytes', current_matrix.nbytes)
+                statsAccumulator.add(partition_stats)
+
+            yield current_matrix
+
+        layoutBroadcast = self.layout_broadcasts.get(layout, stats)
+
+        statsAccumulator = self.stats_accumulator.get(stats)
+
+        with stats.timer('split'):
+            shards = frame.split(self.sc.defaultParallelism)
+            framesRDD = self.sc.parallelize(shards, max(1, len(shards)))
+
+        stats.count('shards', len(shards))
+        if stats is not NO_STATS:
+            stats.count('shard_bytes', sum(shard.nbytes for shard in shards))
+
+        with stats.timer('job'):
+            matrix = framesRDD.mapPartitions(update_partition).treeReduce(sum_matrix)
+
+        if statsAccumulator is not None:
+            stats.merge(statsAccumulator.value)
+
+        return matrix
+
+    def occupation_many(self, compute, layout, frames, stats=NO_STATS):
+        """
+        Computes the occupation of all the frames in a single job. The shards
+        are keyed by frame index, added up inside each partition and then
+        reduced by key.
+        """
+
+        def update_partition(shards):
+            layout = layoutBroadcast.value
+            matrices = {}
+            partition_stats = FrameStats() if statsAccumulator is not None else NO_STATS
+
+            for index, frame in shards:
+                matrix = compute(frame, layout, partition_stats)
+                matrices[index] = sum_matrix(matrices[index], matrix) if index in matrices else matrix
+
+            if statsAccumulator is not None:
+                partition_stats.count('result_bytes', sum(matrix.nbytes for matrix in matrices.values()))
+                statsAccumulator.add(partition_stats)
+
+            return iter(matrices.items())
+
+        layoutBroadcast = self.layout_broadcasts.get(layout, stats)
+
+        statsAccumulator = self.stats_accumulator.get(stats)
+
+        with stats.timer('split'):
+            shards = frame_shards(frames, self.sc.defaultParallelism)
+            shardsRDD = self.sc.parallelize(shards, max(1, min(len(shards), self.sc.defaultParallelism)))
+
+        stats.count('shards', len(shards))
+
+        with stats.timer('job'):
+            results = shardsRDD.mapPartitions(update_partition).reduceByKey(sum_matrix).collect()
+
+        if statsAccumulator is not None:
+            stats.merge(statsAccumulator.value)
+
+        with stats.timer('merge'):
+            return stack_matrices(results, len(frames), layout.n_cells)
+
+    def close(self):
+        self.layout_broadcasts.close()
+
+class TiledSparkBackend(SparkBackend):
+    """
+    Partitions the devices spatially: the grid is split into tiles and each
+    Spark task owns one tile, computing it from the devices whose circles
+    can reach it (devices near tile borders are sent to every tile they
+    overlap). Tasks return only their tile, which the driver stitches, so
+    the output of a task grows with the tile size instead of the grid size.
+    """
+
+    def __init__(self, spark_context, tiles=None):
+        SparkBackend.__init__(self, spark_context)
+        self.tiles = tiles
+        self.tilings = {}
+
+    def __tiling(self, layout):
+        if id(layout) not in self.tilings:
+            tiles = self.tiles or default_tiles(layout.n_cells, self.sc.defaultParallelism)
+            self.tilings[id(layout)] = (layout, Tiling(layout.n_cells, layout.cell_dimensions, tiles))
+
+        return self.tilings[id(layout)][1]
+
+    def occupation(self, compute, layout, frame, stats=NO_STATS):
+        tiling = self.__tiling(layout)
+        blocks = self.__blocks(compute, layout, tiling, [frame], stats)
+
+        with stats.timer('merge'):
+            if not layout.sparse:
+                return self.__stitch(tiling, blocks, 1)[0]
+
+            cells = []
+            values = []
+            for _, tile, block in blocks:
+                first_row, _, first_column, _ = tiling.bounds(tile)
+                rows, columns = numpy.nonzero(block)
+                cells.append((rows + first_row) * layout.n_cells[1] + columns + first_column)
+                values.append(block[rows, columns])
+
+            return SparseMatrix.from_cells(numpy.concatenate(cells), numpy.concatenate(values), layout.n_cells)
+
+    def occupation_many(self, compute, layout, frames, stats=NO_STATS):
+        tiling = self.__tiling(layout)
+        blocks = self.__blocks(compute, layout, tiling, frames, stats)
+
+        with stats.timer('merge'):
+            return self.__stitch(tiling, blocks, len(frames))
+
+    def __stitch(self, tiling, blocks, n_frames):
+        tensor = numpy.zeros((n_frames,) + tiling.n_cells)
+        for index, tile, block in blocks:
+            first_row, last_row, first_column, last_column = tiling.bounds(tile)
+            tensor[index, first_row:last_row, first_column:last_column] = block
+
+        return tensor
+
+    def __blocks(self, compute, layout, tiling, frames, stats):
+
+        def update_tile(shards):
+            # the whole circle of each device is computed so that its weights
+            # are normalized as in the other backends, only the tile is kept
+            sparse_layout = copy.copy(layoutBroadcast.value)
+            sparse_layout.sparse = True
+            partition_stats = FrameStats() if statsAccumulator is not None else NO_STATS
+
+            for index, tile, frame in shards:
+                sparse_layout.tile_bounds = tiling.bounds(tile)
+                block = tiling.block(compute(frame, sparse_layout, partition_stats), tile)
+                partition_stats.count('result_bytes', block.nbytes)
+                yield index, tile, block
+
+            if statsAccumulator is not None:
+                statsAccumulator.add(partition_stats)
+
+        layoutBroadcast = self.layout_broadcasts.get(layout, stats)
+
+        statsAccumulator = self.stats_accumulator.get(stats)
+
+        with stats.timer('split'):
+            shards = []
+            for index, frame in enumerate(frames):
+                for tile, devices in enumerate(tiling.assign(frame.positions, layout.reach(frame.accuracies))):
+                    shards.append((index, tile, frame.take(devices)))
+
+            shardsRDD = self.sc.parallelize(shards, max(1, len(shards)))
+
+        stats.count('shards', len(shards))
+        stats.count('halo_devices', sum(len(frame) for _, _, frame in shards) - sum(len(frame) for frame in frames))
+        if stats is not NO_STATS:
+            stats.count('shard_bytes', sum(frame.nbytes for _, _, frame in shards))
+
+        with stats.timer('job'):
+            blocks = shardsRDD.mapPartitions(update_tile).collect()
+
+        if statsAccumulator is not None:
+            stats.merge(statsAccumulator.value)
+
+        return blocks
+
+class DataFrameBackend(object):
+    """
+    Ships the device columns to the executors as a Spark DataFrame through
+    Arrow, without pickling Python objects. Each Arrow batch is converted to
+    a device frame and its (cell, weight) pairs are computed vectorized with
+    mapInPandas (Spark 3.0+), or with a grouped map pandas UDF over shards of
+    the devices on Spark 2.3 and 2.4; the weights are then summed with a
+    groupBy on the frame and cell indices. Requires pandas and pyarrow.
+    """
+
+    def __init__(self, spark_context):
+        if spark_context is None:
+            raise ValueError('The DataFrame backend requires a spark_context')
+
+        from pyspark.sql import SparkSession, functions
+
+        if not hasattr(functions, 'pandas_udf'):
+            raise ValueError('The DataFrame backend requires Spark 2.3+')
+
+        self.sc = spark_context
+        self.spark = SparkSession(spark_context)
+        self.spark.conf.set('spark.sql.execution.arrow.enabled', 'true')
+        self.spark.conf.set('spark.sql.execution.arrow.pyspark.enabled', 'true')
+        self.layout_broadcasts = LayoutBroadcasts(spark_context)
+
+    def __weights(self, compute, layout, frames, stats):
+        import pandas
+        from pyspark.sql import functions
+
+        def frame_weights(devices):
+            # the executors compute sparse matrices to get the touched cells
+            sparse_layout = copy.copy(layoutBroadcast.value)
+            sparse_layout.sparse = True
+
+            for index, rows in devices.groupby('frame', sort=False):
+                positions = rows[['x', 'y']].values
+                frame = DeviceFrame(numpy.arange(len(positions)), positions, rows['accuracy'].values)
+                matrix = compute(frame, sparse_layout)
+                yield pandas.DataFrame({
+                    'frame': numpy.full(matrix.nnz, index, dtype=numpy.int64),
+                    'cell': matrix.cells.astype(numpy.int64),
+                    'weight': matrix.values
+                }, columns=WEIGHTS_COLUMNS)
+
+        def batch_weights(batches):
+            for batch in batches:
+                for weights in frame_weights(batch):
+                    yield weights
+
+        def shard_weights(devices):
+            parts = list(frame_weights(devices))
+            if not parts:
+                return empty_weights()
+
+            return pandas.concat(parts)
+
+        # Spark cannot infer the schema of an empty DataFrame
+        n_devices = sum(len(frame) for frame in frames)
+        if n_devices == 0:
+            return empty_weights()
+
+        layoutBroadcast = self.layout_broadcasts.get(layout, stats)
+
+        with stats.timer('split'):
+            devices = pandas.DataFrame({
+                'shard': numpy.arange(n_devices) % self.sc.defaultParallelism,
+                'frame': numpy.repeat(numpy.arange(len(frames)), [len(frame) for frame in frames]),
+                'x': numpy.concatenate([frame.positions[:, 0] for frame in frames]),
+                'y': numpy.concatenate([frame.positions[:, 1] for frame in frames]),
+                'accuracy': numpy.concatenate([frame.accuracies for frame in frames])
+            })
+            devices_df = self.spark.createDataFrame(devices)
+
+        stats.count('shards', devices_df.rdd.getNumPartitions())
+
+        with stats.timer('job'):
+            if hasattr(devices_df, 'mapInPandas'):
+                mapped = devices_df.mapInPandas(batch_weights, WEIGHTS_SCHEMA)
+            else:
+                mapped = devices_df.groupby('shard').apply(
+                    functions.pandas_udf(shard_weights, WEIGHTS_SCHEMA, functions.PandasUDFType.GROUPED_MAP))
+
+            weights = mapped \
+                .groupBy('frame', 'cell') \
+                .agg(functions.sum('weight').alias('weight')) \
+                .toPandas()
+
+        stats.count('result_bytes', weights.memory_usage(index=False).sum())
+        return weights
+
+    def occupation(self, compute, layout, frame, stats=NO_STATS):
+        weights = self.__weights(compute, layout, [frame], stats)
+
+        with stats.timer('merge'):
+            return layout.accumulate(weights['cell'].values.astype(int), weights['weight'].values)
+
+    def occupation_many(self, compute, layout, frames, stats=NO_STATS):
+        weights = self.__weights(compute, layout, frames, stats)
+
+        with stats.timer('merge'):
+            size = layout.n_cells[0] * layout.n_cells[1]
+            tensor = numpy.bincount((weights['frame'].values * size + weights['cell'].values).astype(int),
+                weights=weights['weight'].values, minlength=len(frames) * size)
+            return tensor.reshape((len(frames),) + tuple(layout.n_cells))
+
+    def close(self):
+        self.layout_broadcasts.close()
+
+def create_backend(backend, spark_context=None):
+    if backend is None:
+        backend = SPARK_BACKEND if spark_context is not None else LOCAL_BACKEND
+
+    if backend == LOCAL_BACKEND:
+        return LocalBackend()
+    elif backend == PROCESS_BACKEND:
+        return ProcessPoolBackend()
+    elif backend == SPARK_BACKEND:
+        return SparkBackend(spark_context)
+    elif backend == DATAFRAME_BACKEND:
+        return DataFrameBackend(spark_context)
+    elif backend == TILED_BACKEND:
+        return TiledSparkBackend(spark_context)
+    elif isinstance(backend, str):
+        raise ValueError('Unknown backend %s. Available backends: %s' % (backend, ', '.join(BACKENDS)))
+
+    return backend
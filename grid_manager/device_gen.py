@@ -1,4 +1,6 @@
-import random
+import numpy
+
+from .mobility import MobilityModel
 
 class Device(object):
 
@@ -7,26 +9,83 @@ class Device(object):
         self.position = position
         self.accuracy = accuracy
 
+class DeviceFrame(object):
+    """
+    Columnar representation of the devices of a single frame: a (N,) array of
+    ids, a (N, 2) array of positions and a (N,) array of accuracies. It also
+    behaves as a read-only dict of Device objects keyed by id, which are
+    created on demand as views of the arrays.
+    """
+
+    def __init__(self, ids, positions, accuracies):
+        self.ids = numpy.asarray(ids)
+        self.positions = numpy.asarray(positions, dtype=float).reshape(-1, 2)
+        self.accuracies = numpy.asarray(accuracies, dtype=float).reshape(-1)
+        self.__id_index = None
+
+    @classmethod
+    def from_devices(cls, devices):
+        devices = list(devices)
+        ids = [device.id for device in devices]
+        positions = [device.position for device in devices]
+        accuracies = [device.accuracy for device in devices]
+        return cls(ids, positions, accuracies)
+
+    @property
+    def nbytes(self):
+        return self.ids.nbytes + self.positions.nbytes + self.accuracies.nbytes
+
+    def device(self, index):
+        return Device(self.ids[index], self.positions[index], self.accuracies[index])
+
+    def take(self, indices):
+        return DeviceFrame(self.ids[indices], self.positions[indices], self.accuracies[indices])
+
+    def split(self, n_shards):
+        shard_size = max(1, -(-len(self) // n_shards))
+        return [self[i:i + shard_size] for i in range(0, len(self), shard_size)]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return DeviceFrame(self.ids[key], self.positions[key], self.accuracies[key])
+
+        if self.__id_index is None:
+            self.__id_index = dict((node_id, index) for index, node_id in enumerate(self.ids))
+
+        return self.device(self.__id_index[key])
+
+    def keys(self):
+        return list(self.ids)
+
+    def values(self):
+        return [self.device(index) for index in range(len(self))]
+
+    def items(self):
+        return [(device.id, device) for device in self.values()]
+
 class DeviceGenerator(object):
 
-    def __init__(self, mobility_model, accuracy=(0.0, 50.0)):
-        self.devices = {}
+    def __init__(self, mobility_model, accuracy=(0.0, 50.0), seed=None):
         self.model_iter = iter(mobility_model)
+        # the native models yield new arrays, other models may reuse theirs
+        self.copy = not isinstance(mobility_model, MobilityModel)
         self.accuracy = accuracy
+        self.random = numpy.random.RandomState(seed)
 
-        for n in range(mobility_model.nr_nodes):
-            node_id = str(n)
-            self.devices[node_id] = Device(node_id)
+        self.ids = numpy.array([str(n) for n in range(mobility_model.nr_nodes)])
 
     def __iter__(self):
         while True:
-            positions = next(self.model_iter)
-            for index, node_id in enumerate(sorted(self.devices.keys())):
-                self.devices[node_id].position = positions[index]
-                accuracy = random.random() * (self.accuracy[1] - self.accuracy[0]) + self.accuracy[0]
-                self.devices[node_id].accuracy = accuracy
+            positions = numpy.array(next(self.model_iter), dtype=float, copy=self.copy)
+            accuracies = self.random.random_sample(len(self.ids)) * (self.accuracy[1] - self.accuracy[0]) + self.accuracy[0]
 
-            yield self.devices
+            yield DeviceFrame(self.ids, positions, accuracies)
 
 def devices_generator(*args, **kwargs):
     return iter(DeviceGenerator(*args, **kwargs))
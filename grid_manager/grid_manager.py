@@ -1,10 +1,27 @@
 import shapely.geometry as geometry
 import numpy
-from rtree import index
-import os
-
-RTREE_PATH = './rtree'
-RTREE_FILES = ['.idx', '.dat']
+import math
+import time
+
+from .overlap import disc_weights, gaussian_weights, accumulate, GAUSSIAN_REACH
+from .lut import OverlapTable
+from .histogram import ConvolutionTable
+from .sparse import SparseMatrix, densify
+from .backends import create_backend
+from .device_gen import DeviceFrame
+from .incremental import IncrementalOccupation
+from .pyramid import MultiResolution, level_cells
+from .temporal import TemporalDensity
+from .venue import walkable_area, redistribute
+from .queries import evaluate, top_k, regions
+from .metrics import FrameStats, NO_STATS, start_profiler, stop_profiler
+
+SHAPELY_METHOD = 'shapely'
+NUMPY_METHOD = 'numpy'
+LUT_METHOD = 'lut'
+GAUSSIAN_METHOD = 'gaussian'
+HISTOGRAM_METHOD = 'histogram'
+METHODS = (SHAPELY_METHOD, NUMPY_METHOD, LUT_METHOD, GAUSSIAN_METHOD, HISTOGRAM_METHOD)
 
 class Cell(object):
 
@@ -18,14 +35,124 @@ class Cell(object):
             self.position[1] + cell_dimensions[1]
         )
 
+class GridLayout(object):
+
+    def __init__(self, n_cells, cell_dimensions, table=None, sparse=False, walkable_area=None, kernel_reach=1.0):
+        self.n_cells = tuple(n_cells)
+        self.cell_dimensions = tuple(cell_dimensions)
+        self.dimensions = (
+            self.n_cells[0] * self.cell_dimensions[0],
+            self.n_cells[1] * self.cell_dimensions[1]
+        )
+        self.table = table
+        self.sparse = sparse
+        self.kernel_reach = kernel_reach
+
+        # the cells (Tiling.bounds) a compute function has to get right when
+        # only a tile of the grid is kept, None for the whole grid
+        self.tile_bounds = None
+
+        self.walkable_area = walkable_area
+        self.walkable_fraction = None
+        if walkable_area is not None:
+            self.walkable_fraction = walkable_area.ravel() / (self.cell_dimensions[0] * self.cell_dimensions[1])
+
+        self.row_origins = numpy.arange(self.n_cells[0]) * self.cell_dimensions[0]
+        self.column_origins = numpy.arange(self.n_cells[1]) * self.cell_dimensions[1]
+
+    def cell_range(self, bounds):
+        return cell_range(bounds, self.cell_dimensions, self.n_cells)
+
+    def zeros(self):
+        if self.sparse:
+            return SparseMatrix(self.n_cells)
+
+        return numpy.zeros(self.n_cells)
+
+    def accumulate(self, cells, weights, devices=None, n_devices=0):
+        if self.walkable_fraction is not None and devices is not None:
+            weights = redistribute(devices, cells, weights, self.walkable_fraction, n_devices)
+
+        if self.sparse:
+            return SparseMatrix.from_cells(cells, weights, self.n_cells)
+
+        return accumulate(cells, weights, self.n_cells)
+
+    def reach(self, accuracies):
+        # how far from its position a device can put weight, the tables
+        # move and round the circles
+        radii = accuracies * self.kernel_reach
+        if self.table is None:
+            return radii
+
+        return radii + self.table.margin
+
+    def density(self, occupation):
+        if self.walkable_area is None:
+            return occupation / (self.cell_dimensions[0] * self.cell_dimensions[1])
+
+        # cells without walkable area have no density
+        area = self.walkable_area.ravel()
+        if isinstance(occupation, SparseMatrix):
+            cell_area = area[occupation.cells]
+            return SparseMatrix(occupation.shape, occupation.cells,
+                numpy.where(cell_area > 0, occupation.values / numpy.where(cell_area > 0, cell_area, 1.0), 0.0))
+
+        area = area.reshape(self.n_cells)
+        return numpy.where(area > 0, occupation / numpy.where(area > 0, area, 1.0), 0.0)
+
+    def box(self, row, column):
+        return geometry.box(
+            self.row_origins[row],
+            self.column_origins[column],
+            self.row_origins[row] + self.cell_dimensions[0],
+            self.column_origins[column] + self.cell_dimensions[1]
+        )
+
 class GridManager(object):
 
-    def __init__(self, spark_context, dimensions, n_cells=(12, 12)):
+    def __init__(self, spark_context=None, dimensions=None, n_cells=(12, 12), method=SHAPELY_METHOD,
+            backend=None, incremental=False, epsilon=0.0, refresh_interval=100, metrics=False,
+            profiler=None, lut_max_radius=3.0, lut_quantization=0.1, sparse=False, levels=1, refine_density=0.0,
+            temporal=False, rolling_frames=10, ewma_alpha=0.2, threshold_density=None,
+            venue=None, histogram_supersample=4, histogram_quantization=0.5):
+        if dimensions is None:
+            raise ValueError('Grid dimensions must be provided')
+
+        if method not in METHODS:
+            raise ValueError('Unknown method %s. Available methods: %s' % (method, ', '.join(METHODS)))
+
         self.sc = spark_context
+        self.backend = create_backend(backend, spark_context)
         self.dimensions = dimensions
         self.n_cells = n_cells
+        self.method = method
+
+        self.metrics = metrics
+        self.profiler = profiler
+        self.stats = None
+
+        self.occupation = None
+        self.density = None
+
+        if incremental and levels > 1:
+            raise ValueError('Incremental updates cannot be combined with several levels')
+
+        self.incremental = None
+        if incremental:
+            self.incremental = IncrementalOccupation(epsilon, refresh_interval)
 
+        self.temporal = None
+        if temporal:
+            self.temporal = TemporalDensity(rolling_frames, ewma_alpha, threshold_density)
+
+        if venue is not None and method == HISTOGRAM_METHOD:
+            raise ValueError('The histogram method cannot be combined with a venue')
+
+        self.venue = venue
         self.area = float(self.dimensions[0] * self.dimensions[1])
+        if venue is not None:
+            self.area = float(venue.area)
 
         self.cell_dimensions = (
             dimensions[0] / float(n_cells[0]),
@@ -33,140 +160,404 @@ class GridManager(object):
         )
 
         self.cell_area = self.cell_dimensions[0] * self.cell_dimensions[1]
-        self.__create_cells()
 
-    def remove_rtree_files(self):
-        for extension in RTREE_FILES:
-            if os.path.isfile(RTREE_PATH + extension):
-                os.remove(RTREE_PATH + extension)
+        # cells are created on demand, only the assigned ones are kept
+        self.cells = {}
+
+        self.lut_max_radius = lut_max_radius
+        self.lut_quantization = lut_quantization
+        self.histogram_supersample = histogram_supersample
+        self.histogram_quantization = histogram_quantization
+        self.sparse = sparse
+
+        self.layout = self.__create_layout(self.n_cells)
+
+        self.multi_resolution = None
+        if levels > 1:
+            layouts = [self.__create_layout(cells) for cells in level_cells(self.n_cells, levels)[:-1]]
+            self.multi_resolution = MultiResolution(layouts + [self.layout], refine_density)
+
+    def __create_layout(self, n_cells):
+        cell_dimensions = (
+            self.dimensions[0] / float(n_cells[0]),
+            self.dimensions[1] / float(n_cells[1])
+        )
+
+        table = None
+        if self.method == LUT_METHOD:
+            table = OverlapTable(cell_dimensions, self.lut_max_radius, self.lut_quantization)
+        elif self.method == HISTOGRAM_METHOD:
+            table = ConvolutionTable(n_cells, cell_dimensions, self.histogram_supersample, self.histogram_quantization)
 
-    def __create_cells(self):
-        self.remove_rtree_files()
+        kernel_reach = GAUSSIAN_REACH if self.method == GAUSSIAN_METHOD else 1.0
 
-        p = index.Property()
-        p.overwrite = True
-        self.idx = index.Index(RTREE_PATH, properties=p)
+        layout = GridLayout(n_cells, cell_dimensions, table, self.sparse, kernel_reach=kernel_reach)
+        if self.venue is not None:
+            # computed once, the frames only scale the cell weights
+            layout = GridLayout(n_cells, cell_dimensions, table, self.sparse, walkable_area(self.venue, layout),
+                kernel_reach)
 
-        self.cells = []
-        for row_index in range(self.n_cells[0]):
-            row = []
-            for column_index in range(self.n_cells[1]):
-                position = (
-                    row_index * self.cell_dimensions[0],
-                    column_index * self.cell_dimensions[1]
-                )
+        return layout
 
-                cell = Cell(position, self.cell_dimensions)
-                pos = row_index * self.n_cells[0] + column_index
-                self.idx.insert(pos, cell.box.bounds)
-                row.append(cell)
+    def __enter__(self):
+        return self
 
-            self.cells.append(row)
-        self.idx.close()
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.backend.close()
 
     def update(self, devices):
+        if self.profiler is not None:
+            start_profiler(self.profiler)
 
-        def update_device(device):
-            circle = create_circle(device)
-            idx = index.Index(RTREE_PATH)
-            cell_indices = idx.intersection(circle.bounds)
+        try:
+            self.__update(devices)
+        finally:
+            if self.profiler is not None:
+                stop_profiler(self.profiler)
 
-            total_common = 0
-            common_cells = []
+    def __update(self, devices):
+        stats = FrameStats() if self.metrics else NO_STATS
 
-            for pos in cell_indices:
-                cell_index = (pos // columnsBroadcast.value,  pos % columnsBroadcast.value)
-                cell = cellsBroadcast.value[cell_index[0]][cell_index[1]]
-                common = cell.box.intersection(circle)
-                common_cells.append((cell_index, common.area))
-                total_common += common.area
+        with stats.timer('frame'):
+            frame = as_frame(devices)
 
-            missing = (circle.area - total_common) / circle.area
-            current_matrix = numpy.zeros((rowsBroadcast.value, columnsBroadcast.value))
+        stats.count('devices', len(frame))
+        self.avg_density = len(frame) / self.area
 
-            for cell_index, common_area in common_cells:
-                cell_ratio = common_area / float(total_common)
-                current_matrix[cell_index[0]][cell_index[1]] += common_area / circle.area + cell_ratio * missing
+        compute = self.__compute_function()
 
-            return ('matrix', current_matrix)
+        def occupation(frame, layout=self.layout):
+            return self.backend.occupation(compute, layout, frame, stats)
 
-        def sum_matrix(accum, n):
-            return accum + n
+        if self.incremental is not None:
+            self.occupation = self.incremental.update(frame, occupation)
+        elif self.multi_resolution is not None:
+            self.occupation = self.multi_resolution.update(frame, occupation)
+            if self.sparse:
+                self.occupation = SparseMatrix.from_dense(self.occupation)
+        else:
+            self.occupation = occupation(frame)
 
-        self.avg_density = len(devices) / self.area
+        self.density = self.layout.density(self.occupation)
 
-        columnsBroadcast = self.sc.broadcast(self.columns)
-        rowsBroadcast = self.sc.broadcast(self.rows)
-        cellsBroadcast = self.sc.broadcast(self.cells)
+        if self.temporal is not None:
+            with stats.timer('temporal'):
+                self.temporal.update(self.density_matrix)
 
-        devicesRDD = self.sc.parallelize(devices)
-        devicesRDD = devicesRDD.map(update_device)
+        if self.metrics:
+            self.stats = stats
 
-        sumRDD = devicesRDD.reduceByKey(sum_matrix)
+    def __compute_function(self):
+        if self.method == NUMPY_METHOD:
+            return numpy_occupation
+        elif self.method == LUT_METHOD:
+            return lut_occupation
+        elif self.method == GAUSSIAN_METHOD:
+            return gaussian_occupation
+        elif self.method == HISTOGRAM_METHOD:
+            return histogram_occupation
 
-        self.occupation_matrix = sumRDD.collect()[0][1]
-        self.density_matrix = self.occupation_matrix / self.cell_area
+        return shapely_occupation
 
-    def __get_row_column(self, num):
-        if num == 0:
-            return (0, 0)
-        elif num == 1:
-            return (0, 1)
-        elif num == 2:
-            return (1, 0)
-        elif num == 3:
-            return (1, 1)
+    # computes the occupation of a sequence of frames with a single backend
+    # job and returns a (frames, rows, columns) occupation tensor, the grid
+    # manager is left in the state of the last frame
+    def update_many(self, frames):
+        if self.incremental is not None or self.multi_resolution is not None:
+            raise ValueError('update_many does not support incremental updates or several levels')
 
-    def __adjust_row_column(self, current, index, factor):
-        adjusted = (
-            (current[0] * factor + index[0][0], current[1] * factor + index[0][1]),
-            index[1]
-        )
+        if self.profiler is not None:
+            start_profiler(self.profiler)
+
+        try:
+            return self.__update_many(frames)
+        finally:
+            if self.profiler is not None:
+                stop_profiler(self.profiler)
+
+    def __update_many(self, frames):
+        stats = FrameStats() if self.metrics else NO_STATS
+
+        with stats.timer('frame'):
+            frames = [as_frame(devices) for devices in frames]
+
+        stats.count('devices', sum(len(frame) for frame in frames))
+
+        tensor = self.backend.occupation_many(self.__compute_function(), self.layout, frames, stats)
+
+        if self.temporal is not None:
+            with stats.timer('temporal'):
+                for matrix in tensor:
+                    self.temporal.update(self.layout.density(matrix))
+
+        if len(frames) > 0:
+            self.avg_density = len(frames[-1]) / self.area
+            self.occupation = tensor[-1]
+            if self.sparse:
+                self.occupation = SparseMatrix.from_dense(self.occupation)
 
-        return adjusted
+            self.density = self.layout.density(self.occupation)
 
-    def __total_cells_area(self, cells):
-        total_area = 0.0
-        for cell in cells:
-            total_area += cell[1]
+        if self.metrics:
+            self.stats = stats
 
-        return total_area
+        return tensor
+
+    def __cell_index(self, index):
+        row, column = index
+        if row < 0:
+            row += self.n_cells[0]
+        if column < 0:
+            column += self.n_cells[1]
+
+        if not (0 <= row < self.n_cells[0] and 0 <= column < self.n_cells[1]):
+            raise IndexError('Cell %s out of range' % (index,))
+
+        return row, column
 
     def __getitem__(self, index):
-        return self.cells[index[0]][index[1]]
+        index = self.__cell_index(index)
+        if index in self.cells:
+            return self.cells[index]
+
+        return Cell((self.layout.row_origins[index[0]], self.layout.column_origins[index[1]]), self.cell_dimensions)
 
     def __setitem__(self, index, value):
-        self.cells[index[0]][index[1]] = value
+        self.cells[self.__cell_index(index)] = value
+
+    @property
+    def walkable_area(self):
+        return self.layout.walkable_area
+
+    @property
+    def occupation_matrix(self):
+        return densify(self.occupation)
+
+    @property
+    def density_matrix(self):
+        return densify(self.density)
+
+    @property
+    def ewma_density(self):
+        return self.temporal.ewma
+
+    @property
+    def rolling_mean_density(self):
+        return self.temporal.rolling_mean
+
+    @property
+    def rolling_max_density(self):
+        return self.temporal.rolling_max
+
+    # consecutive frames each cell has been above threshold_density
+    @property
+    def time_above_threshold(self):
+        return self.temporal.time_above
+
+    # density matrices of every level, from the coarsest to the finest
+    @property
+    def density_pyramid(self):
+        return [
+            layout.density(matrix)
+            for matrix, layout in zip(self.multi_resolution.levels, self.multi_resolution.layouts)
+        ]
+
+    # cells of every level whose occupation was computed at that level
+    @property
+    def refined_cells(self):
+        return self.multi_resolution.exact
 
     @property
     def rows(self):
-        return len(self.cells)
+        return self.n_cells[0]
 
     @property
     def columns(self):
-        return len(self.cells[0])
+        return self.n_cells[1]
 
     @property
     def shape(self):
         return (self.rows, self.columns)
 
     def check_density(self, f):
-        indices = []
-        for row_index in range(self.rows):
-            for column_index in range(self.columns):
-                if f(self.density_matrix[row_index, column_index]):
-                    indices.append((row_index, column_index))
-
-        return indices
+        return check(f, self.density)
 
     def check_occupation(self, f):
-        indices = []
-        for row_index in range(self.rows):
-            for column_index in range(self.columns):
-                if f(self.occupation_matrix[row_index, column_index]):
-                    indices.append((row_index, column_index))
-
-        return indices
+        return check(f, self.occupation)
+
+    def most_crowded(self, k, density=True):
+        return top_k(self.density_matrix if density else self.occupation_matrix, k)
+
+    def hotspots(self, f, density=True, connectivity=4):
+        mask = evaluate(f, self.density_matrix if density else self.occupation_matrix)
+        return regions(mask, self.occupation_matrix, self.density_matrix, connectivity)
+
+def cell_range(bounds, cell_dimensions, n_cells):
+    first_row = max(int(math.floor(bounds[0] / cell_dimensions[0])), 0)
+    last_row = min(int(math.floor(bounds[2] / cell_dimensions[0])), n_cells[0] - 1)
+    first_column = max(int(math.floor(bounds[1] / cell_dimensions[1])), 0)
+    last_column = min(int(math.floor(bounds[3] / cell_dimensions[1])), n_cells[1] - 1)
+
+    return range(first_row, last_row + 1), range(first_column, last_column + 1)
+
+def check(f, matrix):
+    # when f is false for empty cells only the touched cells of a sparse
+    # matrix have to be evaluated
+    if isinstance(matrix, SparseMatrix) and not evaluate(f, numpy.zeros(1))[0]:
+        cells = matrix.cells[evaluate(f, matrix.values)]
+        return numpy.column_stack(numpy.unravel_index(cells, matrix.shape)).reshape(-1, 2)
+
+    return numpy.argwhere(evaluate(f, densify(matrix)))
+
+def as_frame(devices):
+    if isinstance(devices, DeviceFrame):
+        return devices
+
+    return DeviceFrame.from_devices(devices)
+
+def numpy_occupation(frame, layout, stats=NO_STATS):
+    with stats.timer('compute'):
+        with stats.timer('overlap'):
+            devices, cells, weights = disc_weights(frame.positions, frame.accuracies, layout.cell_dimensions,
+                layout.n_cells)
+
+        with stats.timer('accumulate'):
+            return layout.accumulate(cells, weights, devices, len(frame))
+
+def gaussian_occupation(frame, layout, stats=NO_STATS):
+    with stats.timer('compute'):
+        with stats.timer('overlap'):
+            devices, cells, weights = gaussian_weights(frame.positions, frame.accuracies, layout.cell_dimensions,
+                layout.n_cells)
+
+        with stats.timer('accumulate'):
+            return layout.accumulate(cells, weights, devices, len(frame))
+
+def lut_occupation(frame, layout, stats=NO_STATS):
+    with stats.timer('compute'):
+        with stats.timer('overlap'):
+            interior = layout.table.interior(frame.positions, frame.accuracies, layout.dimensions)
+            lut_devices, lut_cells, lut_weights = layout.table.stencil_weights(
+                frame.positions[interior], frame.accuracies[interior], layout.n_cells)
+
+            # devices close to the borders need the exact missing area redistribution
+            border = ~interior
+            devices, cells, weights = disc_weights(frame.positions[border], frame.accuracies[border],
+                layout.cell_dimensions, layout.n_cells)
+
+        with stats.timer('accumulate'):
+            return layout.accumulate(numpy.concatenate([lut_cells, cells]), numpy.concatenate([lut_weights, weights]),
+                numpy.concatenate([lut_devices, devices + interior.sum()]), len(frame))
+
+def convolution_window(layout, accuracies):
+    """
+    Returns the cells the histogram convolution has to span for layout,
+    None for the whole grid. With a tile, its cells plus the reach of the
+    devices, padded to a power of two cells so that the windows of a few
+    shapes share their kernel spectra.
+    """
+    if layout.tile_bounds is None or len(accuracies) == 0:
+        return None
+
+    first_row, last_row, first_column, last_column = layout.tile_bounds
+    reach = layout.reach(accuracies).max()
+    pads = [2 ** int(math.ceil(math.log(math.ceil(reach / size) + 1, 2))) for size in layout.cell_dimensions]
+    return (first_row - pads[0], first_column - pads[1],
+        last_row - first_row + 2 * pads[0], last_column - first_column + 2 * pads[1])
+
+def histogram_occupation(frame, layout, stats=NO_STATS):
+    with stats.timer('compute'):
+        with stats.timer('overlap'):
+            interior = layout.table.interior(frame.positions, frame.accuracies, layout.dimensions)
+            window = convolution_window(layout, frame.accuracies[interior])
+            matrix = layout.table.convolve(frame.positions[interior], frame.accuracies[interior], window)
+
+            # devices close to the borders need the exact missing area redistribution
+            border = ~interior
+            _, cells, weights = disc_weights(frame.positions[border], frame.accuracies[border],
+                layout.cell_dimensions, layout.n_cells)
+
+        with stats.timer('accumulate'):
+            rows, columns = numpy.nonzero(matrix)
+            values = matrix[rows, columns]
+            if window is not None:
+                # only the cells of the tile are exact
+                first_row, last_row, first_column, last_column = layout.tile_bounds
+                rows = rows + window[0]
+                columns = columns + window[1]
+                inside = (rows >= first_row) & (rows < last_row) & (columns >= first_column) & (columns < last_column)
+                rows, columns, values = rows[inside], columns[inside], values[inside]
+
+            return layout.accumulate(numpy.concatenate([rows * layout.n_cells[1] + columns, cells]),
+                numpy.concatenate([values, weights]))
+
+def shapely_occupation(frame, layout, stats=NO_STATS):
+    with stats.timer('compute'):
+        devices = []
+        cells = []
+        weights = []
+
+        for index, device in enumerate(frame.values()):
+            for cell_index, weight in device_weights(device, layout, stats):
+                devices.append(index)
+                cells.append(cell_index[0] * layout.n_cells[1] + cell_index[1])
+                weights.append(weight)
+
+        with stats.timer('accumulate'):
+            return layout.accumulate(numpy.array(cells, dtype=int), numpy.array(weights),
+                numpy.array(devices, dtype=int), len(frame))
+
+def point_weights(position, layout):
+    # a device with no accuracy radius is located at the cell that contains it
+    if not (0 <= position[0] <= layout.dimensions[0] and 0 <= position[1] <= layout.dimensions[1]):
+        return []
+
+    row = min(int(math.floor(position[0] / layout.cell_dimensions[0])), layout.n_cells[0] - 1)
+    column = min(int(math.floor(position[1] / layout.cell_dimensions[1])), layout.n_cells[1] - 1)
+    return [((row, column), 1.0)]
+
+def common_areas(circle, rows, columns, layout):
+    return [
+        ((row, column), layout.box(row, column).intersection(circle).area)
+        for row in rows for column in columns
+    ]
+
+def device_weights(device, layout, stats=NO_STATS):
+    if device.accuracy <= 0:
+        return point_weights(device.position, layout)
+
+    if stats is NO_STATS:
+        circle = create_circle(device)
+        rows, columns = layout.cell_range(circle.bounds)
+        common_cells = common_areas(circle, rows, columns, layout)
+    else:
+        start_time = time.time()
+        circle = create_circle(device)
+        circle_time = time.time()
+        rows, columns = layout.cell_range(circle.bounds)
+        lookup_time = time.time()
+        common_cells = common_areas(circle, rows, columns, layout)
+
+        stats.add_time('circle', circle_time - start_time)
+        stats.add_time('lookup', lookup_time - circle_time)
+        stats.add_time('intersection', time.time() - lookup_time)
+        stats.count('candidate_cells', len(common_cells))
+
+    total_common = sum(common_area for _, common_area in common_cells)
+    if total_common == 0:
+        return []
+
+    missing = (circle.area - total_common) / circle.area
+
+    weights = []
+    for cell_index, common_area in common_cells:
+        cell_ratio = common_area / float(total_common)
+        weights.append((cell_index, common_area / circle.area + cell_ratio * missing))
+
+    return weights
 
 def create_circle(device):
     p = geometry.point.Point(device.position)
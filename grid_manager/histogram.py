@@ -0,0 +1,136 @@
+import numpy
+
+from .overlap import disc_weights, displaced_disc_error
+from .lut import MAX_TABLE_BYTES
+
+# occupation values below this are numerical noise of the FFTs
+EPSILON = 1e-9
+
+class ConvolutionTable(object):
+    """
+    Approximate occupation whose cost grows with the number of cells and
+    radius classes instead of with the number of devices. The device centres
+    are binned into a histogram of sub-cells (supersample x supersample per
+    cell) for each radius class, every histogram is convolved (FFT) with the
+    disc of its class and the result is summed back to the cells.
+
+    A device is thus replaced by a disc centred at its sub-cell centre and
+    whose radius is rounded to a multiple of quantization. Each disc kernel
+    is the exact overlap of that disc with the sub-cells, so the only error
+    of a device is the one of moving its disc, which error_bound quantifies.
+    Only devices whose replaced disc stays inside the grid are handled, the
+    rest need the exact missing area redistribution.
+    """
+
+    def __init__(self, n_cells, cell_dimensions, supersample=4, quantization=0.5, max_bytes=MAX_TABLE_BYTES):
+        self.n_cells = tuple(n_cells)
+        self.cell_dimensions = tuple(cell_dimensions)
+        self.supersample = supersample
+        self.quantization = float(quantization)
+        self.max_bytes = max_bytes
+
+        self.subcell_dimensions = (
+            self.cell_dimensions[0] / float(supersample),
+            self.cell_dimensions[1] / float(supersample)
+        )
+
+        # displacement of the disc edges by the rounding and the binning
+        self.margin = self.quantization / 2 + numpy.hypot(*self.subcell_dimensions) / 2
+
+        # kernel spectra by sub-cell grid shape and radius class, kept while
+        # they fit in max_bytes
+        self.spectra = {}
+        self.spectra_bytes = 0
+
+    def radius_classes(self, accuracies):
+        return numpy.round(accuracies / self.quantization).astype(int)
+
+    def interior(self, positions, accuracies, dimensions):
+        """
+        Returns which devices can be approximated: their disc, moved to the
+        sub-cell centre and with the rounded radius, is inside the grid.
+        """
+        radius = numpy.maximum(accuracies, self.radius_classes(accuracies) * self.quantization)
+        row_margin = radius + self.subcell_dimensions[0] / 2
+        column_margin = radius + self.subcell_dimensions[1] / 2
+        return (
+            (positions[:, 0] - row_margin >= 0) & (positions[:, 0] + row_margin <= dimensions[0]) &
+            (positions[:, 1] - column_margin >= 0) & (positions[:, 1] + column_margin <= dimensions[1])
+        )
+
+    def error_bound(self, accuracies):
+        """
+        Upper bound of the L1 error (sum over the cells of the absolute
+        difference with the exact occupation) of the devices that satisfy
+        interior: each disc is moved at most half the sub-cell diagonal and
+        its radius rounded to a multiple of quantization (see
+        displaced_disc_error). No single cell is off by more than half of
+        the bound.
+        """
+        accuracies = numpy.asarray(accuracies, dtype=float)
+        rounded = self.radius_classes(accuracies) * self.quantization
+        offset = numpy.hypot(*self.subcell_dimensions) / 2
+        return displaced_disc_error(accuracies, rounded, offset).sum()
+
+    def __spectrum(self, radius_class, shape):
+        if (shape, radius_class) in self.spectra:
+            return self.spectra[(shape, radius_class)]
+
+        # the disc centred at the centre of sub-cell (0, 0), on a stencil
+        # sized grid, wrapped around the sub-cell grid for the FFT
+        radius = radius_class * self.quantization
+        half_size = (
+            int(numpy.ceil(radius / self.subcell_dimensions[0])) + 1,
+            int(numpy.ceil(radius / self.subcell_dimensions[1])) + 1
+        )
+        stencil_shape = (2 * half_size[0] + 1, 2 * half_size[1] + 1)
+        centre = [[(half_size[0] + 0.5) * self.subcell_dimensions[0], (half_size[1] + 0.5) * self.subcell_dimensions[1]]]
+        _, cells, weights = disc_weights(centre, [radius], self.subcell_dimensions, stencil_shape)
+
+        rows, columns = numpy.unravel_index(cells, stencil_shape)
+        rows = (rows - half_size[0]) % shape[0]
+        columns = (columns - half_size[1]) % shape[1]
+        kernel = numpy.bincount(rows * shape[1] + columns, weights=weights,
+            minlength=shape[0] * shape[1]).reshape(shape)
+
+        spectrum = numpy.fft.rfft2(kernel)
+        if self.spectra_bytes + spectrum.nbytes <= self.max_bytes:
+            self.spectra[(shape, radius_class)] = spectrum
+            self.spectra_bytes += spectrum.nbytes
+
+        return spectrum
+
+    def convolve(self, positions, accuracies, window=None):
+        """
+        Returns the approximate occupation of devices that satisfy interior,
+        as a rows x columns matrix or, with a window (first row, first
+        column, rows, columns), as the matrix of the cells of the window,
+        which may extend past the grid. The FFTs only span the window, and
+        wrap around it: only the cells further than the reach of every
+        device from the window edges are exact.
+        """
+        first_row, first_column, rows, columns = window or (0, 0) + self.n_cells
+        if len(accuracies) == 0:
+            return numpy.zeros((rows, columns))
+
+        shape = (rows * self.supersample, columns * self.supersample)
+        subcell_rows = numpy.clip(numpy.floor(positions[:, 0] / self.subcell_dimensions[0]).astype(int) -
+            first_row * self.supersample, 0, shape[0] - 1)
+        subcell_columns = numpy.clip(numpy.floor(positions[:, 1] / self.subcell_dimensions[1]).astype(int) -
+            first_column * self.supersample, 0, shape[1] - 1)
+        subcells = subcell_rows * shape[1] + subcell_columns
+
+        classes = self.radius_classes(accuracies)
+        size = shape[0] * shape[1]
+
+        # a single inverse FFT for the sum of all the classes
+        total = None
+        for radius_class in numpy.unique(classes):
+            histogram = numpy.bincount(subcells[classes == radius_class], minlength=size).reshape(shape)
+            product = numpy.fft.rfft2(histogram) * self.__spectrum(radius_class, shape)
+            total = product if total is None else total + product
+
+        subcell_occupation = numpy.fft.irfft2(total, s=shape)
+        occupation = subcell_occupation.reshape(rows, self.supersample, columns, self.supersample).sum(axis=(1, 3))
+        occupation[numpy.abs(occupation) < EPSILON] = 0.0
+        return occupation
@@ -0,0 +1,86 @@
+import numpy
+
+from .device_gen import DeviceFrame
+
+def match_ids(previous_ids, ids):
+    """
+    Matches the device ids of two frames. Returns the indices of the common
+    devices in the previous and the current frame, the indices of the devices
+    that are only in the previous frame and of those only in the current one.
+    """
+    if len(previous_ids) == len(ids) and numpy.array_equal(previous_ids, ids):
+        common = numpy.arange(len(ids))
+        return common, common, numpy.arange(0), numpy.arange(0)
+
+    if len(previous_ids) == 0:
+        return numpy.arange(0), numpy.arange(0), numpy.arange(0), numpy.arange(len(ids))
+
+    order = numpy.argsort(previous_ids, kind='mergesort')
+    sorted_ids = previous_ids[order]
+    positions = numpy.clip(numpy.searchsorted(sorted_ids, ids), 0, len(sorted_ids) - 1)
+    found = sorted_ids[positions] == ids
+
+    previous_common = order[positions[found]]
+    removed = numpy.ones(len(previous_ids), dtype=bool)
+    removed[previous_common] = False
+
+    return previous_common, numpy.flatnonzero(found), numpy.flatnonzero(removed), numpy.flatnonzero(~found)
+
+class IncrementalOccupation(object):
+    """
+    Keeps the occupation matrix of the last frame together with the device
+    states that produced it. On each update only the devices whose position
+    or accuracy changed more than epsilon (and the devices that appeared or
+    disappeared) are computed: their previous contribution is subtracted and
+    the new one added. Every refresh_interval updates the whole matrix is
+    recomputed to bound the floating point drift.
+    """
+
+    def __init__(self, epsilon=0.0, refresh_interval=100):
+        self.epsilon = epsilon
+        self.refresh_interval = refresh_interval
+
+        self.frame = None
+        self.matrix = None
+        self.updates = 0
+        self.changes = 0
+
+    def reset(self):
+        self.frame = None
+        self.matrix = None
+
+    def update(self, frame, occupation):
+        if self.frame is None or self.updates >= self.refresh_interval:
+            self.matrix = occupation(frame)
+            self.frame = frame.take(numpy.arange(len(frame)))
+            self.updates = 0
+            self.changes = len(frame)
+            return self.matrix
+
+        previous_common, common, removed, added = match_ids(self.frame.ids, frame.ids)
+
+        distance = numpy.hypot(*(frame.positions[common] - self.frame.positions[previous_common]).T)
+        accuracy_change = numpy.abs(frame.accuracies[common] - self.frame.accuracies[previous_common])
+        moved = (distance > self.epsilon) | (accuracy_change > self.epsilon)
+
+        old = self.frame.take(numpy.concatenate([previous_common[moved], removed]))
+        new = frame.take(numpy.concatenate([common[moved], added]))
+
+        matrix = self.matrix.copy()
+        if len(old) > 0:
+            matrix -= occupation(old)
+        if len(new) > 0:
+            matrix += occupation(new)
+
+        # devices that did not move keep the state their contribution was
+        # computed with, so small movements do not accumulate unnoticed
+        positions = frame.positions.copy()
+        accuracies = frame.accuracies.copy()
+        positions[common[~moved]] = self.frame.positions[previous_common[~moved]]
+        accuracies[common[~moved]] = self.frame.accuracies[previous_common[~moved]]
+
+        self.frame = DeviceFrame(frame.ids, positions, accuracies)
+        self.matrix = matrix
+        self.updates += 1
+        self.changes = len(old) + len(new)
+        return self.matrix
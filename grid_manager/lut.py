@@ -0,0 +1,169 @@
+import warnings
+import numpy
+
+from .overlap import disc_weights, displaced_disc_error, MAX_CHUNK_ELEMENTS
+
+# upper bound for the memory used by a table
+MAX_TABLE_BYTES = 64 * 1024 * 1024
+
+class OverlapTable(object):
+    """
+    Precomputed cell weights of a device circle for quantized radius and
+    sub-cell offset buckets. For a device far enough from the grid borders
+    the weights only depend on its radius and on its position inside its
+    cell, so its contribution is a stencil of (2 * h + 1) cells centred on
+    the cell of the device. Radii are quantized in steps of quantization and
+    offsets in bins of quantization per axis, so the circle used for a
+    device is displaced at most about margin from the exact one. For cells
+    too large to keep the table within max_bytes the offset bins are made
+    coarser (offset_step) with a warning, error_bound gives the resulting
+    error.
+    """
+
+    def __init__(self, cell_dimensions, max_radius, quantization=0.1, max_bytes=MAX_TABLE_BYTES):
+        self.cell_dimensions = tuple(cell_dimensions)
+        self.max_radius = float(max_radius)
+        self.quantization = float(quantization)
+
+        self.radius_step = self.quantization
+        self.n_radius = int(numpy.ceil(self.max_radius / self.radius_step)) + 1
+        self.half_size = (
+            int(numpy.ceil(self.max_radius / self.cell_dimensions[0])) + 1,
+            int(numpy.ceil(self.max_radius / self.cell_dimensions[1])) + 1
+        )
+        self.stencil_shape = (2 * self.half_size[0] + 1, 2 * self.half_size[1] + 1)
+
+        # the table holds a stencil per radius and offset bin
+        offset_bytes = self.n_radius * numpy.prod(self.stencil_shape) * numpy.dtype(float).itemsize
+        if offset_bytes > max_bytes:
+            raise ValueError('Overlap table would use at least %d bytes (limit %d). Increase quantization or reduce '
+                'max_radius' % (offset_bytes, max_bytes))
+
+        self.offset_bins = self.__offset_bins(max_bytes // offset_bytes)
+        self.offset_step = (
+            self.cell_dimensions[0] / self.offset_bins[0],
+            self.cell_dimensions[1] / self.offset_bins[1]
+        )
+        self.margin = max(self.quantization, max(self.offset_step))
+
+        if max(self.offset_step) > self.quantization:
+            warnings.warn('Overlap table offset bins of %.3g x %.3g instead of the quantization %.3g to stay within '
+                '%d bytes' % (self.offset_step + (self.quantization, max_bytes)))
+
+        shape = (self.n_radius, self.offset_bins[0], self.offset_bins[1]) + self.stencil_shape
+        self.weights = self.__build(shape)
+
+    def __offset_bins(self, max_bins):
+        offset_bins = (
+            int(numpy.ceil(self.cell_dimensions[0] / self.quantization)),
+            int(numpy.ceil(self.cell_dimensions[1] / self.quantization))
+        )
+        if offset_bins[0] * offset_bins[1] <= max_bins:
+            return offset_bins
+
+        # coarser bins with the same aspect ratio
+        scale = numpy.sqrt(max_bins / float(offset_bins[0] * offset_bins[1]))
+        return (max(1, int(offset_bins[0] * scale)), max(1, int(offset_bins[1] * scale)))
+
+    def __build(self, shape):
+        radius, row_offset, column_offset = numpy.meshgrid(
+            numpy.arange(self.n_radius) * self.radius_step,
+            (numpy.arange(self.offset_bins[0]) + 0.5) / self.offset_bins[0],
+            (numpy.arange(self.offset_bins[1]) + 0.5) / self.offset_bins[1],
+            indexing='ij'
+        )
+
+        # each bucket is a device placed in the centre cell of a stencil sized grid
+        positions = numpy.column_stack([
+            (self.half_size[0] + row_offset.ravel()) * self.cell_dimensions[0],
+            (self.half_size[1] + column_offset.ravel()) * self.cell_dimensions[1]
+        ])
+
+        devices, cells, weights = disc_weights(positions, radius.ravel(), self.cell_dimensions, self.stencil_shape)
+
+        stencil_size = self.stencil_shape[0] * self.stencil_shape[1]
+        table = numpy.bincount(devices * stencil_size + cells, weights=weights, minlength=numpy.prod(shape))
+        return table.reshape(shape)
+
+    def interior(self, positions, accuracies, dimensions):
+        """
+        Returns which devices can use the table: their radius is covered and
+        their quantized circle cannot reach the grid borders.
+        """
+        margin = accuracies + self.margin
+        return (
+            (accuracies <= self.max_radius) &
+            (positions[:, 0] - margin >= 0) & (positions[:, 0] + margin <= dimensions[0]) &
+            (positions[:, 1] - margin >= 0) & (positions[:, 1] + margin <= dimensions[1])
+        )
+
+    def error_bound(self, accuracies):
+        """
+        Upper bound of the L1 error (sum over the cells of the absolute
+        difference with the exact occupation) of the devices that satisfy
+        interior: each circle is moved to the centre of its offset bin and
+        its radius rounded to a multiple of quantization (see
+        displaced_disc_error).
+        """
+        accuracies = numpy.asarray(accuracies, dtype=float)
+        rounded = numpy.clip(numpy.rint(accuracies / self.radius_step), 0, self.n_radius - 1) * self.radius_step
+        offset = numpy.hypot(*self.offset_step) / 2
+        return displaced_disc_error(accuracies, rounded, offset).sum()
+
+    def stencil_weights(self, positions, accuracies, n_cells):
+        """
+        Returns the (device index, flat cell index, weight) triplets of devices
+        that satisfy interior. Devices are grouped by the stencil size their
+        radius needs, so small circles do not pay for the largest stencil.
+        """
+        radius_bins = numpy.clip(numpy.rint(accuracies / self.radius_step).astype(int), 0, self.n_radius - 1)
+        radius = radius_bins * self.radius_step
+        half_rows = numpy.minimum(numpy.ceil(radius / self.cell_dimensions[0]).astype(int) + 1, self.half_size[0])
+        half_columns = numpy.minimum(numpy.ceil(radius / self.cell_dimensions[1]).astype(int) + 1, self.half_size[1])
+        groups = half_rows * (self.half_size[1] + 1) + half_columns
+
+        result = []
+        for group in numpy.unique(groups):
+            members = numpy.flatnonzero(groups == group)
+            half_size = (group // (self.half_size[1] + 1), group % (self.half_size[1] + 1))
+            stencil_size = (2 * half_size[0] + 1) * (2 * half_size[1] + 1)
+            chunk_size = max(1, MAX_CHUNK_ELEMENTS // stencil_size)
+
+            for start in range(0, len(members), chunk_size):
+                chunk = members[start:start + chunk_size]
+                devices, cells, weights = self.__chunk_weights(positions[chunk], radius_bins[chunk],
+                    half_size, n_cells)
+                result.append((chunk[devices], cells, weights))
+
+        if not result:
+            return numpy.zeros(0, dtype=int), numpy.zeros(0, dtype=int), numpy.zeros(0)
+
+        return tuple(numpy.concatenate([r[i] for r in result]) for i in range(3))
+
+    def __chunk_weights(self, positions, radius_bins, half_size, n_cells):
+        scaled_rows = positions[:, 0] / self.cell_dimensions[0]
+        scaled_columns = positions[:, 1] / self.cell_dimensions[1]
+        rows = numpy.floor(scaled_rows).astype(int)
+        columns = numpy.floor(scaled_columns).astype(int)
+
+        row_bins = numpy.minimum(((scaled_rows - rows) * self.offset_bins[0]).astype(int), self.offset_bins[0] - 1)
+        column_bins = numpy.minimum(((scaled_columns - columns) * self.offset_bins[1]).astype(int), self.offset_bins[1] - 1)
+
+        # centred view of the stencils, only the needed part is gathered
+        table = self.weights[:, :, :,
+            self.half_size[0] - half_size[0]:self.half_size[0] + half_size[0] + 1,
+            self.half_size[1] - half_size[1]:self.half_size[1] + half_size[1] + 1]
+        weights = table[radius_bins, row_bins, column_bins]
+
+        stencil_rows = rows[:, None] + numpy.arange(-half_size[0], half_size[0] + 1)
+        stencil_columns = columns[:, None] + numpy.arange(-half_size[1], half_size[1] + 1)
+        inside = (
+            ((stencil_rows >= 0) & (stencil_rows < n_cells[0]))[:, :, None] &
+            ((stencil_columns >= 0) & (stencil_columns < n_cells[1]))[:, None, :]
+        )
+
+        cells = stencil_rows[:, :, None] * n_cells[1] + stencil_columns[:, None, :]
+        devices = numpy.broadcast_to(numpy.arange(len(radius_bins))[:, None, None], weights.shape)
+
+        mask = (weights > 0) & inside
+        return devices[mask], cells[mask], weights[mask]
@@ -0,0 +1,83 @@
+from contextlib import contextmanager
+import time
+
+# stages timed by GridManager.update and the backends
+TIMERS = (
+    'frame', 'broadcast', 'split', 'job', 'merge',
+    'compute', 'circle', 'lookup', 'intersection', 'overlap', 'accumulate', 'temporal'
+)
+
+COUNTERS = (
+    'devices', 'shards', 'halo_devices', 'candidate_cells', 'broadcast_bytes', 'shard_bytes', 'result_bytes'
+)
+
+class FrameStats(object):
+    """
+    Per-frame metrics: time spent in each stage (seconds) and counters. Stats
+    gathered in worker processes or Spark executors are merged into the
+    driver stats, so executor stages add up the time of all the workers.
+    """
+
+    def __init__(self):
+        self.times = {}
+        self.counters = {}
+
+    def add_time(self, stage, elapsed):
+        self.times[stage] = self.times.get(stage, 0.0) + elapsed
+
+    def count(self, counter, n=1):
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+    @contextmanager
+    def timer(self, stage):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.time() - start_time)
+
+    def merge(self, other):
+        for stage, elapsed in other.times.items():
+            self.add_time(stage, elapsed)
+        for counter, n in other.counters.items():
+            self.count(counter, n)
+
+        return self
+
+    def as_dict(self):
+        values = dict(('time_' + stage, self.times.get(stage, 0.0)) for stage in TIMERS)
+        values.update((counter, self.counters.get(counter, 0)) for counter in COUNTERS)
+        return values
+
+class NullStats(FrameStats):
+    """
+    Stats that record nothing, used when metrics are disabled.
+    """
+
+    def add_time(self, stage, elapsed):
+        pass
+
+    def count(self, counter, n=1):
+        pass
+
+    @contextmanager
+    def timer(self, stage):
+        yield
+
+    def merge(self, other):
+        return self
+
+NO_STATS = NullStats()
+
+def start_profiler(profiler):
+    # cProfile.Profile uses enable/disable, pyinstrument.Profiler start/stop
+    if hasattr(profiler, 'enable'):
+        profiler.enable()
+    else:
+        profiler.start()
+
+def stop_profiler(profiler):
+    if hasattr(profiler, 'disable'):
+        profiler.disable()
+    else:
+        profiler.stop()
@@ -0,0 +1,133 @@
+import numpy
+
+# nodes updated together, small enough for the temporaries to stay in cache
+DEFAULT_CHUNK_SIZE = 65536
+
+class MobilityModel(object):
+    """
+    Base of the vectorized mobility models. All the node state is kept in
+    numpy arrays and every step is computed chunk_size nodes at a time.
+    Iterating over a model yields a new (nr_nodes, 2) array of positions
+    per step, so a yielded frame is never modified afterwards. With the same
+    seed and chunk_size the trajectories are reproducible.
+    """
+
+    def __init__(self, nr_nodes, dimensions, seed=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.nr_nodes = nr_nodes
+        self.dimensions = numpy.asarray(dimensions, dtype=float)
+        self.chunk_size = chunk_size
+        self.random = numpy.random.RandomState(seed)
+
+        self.positions = self.uniform_positions(nr_nodes)
+
+    def uniform_positions(self, n):
+        return self.random.random_sample((n, 2)) * self.dimensions
+
+    def chunks(self):
+        for start in range(0, self.nr_nodes, self.chunk_size):
+            yield slice(start, min(start + self.chunk_size, self.nr_nodes))
+
+    def step(self, nodes):
+        raise NotImplementedError()
+
+    def __iter__(self):
+        while True:
+            for nodes in self.chunks():
+                self.step(nodes)
+
+            yield self.positions.copy()
+
+class RandomWaypoint(MobilityModel):
+    """
+    Each node moves in a straight line towards a random waypoint at a random
+    velocity, pauses for up to wt_max steps when it arrives and then picks a
+    new waypoint and velocity. Same parameters as pymobility's RandomWaypoint.
+    """
+
+    def __init__(self, nr_nodes, dimensions, velocity=(0.1, 1.0), wt_max=None, seed=None,
+            chunk_size=DEFAULT_CHUNK_SIZE):
+        MobilityModel.__init__(self, nr_nodes, dimensions, seed, chunk_size)
+
+        self.velocity = velocity
+        self.wt_max = wt_max or 0.0
+
+        self.waypoints = self.uniform_positions(nr_nodes)
+        self.speeds = self.random_speeds(nr_nodes)
+        self.wait = numpy.zeros(nr_nodes)
+
+    def random_speeds(self, n):
+        return self.random.uniform(self.velocity[0], self.velocity[1], n)
+
+    def step(self, nodes):
+        positions = self.positions[nodes]
+        waypoints = self.waypoints[nodes]
+        speeds = self.speeds[nodes]
+        wait = self.wait[nodes]
+
+        moving = wait <= 0
+        wait -= 1
+
+        offsets = waypoints - positions
+        distances = numpy.hypot(offsets[:, 0], offsets[:, 1])
+
+        arrived = moving & (distances <= speeds)
+        travelling = moving & ~arrived
+
+        scale = speeds[travelling] / distances[travelling]
+        positions[travelling] += offsets[travelling] * scale[:, None]
+        positions[arrived] = waypoints[arrived]
+
+        # arrived nodes pause and then leave towards a new waypoint
+        n_arrived = numpy.count_nonzero(arrived)
+        if n_arrived:
+            wait[arrived] = self.random.random_sample(n_arrived) * self.wt_max
+            waypoints[arrived] = self.uniform_positions(n_arrived)
+            speeds[arrived] = self.random_speeds(n_arrived)
+
+class RandomWalk(MobilityModel):
+    """
+    Each node moves at a random velocity in a random direction for a flight
+    of up to max_flight length units, then turns to a new random direction.
+    Nodes bounce off the borders of the area.
+    """
+
+    def __init__(self, nr_nodes, dimensions, velocity=(0.1, 1.0), max_flight=10.0, seed=None,
+            chunk_size=DEFAULT_CHUNK_SIZE):
+        MobilityModel.__init__(self, nr_nodes, dimensions, seed, chunk_size)
+
+        self.velocity = velocity
+        self.max_flight = max_flight
+
+        self.directions = self.random_directions(nr_nodes)
+        self.speeds = self.random.uniform(velocity[0], velocity[1], nr_nodes)
+        self.flights = self.random.random_sample(nr_nodes) * max_flight
+
+    def random_directions(self, n):
+        angles = self.random.random_sample(n) * 2 * numpy.pi
+        return numpy.column_stack([numpy.cos(angles), numpy.sin(angles)])
+
+    def step(self, nodes):
+        positions = self.positions[nodes]
+        directions = self.directions[nodes]
+        speeds = self.speeds[nodes]
+        flights = self.flights[nodes]
+
+        positions += directions * speeds[:, None]
+        flights -= speeds
+
+        # reflect on the borders
+        for axis in range(2):
+            low = positions[:, axis] < 0
+            high = positions[:, axis] > self.dimensions[axis]
+            positions[low, axis] = -positions[low, axis]
+            positions[high, axis] = 2 * self.dimensions[axis] - positions[high, axis]
+            directions[low | high, axis] = -directions[low | high, axis]
+
+        numpy.clip(positions, 0, self.dimensions, out=positions)
+
+        finished = flights <= 0
+        n_finished = numpy.count_nonzero(finished)
+        if n_finished:
+            directions[finished] = self.random_directions(n_finished)
+            speeds[finished] = self.random.uniform(self.velocity[0], self.velocity[1], n_finished)
+            flights[finished] = self.random.random_sample(n_finished) * self.max_flight
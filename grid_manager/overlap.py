@@ -0,0 +1,213 @@
+import numpy
+
+# upper bound on the number of corner areas evaluated at once
+MAX_CHUNK_ELEMENTS = 1000000
+
+# probability that a device is inside its accuracy circle (68% for GPS
+# fixes), accuracy / ACCURACY_SIGMAS is the standard deviation that gives it
+ACCURACY_CONFIDENCE = 0.68
+ACCURACY_SIGMAS = numpy.sqrt(-2.0 * numpy.log(1.0 - ACCURACY_CONFIDENCE))
+
+# standard deviations covered by the gaussian kernel along each axis
+GAUSSIAN_TRUNCATE = 3.0
+
+# half the side of the gaussian kernel square, relative to the accuracy
+GAUSSIAN_REACH = GAUSSIAN_TRUNCATE / ACCURACY_SIGMAS
+
+ERF_P = 0.3275911
+ERF_A = (0.254829592, -0.284496736, 1.421413741, -1.453152027, 1.061405429)
+
+def _primitive(t, r, r_safe):
+    # integral of sqrt(r^2 - t^2) dt
+    ratio = numpy.clip(t / r_safe, -1.0, 1.0)
+    return 0.5 * (t * numpy.sqrt(numpy.maximum(r * r - t * t, 0.0)) + r * r * numpy.arcsin(ratio))
+
+def corner_area(x, y, r):
+    """
+    Signed area of the intersection between the disc of radius r centred at
+    the origin and the rectangle with opposite corners (0, 0) and (x, y).
+    """
+    sign = numpy.sign(x) * numpy.sign(y)
+    x = numpy.minimum(numpy.abs(x), r)
+    y = numpy.minimum(numpy.abs(y), r)
+    r_safe = numpy.where(r > 0, r, 1.0)
+
+    x_cut = numpy.minimum(numpy.sqrt(numpy.maximum(r * r - y * y, 0.0)), x)
+    area = y * x_cut + _primitive(x, r, r_safe) - _primitive(x_cut, r, r_safe)
+    return sign * area
+
+def _window_size(radius, cell_size):
+    return int(numpy.ceil(2.0 * radius / cell_size)) + 1
+
+def _first_cell(coordinates, cell_size, n):
+    first = numpy.floor(coordinates / cell_size).astype(int)
+    return numpy.clip(first, 0, n - 1)
+
+def _disc_chunk(positions, accuracies, cell_dimensions, n_cells):
+    rows, columns = n_cells
+    max_radius = accuracies.max()
+    k_rows = _window_size(max_radius, cell_dimensions[0])
+    k_columns = _window_size(max_radius, cell_dimensions[1])
+
+    first_row = _first_cell(positions[:, 0] - accuracies, cell_dimensions[0], rows)
+    first_column = _first_cell(positions[:, 1] - accuracies, cell_dimensions[1], columns)
+
+    row_indices = first_row[:, None] + numpy.arange(k_rows + 1)
+    column_indices = first_column[:, None] + numpy.arange(k_columns + 1)
+
+    # cell edges relative to each device, clipped to the grid limits so that
+    # window cells falling outside the grid get a zero area
+    x = numpy.minimum(row_indices, rows) * cell_dimensions[0] - positions[:, 0:1]
+    y = numpy.minimum(column_indices, columns) * cell_dimensions[1] - positions[:, 1:2]
+
+    corners = corner_area(x[:, :, None], y[:, None, :], accuracies[:, None, None])
+    areas = numpy.diff(numpy.diff(corners, axis=1), axis=2)
+
+    # the area outside the grid is redistributed proportionally among the
+    # common cells, i.e. each device contributes common_area / total_common
+    total_common = areas.sum(axis=(1, 2))
+    weights = numpy.zeros_like(areas)
+    inside = total_common > 0
+    weights[inside] = areas[inside] / total_common[inside][:, None, None]
+
+    cell_rows = numpy.minimum(row_indices[:, :-1], rows - 1)
+    cell_columns = numpy.minimum(column_indices[:, :-1], columns - 1)
+    cells = cell_rows[:, :, None] * columns + cell_columns[:, None, :]
+    devices = numpy.arange(len(accuracies))[:, None, None]
+
+    mask = weights > 0
+    return numpy.broadcast_to(devices, mask.shape)[mask], cells[mask], weights[mask]
+
+def _point_cells(positions, cell_dimensions, n_cells):
+    rows, columns = n_cells
+    inside = (
+        (positions[:, 0] >= 0) & (positions[:, 0] <= rows * cell_dimensions[0]) &
+        (positions[:, 1] >= 0) & (positions[:, 1] <= columns * cell_dimensions[1])
+    )
+
+    row = _first_cell(positions[:, 0], cell_dimensions[0], rows)
+    column = _first_cell(positions[:, 1], cell_dimensions[1], columns)
+    devices = numpy.flatnonzero(inside)
+    return devices, row[inside] * columns + column[inside], numpy.ones(len(devices))
+
+def _chunked_weights(positions, accuracies, cell_dimensions, n_cells, chunk_weights, radius):
+    positions = numpy.asarray(positions, dtype=float).reshape(-1, 2)
+    accuracies = numpy.asarray(accuracies, dtype=float).reshape(-1)
+
+    # devices with no accuracy radius are located at a single cell
+    points = numpy.flatnonzero(accuracies <= 0)
+    p_devices, p_cells, p_weights = _point_cells(positions[points], cell_dimensions, n_cells)
+    result = [(points[p_devices], p_cells, p_weights)]
+
+    # sorting by radius keeps the evaluation windows of each chunk tight
+    discs = numpy.flatnonzero(accuracies > 0)
+    discs = discs[numpy.argsort(accuracies[discs], kind='mergesort')]
+
+    cost = (numpy.ceil(2.0 * radius * accuracies[discs] / min(cell_dimensions)) + 2) ** 2
+
+    start = 0
+    while start < len(discs):
+        chunk_cost = numpy.arange(1, len(discs) - start + 1) * cost[start:]
+        end = start + max(1, numpy.searchsorted(chunk_cost, MAX_CHUNK_ELEMENTS, side='right'))
+
+        chunk = discs[start:end]
+        devices, cells, weights = chunk_weights(positions[chunk], accuracies[chunk], cell_dimensions, n_cells)
+        result.append((chunk[devices], cells, weights))
+        start = end
+
+    devices = numpy.concatenate([r[0] for r in result])
+    cells = numpy.concatenate([r[1] for r in result])
+    weights = numpy.concatenate([r[2] for r in result])
+    return devices, cells, weights
+
+def disc_weights(positions, accuracies, cell_dimensions, n_cells):
+    """
+    Computes the exact overlap between each device accuracy circle and the
+    cells of a uniform grid. positions is a (N, 2) array and accuracies a (N,)
+    array. Returns three aligned arrays (device index, flat cell index, weight)
+    where the weights of each device sum to 1 if it touches the grid.
+    """
+    return _chunked_weights(positions, accuracies, cell_dimensions, n_cells, _disc_chunk, 1.0)
+
+def displaced_disc_error(accuracies, rounded, offset):
+    """
+    Upper bound of the L1 error of each device whose disc of radius accuracy
+    is replaced by a disc of radius rounded whose centre is at most offset
+    away. It is the total variation between the two uniform discs:
+
+        2 * (1 - ((min(r, r') - d) / max(r, r')) ** 2)
+
+    so it decreases as 4 * (d + |r - r'|) / r with the device radius. A
+    point stays in its cell and has no error.
+    """
+    inner = numpy.maximum(numpy.minimum(accuracies, rounded) - offset, 0.0)
+    outer = numpy.maximum(accuracies, rounded)
+    bounds = 2.0 * (1.0 - (inner / numpy.where(outer > 0, outer, 1.0)) ** 2)
+    return numpy.where(accuracies > 0, bounds, 0.0)
+
+def erf(x):
+    """
+    Vectorized error function (Abramowitz and Stegun 7.1.26), with an
+    absolute error below 1.5e-7.
+    """
+    x = numpy.asarray(x, dtype=float)
+    t = 1.0 / (1.0 + ERF_P * numpy.abs(x))
+    polynomial = t * (ERF_A[0] + t * (ERF_A[1] + t * (ERF_A[2] + t * (ERF_A[3] + t * ERF_A[4]))))
+    return numpy.sign(x) * (1.0 - polynomial * numpy.exp(-x * x))
+
+def _axis_weights(centres, sigmas, first, k, cell_size, n):
+    # probability of each of the k cells from first along one axis, with the
+    # edges clipped to the grid and to the truncation window of each device
+    indices = first[:, None] + numpy.arange(k + 1)
+    low = numpy.maximum(centres - GAUSSIAN_TRUNCATE * sigmas, 0.0)[:, None]
+    high = numpy.minimum(centres + GAUSSIAN_TRUNCATE * sigmas, n * cell_size)[:, None]
+    edges = numpy.clip(indices * cell_size, low, numpy.maximum(low, high))
+
+    cdf = erf((edges - centres[:, None]) / (numpy.sqrt(2.0) * sigmas[:, None]))
+    return numpy.minimum(indices[:, :-1], n - 1), 0.5 * numpy.diff(cdf, axis=1)
+
+def _gaussian_chunk(positions, accuracies, cell_dimensions, n_cells):
+    rows, columns = n_cells
+    sigmas = accuracies / ACCURACY_SIGMAS
+    max_radius = GAUSSIAN_TRUNCATE * sigmas.max()
+    k_rows = _window_size(max_radius, cell_dimensions[0])
+    k_columns = _window_size(max_radius, cell_dimensions[1])
+
+    first_row = _first_cell(positions[:, 0] - GAUSSIAN_TRUNCATE * sigmas, cell_dimensions[0], rows)
+    first_column = _first_cell(positions[:, 1] - GAUSSIAN_TRUNCATE * sigmas, cell_dimensions[1], columns)
+
+    cell_rows, row_weights = _axis_weights(positions[:, 0], sigmas, first_row, k_rows, cell_dimensions[0], rows)
+    cell_columns, column_weights = _axis_weights(positions[:, 1], sigmas, first_column, k_columns,
+        cell_dimensions[1], columns)
+
+    # the kernel is separable, so the probability of a cell is the product of
+    # the probabilities of its row and its column. The mass outside the grid
+    # is redistributed proportionally among the common cells
+    total_common = row_weights.sum(axis=1) * column_weights.sum(axis=1)
+    inside = total_common > 0
+    row_weights[inside] /= total_common[inside][:, None]
+    row_weights[~inside] = 0.0
+
+    weights = row_weights[:, :, None] * column_weights[:, None, :]
+    cells = cell_rows[:, :, None] * columns + cell_columns[:, None, :]
+    devices = numpy.arange(len(accuracies))[:, None, None]
+
+    mask = weights > 0
+    return numpy.broadcast_to(devices, mask.shape)[mask], cells[mask], weights[mask]
+
+def gaussian_weights(positions, accuracies, cell_dimensions, n_cells):
+    """
+    Same as disc_weights, but each device is a 2D gaussian centred at its
+    position whose accuracy is the radius of the ACCURACY_CONFIDENCE
+    probability circle. The gaussian is truncated at GAUSSIAN_TRUNCATE
+    standard deviations along each axis.
+    """
+    return _chunked_weights(positions, accuracies, cell_dimensions, n_cells, _gaussian_chunk, GAUSSIAN_REACH)
+
+def accumulate(cells, weights, n_cells):
+    """
+    Sums the weights of each flat cell index into a dense rows x columns matrix.
+    """
+    size = n_cells[0] * n_cells[1]
+    # bincount of no cells is an integer array even with weights
+    return numpy.bincount(cells, weights=weights, minlength=size).astype(float).reshape(n_cells)
@@ -0,0 +1,182 @@
+import itertools
+import threading
+import time
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+STAGES = ('produce', 'compute', 'consume')
+QUEUES = ('frames', 'results')
+
+# marks the end of the frames in the queues
+END = object()
+
+class PipelineStats(object):
+    """
+    Busy and blocked time of each stage and the depth of each queue, sampled
+    every time an item is taken from it.
+    """
+
+    def __init__(self):
+        self.frames = 0
+        self.elapsed = 0.0
+        self.busy = dict((stage, 0.0) for stage in STAGES)
+        self.blocked = dict((stage, 0.0) for stage in STAGES)
+        self.depth_sum = dict((queue, 0) for queue in QUEUES)
+        self.depth_max = dict((queue, 0) for queue in QUEUES)
+        self.samples = dict((queue, 0) for queue in QUEUES)
+
+    def sample(self, queue, depth):
+        self.depth_sum[queue] += depth
+        self.depth_max[queue] = max(self.depth_max[queue], depth)
+        self.samples[queue] += 1
+
+    @property
+    def frames_per_second(self):
+        return self.frames / self.elapsed if self.elapsed > 0 else 0.0
+
+    def as_dict(self):
+        values = {'frames_per_second': self.frames_per_second}
+        for stage in STAGES:
+            values['busy_' + stage] = self.busy[stage]
+            values['blocked_' + stage] = self.blocked[stage]
+        for queue in QUEUES:
+            values['avg_depth_' + queue] = self.depth_sum[queue] / float(max(1, self.samples[queue]))
+            values['max_depth_' + queue] = self.depth_max[queue]
+        return values
+
+class FramePipeline(object):
+    """
+    Runs produce, compute and consume as a pipeline: a producer thread takes
+    frames from the frames iterator, the calling thread computes them and a
+    consumer thread handles the results. The bounded queues between the
+    stages (depth items each) apply backpressure, so while frame t is being
+    computed frame t + 1 is produced and the result of frame t - 1 consumed,
+    and the frame rate approaches that of the slowest stage.
+
+    compute runs in the calling thread, which is where the Spark context and
+    the grid manager are used. Its result must not be modified by the next
+    compute call because it is consumed concurrently.
+    """
+
+    def __init__(self, frames, compute, consume, depth=2):
+        self.frames = frames
+        self.compute = compute
+        self.consume = consume
+        self.depth = depth
+
+        self.stats = None
+        self.__error = None
+        self.__stop = threading.Event()
+
+    def __put(self, queue, item, stage):
+        start_time = time.time()
+        queue.put(item)
+        self.stats.blocked[stage] += time.time() - start_time
+
+    def __get(self, queue, name, stage):
+        self.stats.sample(name, queue.qsize())
+        start_time = time.time()
+        item = queue.get()
+        self.stats.blocked[stage] += time.time() - start_time
+        return item
+
+    def __produce(self, frames_queue, n_frames):
+        frames = iter(self.frames)
+        if n_frames is not None:
+            frames = itertools.islice(frames, n_frames)
+
+        try:
+            while not self.__stop.is_set():
+                start_time = time.time()
+                try:
+                    frame = next(frames)
+                except StopIteration:
+                    break
+                finally:
+                    self.stats.busy['produce'] += time.time() - start_time
+
+                self.__put(frames_queue, frame, 'produce')
+        except Exception as e:
+            self.__error = e
+        finally:
+            frames_queue.put(END)
+
+    def __consume(self, results_queue):
+        # the results computed before a failure elsewhere are still consumed,
+        # after a failure here the remaining ones are only drained
+        failed = False
+        while True:
+            result = self.__get(results_queue, 'results', 'consume')
+            if result is END:
+                return
+
+            if failed:
+                continue
+
+            start_time = time.time()
+            try:
+                self.consume(result)
+            except Exception as e:
+                self.__error = e
+                self.__stop.set()
+                failed = True
+            finally:
+                self.stats.busy['consume'] += time.time() - start_time
+
+    def run(self, n_frames=None):
+        """
+        Processes n_frames frames (all of them if None) and returns the
+        PipelineStats. An exception raised by any stage stops the pipeline
+        and is raised again here.
+        """
+        self.stats = PipelineStats()
+        self.__error = None
+        self.__stop.clear()
+
+        frames_queue = Queue(maxsize=self.depth)
+        results_queue = Queue(maxsize=self.depth)
+
+        producer = threading.Thread(target=self.__produce, args=(frames_queue, n_frames))
+        consumer = threading.Thread(target=self.__consume, args=(results_queue,))
+        producer.daemon = True
+        consumer.daemon = True
+
+        start_time = time.time()
+        producer.start()
+        consumer.start()
+
+        try:
+            while True:
+                frame = self.__get(frames_queue, 'frames', 'compute')
+                if frame is END or self.__stop.is_set():
+                    break
+
+                compute_time = time.time()
+                result = self.compute(frame)
+                self.stats.busy['compute'] += time.time() - compute_time
+
+                self.__put(results_queue, result, 'compute')
+                self.stats.frames += 1
+        except Exception as e:
+            self.__error = e
+        finally:
+            self.__stop.set()
+            results_queue.put(END)
+
+            # unblock the producer if it is waiting for space
+            while producer.is_alive():
+                while not frames_queue.empty():
+                    frames_queue.get()
+                producer.join(0.01)
+
+            consumer.join()
+
+        self.stats.elapsed = time.time() - start_time
+
+        if self.__error is not None:
+            raise self.__error
+
+        return self.stats
@@ -0,0 +1,97 @@
+import numpy
+
+from .sparse import densify
+
+# every level splits each cell of the previous one into factor x factor cells
+REFINE_FACTOR = 2
+
+def level_cells(n_cells, levels):
+    """
+    Returns the number of cells of each level, from the coarsest to n_cells.
+    """
+    factor = REFINE_FACTOR ** (levels - 1)
+    if n_cells[0] % factor or n_cells[1] % factor:
+        raise ValueError('The number of cells %s must be divisible by %d to use %d levels' % (n_cells, factor, levels))
+
+    return [
+        (n_cells[0] // REFINE_FACTOR ** level, n_cells[1] // REFINE_FACTOR ** level)
+        for level in reversed(range(levels))
+    ]
+
+def upsample(matrix, factor=REFINE_FACTOR):
+    return matrix.repeat(factor, axis=0).repeat(factor, axis=1)
+
+def touching(positions, radii, mask, cell_dimensions):
+    """
+    Returns the indices of the devices whose reach (radii, see
+    GridLayout.reach) bounding box overlaps a marked cell of mask, using a
+    summed area table of the mask.
+    """
+    n_cells = mask.shape
+    first_rows = numpy.clip(numpy.floor((positions[:, 0] - radii) / cell_dimensions[0]).astype(int), 0, n_cells[0] - 1)
+    last_rows = numpy.clip(numpy.floor((positions[:, 0] + radii) / cell_dimensions[0]).astype(int), 0, n_cells[0] - 1)
+    first_columns = numpy.clip(numpy.floor((positions[:, 1] - radii) / cell_dimensions[1]).astype(int), 0, n_cells[1] - 1)
+    last_columns = numpy.clip(numpy.floor((positions[:, 1] + radii) / cell_dimensions[1]).astype(int), 0, n_cells[1] - 1)
+
+    table = numpy.zeros((n_cells[0] + 1, n_cells[1] + 1), dtype=int)
+    table[1:, 1:] = mask.cumsum(axis=0).cumsum(axis=1)
+
+    marked = (
+        table[last_rows + 1, last_columns + 1] - table[first_rows, last_columns + 1] -
+        table[last_rows + 1, first_columns] + table[first_rows, first_columns]
+    )
+
+    return numpy.flatnonzero(marked > 0)
+
+class MultiResolution(object):
+    """
+    Computes the occupation of a frame on a pyramid of grid layouts, from the
+    coarsest to the finest. The first level is computed for all the devices;
+    each following level only computes the children of the cells whose
+    density is above threshold, with the devices that can reach them. The
+    other cells keep the occupation of their parent split among the children
+    (evenly, or by walkable area in a venue), so every level covers the
+    whole grid.
+    """
+
+    def __init__(self, layouts, threshold=0.0):
+        self.layouts = layouts
+        self.threshold = threshold
+
+        self.levels = []
+        self.exact = []
+
+    def __child_shares(self, level):
+        # the occupation of a parent cell is split by the walkable area of
+        # its children, or evenly without a venue
+        walkable_area = self.layouts[level].walkable_area
+        if walkable_area is None:
+            return 1.0 / REFINE_FACTOR ** 2
+
+        parent_area = upsample(self.layouts[level - 1].walkable_area)
+        return numpy.where(parent_area > 0, walkable_area / numpy.where(parent_area > 0, parent_area, 1.0),
+            1.0 / REFINE_FACTOR ** 2)
+
+    def update(self, frame, occupation):
+        self.levels = []
+        self.exact = []
+
+        refine = None
+        for level, layout in enumerate(self.layouts):
+            if refine is None:
+                exact = numpy.ones(layout.n_cells, dtype=bool)
+                matrix = densify(occupation(frame, layout))
+            else:
+                exact = upsample(refine)
+                matrix = upsample(self.levels[-1]) * self.__child_shares(level)
+
+                devices = touching(frame.positions, layout.reach(frame.accuracies), exact, layout.cell_dimensions)
+                matrix[exact] = 0.0
+                if len(devices) > 0:
+                    matrix[exact] = densify(occupation(frame.take(devices), layout))[exact]
+
+            self.levels.append(matrix)
+            self.exact.append(exact)
+            refine = exact & (densify(layout.density(matrix)) > self.threshold)
+
+        return self.levels[-1]
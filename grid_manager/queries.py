@@ -0,0 +1,107 @@
+from collections import namedtuple
+
+import numpy
+
+Region = namedtuple('Region', ['label', 'cells', 'occupation', 'max_density', 'mean_density'])
+
+NEIGHBOURS = {
+    4: ((-1, 0), (1, 0), (0, -1), (0, 1)),
+    8: ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)),
+}
+
+def greater(threshold):
+    return lambda matrix: matrix > threshold
+
+def greater_equal(threshold):
+    return lambda matrix: matrix >= threshold
+
+def between(low, high):
+    return lambda matrix: (matrix >= low) & (matrix < high)
+
+def evaluate(f, matrix):
+    """
+    Applies f to the whole matrix and returns a boolean mask. f may be a
+    numpy ufunc or any function working on arrays; functions that only work
+    on single values are applied element by element.
+    """
+    try:
+        mask = numpy.asarray(f(matrix), dtype=bool)
+    except (TypeError, ValueError):
+        mask = None
+
+    if mask is None or mask.shape != matrix.shape:
+        mask = numpy.vectorize(f, otypes=[bool])(matrix)
+
+    return mask
+
+def top_k(matrix, k):
+    """
+    Returns the (row, column) coordinates of the k largest values of matrix
+    in decreasing order, and the values.
+    """
+    k = min(k, matrix.size)
+    if k <= 0:
+        return numpy.zeros((0, 2), dtype=int), numpy.zeros(0)
+
+    flat = matrix.ravel()
+    largest = numpy.argpartition(-flat, k - 1)[:k]
+    largest = largest[numpy.argsort(-flat[largest], kind='mergesort')]
+
+    cells = numpy.column_stack(numpy.unravel_index(largest, matrix.shape))
+    return cells, flat[largest]
+
+def label_regions(mask, connectivity=4):
+    """
+    Labels the connected regions of True cells of mask. Returns a matrix with
+    the label (starting at 1) of each cell, 0 for the cells outside regions,
+    and the number of regions. Only the marked cells are visited.
+    """
+    neighbours = NEIGHBOURS[connectivity]
+    labels = numpy.zeros(mask.shape, dtype=int)
+
+    n_regions = 0
+    for start in map(tuple, numpy.argwhere(mask)):
+        if labels[start]:
+            continue
+
+        n_regions += 1
+        labels[start] = n_regions
+        pending = [start]
+        while pending:
+            row, column = pending.pop()
+            for d_row, d_column in neighbours:
+                cell = (row + d_row, column + d_column)
+                if 0 <= cell[0] < mask.shape[0] and 0 <= cell[1] < mask.shape[1] \
+                        and mask[cell] and not labels[cell]:
+                    labels[cell] = n_regions
+                    pending.append(cell)
+
+    return labels, n_regions
+
+def regions(mask, occupation_matrix, density_matrix, connectivity=4):
+    """
+    Groups the marked cells into connected regions, sorted by decreasing
+    total occupation.
+    """
+    labels, n_regions = label_regions(mask, connectivity)
+
+    flat_labels = labels.ravel()
+    size = n_regions + 1
+    occupation = numpy.bincount(flat_labels, weights=occupation_matrix.ravel(), minlength=size)
+    density = numpy.bincount(flat_labels, weights=density_matrix.ravel(), minlength=size)
+    counts = numpy.bincount(flat_labels, minlength=size)
+
+    max_density = numpy.full(size, -numpy.inf)
+    numpy.maximum.at(max_density, flat_labels, density_matrix.ravel())
+
+    marked = numpy.flatnonzero(flat_labels)
+    marked = marked[numpy.argsort(flat_labels[marked], kind='mergesort')]
+    region_cells = numpy.split(marked, numpy.cumsum(counts[1:])[:-1])
+
+    result = [
+        Region(label, numpy.column_stack(numpy.unravel_index(region_cells[label - 1], mask.shape)),
+            occupation[label], max_density[label], density[label] / counts[label])
+        for label in range(1, size)
+    ]
+
+    return sorted(result, key=lambda region: -region.occupation)
@@ -0,0 +1,153 @@
+import json
+import os
+import numpy
+
+from .device_gen import DeviceFrame
+
+# a recording is a directory of raw little endian columns with all the
+# frames one after the other, and the offsets of each frame
+POSITIONS = 'positions.bin'
+ACCURACIES = 'accuracies.bin'
+CODES = 'codes.bin'
+OFFSETS = 'offsets.bin'
+IDS = 'ids.npy'
+META = 'meta.json'
+
+POSITION_DTYPE = numpy.dtype('<f8')
+ACCURACY_DTYPE = numpy.dtype('<f8')
+CODE_DTYPE = numpy.dtype('<i4')
+OFFSET_DTYPE = numpy.dtype('<i8')
+
+FORMAT_VERSION = 1
+
+class FrameRecorder(object):
+    """
+    Appends device frames to a recording directory. Positions and accuracies
+    are written as they are; device ids are replaced by int32 codes into an
+    id table written on close. Frames may contain different devices.
+    """
+
+    def __init__(self, path):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.path = path
+        self.files = dict(
+            (name, open(os.path.join(path, name), 'wb'))
+            for name in (POSITIONS, ACCURACIES, CODES, OFFSETS)
+        )
+
+        self.id_codes = {}
+        self.frames = 0
+        self.rows = 0
+
+        self.__last_ids = None
+        self.__last_codes = None
+
+        numpy.zeros(1, dtype=OFFSET_DTYPE).tofile(self.files[OFFSETS])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __encode(self, ids):
+        # generators usually reuse the same ids on every frame
+        if self.__last_ids is not None and len(ids) == len(self.__last_ids) and numpy.array_equal(ids, self.__last_ids):
+            return self.__last_codes
+
+        codes = numpy.array([self.id_codes.setdefault(node_id, len(self.id_codes)) for node_id in ids.tolist()],
+            dtype=CODE_DTYPE)
+
+        self.__last_ids = ids.copy()
+        self.__last_codes = codes
+        return codes
+
+    def write(self, frame):
+        self.__encode(frame.ids).tofile(self.files[CODES])
+        frame.positions.astype(POSITION_DTYPE).tofile(self.files[POSITIONS])
+        frame.accuracies.astype(ACCURACY_DTYPE).tofile(self.files[ACCURACIES])
+
+        self.frames += 1
+        self.rows += len(frame)
+        numpy.array([self.rows], dtype=OFFSET_DTYPE).tofile(self.files[OFFSETS])
+
+    def close(self):
+        if self.files is None:
+            return
+
+        for output in self.files.values():
+            output.close()
+
+        self.files = None
+
+        ids = sorted(self.id_codes, key=self.id_codes.get)
+        numpy.save(os.path.join(self.path, IDS), numpy.array(ids))
+
+        with open(os.path.join(self.path, META), 'w') as meta:
+            json.dump({'version': FORMAT_VERSION, 'frames': self.frames, 'rows': self.rows}, meta)
+
+def map_column(path, dtype, shape):
+    # numpy cannot map empty files
+    if shape[0] == 0:
+        return numpy.zeros(shape, dtype=dtype)
+
+    return numpy.memmap(path, dtype=dtype, mode='r', shape=shape)
+
+class FrameReplay(object):
+    """
+    Reads the frames of a recording through memory maps. Frames are views
+    of the mapped columns, so nothing is parsed and only the pages that are
+    used are loaded: recordings may be larger than the available memory.
+    """
+
+    def __init__(self, path, loop=False):
+        with open(os.path.join(path, META)) as meta:
+            meta = json.load(meta)
+
+        if meta['version'] != FORMAT_VERSION:
+            raise ValueError('Unsupported recording version %s' % meta['version'])
+
+        self.path = path
+        self.loop = loop
+        self.frames = meta['frames']
+        rows = meta['rows']
+
+        self.ids = numpy.load(os.path.join(path, IDS))
+        self.offsets = map_column(os.path.join(path, OFFSETS), OFFSET_DTYPE, (self.frames + 1,))
+        self.codes = map_column(os.path.join(path, CODES), CODE_DTYPE, (rows,))
+        self.positions = map_column(os.path.join(path, POSITIONS), POSITION_DTYPE, (rows, 2))
+        self.accuracies = map_column(os.path.join(path, ACCURACIES), ACCURACY_DTYPE, (rows,))
+
+    def __len__(self):
+        return self.frames
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.frames
+
+        if not 0 <= index < self.frames:
+            raise IndexError('Frame %d out of range' % index)
+
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return DeviceFrame(self.ids[self.codes[start:end]], self.positions[start:end], self.accuracies[start:end])
+
+    def __iter__(self):
+        while True:
+            for index in range(self.frames):
+                yield self[index]
+
+            if not self.loop or self.frames == 0:
+                return
+
+def record_frames(devices_gen, path, frames):
+    """
+    Writes frames consecutive frames of devices_gen to a recording.
+    """
+    with FrameRecorder(path) as recorder:
+        for i in range(frames):
+            recorder.write(next(devices_gen))
+
+def replay_generator(path, loop=False):
+    return iter(FrameReplay(path, loop))
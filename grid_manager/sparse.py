@@ -0,0 +1,96 @@
+import numpy
+
+class SparseMatrix(object):
+    """
+    Rows x columns matrix that only stores the touched cells, as sorted flat
+    cell indices and their values. Adding, subtracting and scaling keep it
+    sparse, so memory and serialized size grow with the number of touched
+    cells instead of with the grid size. toarray builds (and keeps) the
+    dense matrix on demand.
+    """
+
+    def __init__(self, shape, cells=None, values=None):
+        self.shape = tuple(shape)
+        self.cells = numpy.zeros(0, dtype=int) if cells is None else numpy.asarray(cells, dtype=int)
+        self.values = numpy.zeros(0) if values is None else numpy.asarray(values, dtype=float)
+        self.__dense = None
+
+    @classmethod
+    def from_cells(cls, cells, weights, shape):
+        """
+        Sums the weights of each flat cell index. Repeated cells are merged.
+        """
+        cells, inverse = numpy.unique(cells, return_inverse=True)
+        return cls(shape, cells, numpy.bincount(inverse, weights=weights, minlength=len(cells)))
+
+    @classmethod
+    def from_dense(cls, matrix):
+        cells = numpy.flatnonzero(matrix)
+        return cls(matrix.shape, cells, matrix.ravel()[cells])
+
+    @property
+    def nnz(self):
+        return len(self.cells)
+
+    @property
+    def nbytes(self):
+        return self.cells.nbytes + self.values.nbytes
+
+    @property
+    def coordinates(self):
+        return numpy.column_stack(numpy.unravel_index(self.cells, self.shape))
+
+    def toarray(self):
+        if self.__dense is None:
+            dense = numpy.zeros(self.shape[0] * self.shape[1])
+            dense[self.cells] = self.values
+            self.__dense = dense.reshape(self.shape)
+
+        return self.__dense
+
+    def sum(self):
+        return self.values.sum()
+
+    def copy(self):
+        return SparseMatrix(self.shape, self.cells.copy(), self.values.copy())
+
+    def __merge(self, other, sign):
+        if not isinstance(other, SparseMatrix):
+            return NotImplemented
+
+        if other.shape != self.shape:
+            raise ValueError('Matrix shapes differ: %s and %s' % (self.shape, other.shape))
+
+        return SparseMatrix.from_cells(
+            numpy.concatenate([self.cells, other.cells]),
+            numpy.concatenate([self.values, sign * other.values]),
+            self.shape
+        )
+
+    def __add__(self, other):
+        return self.__merge(other, 1.0)
+
+    def __sub__(self, other):
+        return self.__merge(other, -1.0)
+
+    def __mul__(self, factor):
+        return SparseMatrix(self.shape, self.cells, self.values * factor)
+
+    def __truediv__(self, divisor):
+        return SparseMatrix(self.shape, self.cells, self.values / divisor)
+
+    __rmul__ = __mul__
+    __div__ = __truediv__
+
+    def __getstate__(self):
+        # the dense cache is not shipped between processes
+        return {'shape': self.shape, 'cells': self.cells, 'values': self.values}
+
+    def __setstate__(self, state):
+        self.__init__(state['shape'], state['cells'], state['values'])
+
+def densify(matrix):
+    if isinstance(matrix, SparseMatrix):
+        return matrix.toarray()
+
+    return matrix
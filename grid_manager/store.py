@@ -0,0 +1,276 @@
+import json
+import os
+import threading
+import time
+import numpy
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+from .sparse import densify
+
+# a store is a directory with the raw timestamps of the frames and a
+# directory of chunks per matrix. Each chunk holds chunk_frames consecutive
+# (rows, columns) matrices, as a .npy file that can be memory mapped or as a
+# compressed .npz file
+TIMESTAMPS = 'timestamps.bin'
+META = 'meta.json'
+MATRICES = ('occupation', 'density')
+
+TIMESTAMP_DTYPE = numpy.dtype('<f8')
+MATRIX_DTYPE = numpy.dtype('<f8')
+
+FORMAT_VERSION = 1
+
+DEFAULT_CHUNK_FRAMES = 64
+
+# marks the end of the chunks in the queue
+END = object()
+
+def chunk_path(path, name, chunk, compressed):
+    return os.path.join(path, name, '%08d.%s' % (chunk, 'npz' if compressed else 'npy'))
+
+class DensityWriter(object):
+    """
+    Appends the occupation and density matrices of every frame, with their
+    timestamp, to a store directory. write only copies the matrices into the
+    current chunk; full chunks are compressed and written by a background
+    thread, with at most queue_size chunks waiting, so the update loop is
+    not blocked by the disk. The metadata is rewritten after every chunk,
+    so a store is readable up to its last complete chunk while it grows.
+    """
+
+    def __init__(self, path, n_cells, chunk_frames=DEFAULT_CHUNK_FRAMES, compressed=True, queue_size=2):
+        for name in MATRICES:
+            if not os.path.isdir(os.path.join(path, name)):
+                os.makedirs(os.path.join(path, name))
+
+        self.path = path
+        self.n_cells = tuple(n_cells)
+        self.chunk_frames = chunk_frames
+        self.compressed = compressed
+
+        self.frames = 0
+        self.written_frames = 0
+        self.chunks = 0
+
+        self.__timestamps = open(os.path.join(path, TIMESTAMPS), 'wb')
+        self.__buffers = None
+        self.__buffer_timestamps = None
+        self.__buffered = 0
+        self.__new_buffers()
+
+        self.__error = None
+        self.__queue = Queue(maxsize=queue_size)
+        self.__thread = threading.Thread(target=self.__write_chunks)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __new_buffers(self):
+        shape = (self.chunk_frames,) + self.n_cells
+        self.__buffers = dict((name, numpy.empty(shape, dtype=MATRIX_DTYPE)) for name in MATRICES)
+        self.__buffer_timestamps = numpy.empty(self.chunk_frames, dtype=TIMESTAMP_DTYPE)
+        self.__buffered = 0
+
+    def __flush(self):
+        if self.__buffered == 0:
+            return
+
+        matrices = dict((name, buffer[:self.__buffered]) for name, buffer in self.__buffers.items())
+        self.__queue.put((matrices, self.__buffer_timestamps[:self.__buffered]))
+        self.__new_buffers()
+
+    def __write_chunks(self):
+        while True:
+            item = self.__queue.get()
+            if item is END:
+                return
+
+            if self.__error is not None:
+                continue
+
+            matrices, timestamps = item
+            try:
+                for name, matrix in matrices.items():
+                    output = chunk_path(self.path, name, self.chunks, self.compressed)
+                    if self.compressed:
+                        numpy.savez_compressed(output, data=matrix)
+                    else:
+                        numpy.save(output, matrix)
+
+                timestamps.tofile(self.__timestamps)
+                self.__timestamps.flush()
+
+                self.chunks += 1
+                self.written_frames += len(timestamps)
+                self.__write_meta()
+            except Exception as e:
+                self.__error = e
+
+    def __write_meta(self):
+        meta = {
+            'version': FORMAT_VERSION,
+            'frames': self.written_frames,
+            'n_cells': list(self.n_cells),
+            'chunk_frames': self.chunk_frames,
+            'compressed': self.compressed,
+        }
+
+        # replaced atomically, readers never see a partial file
+        temporary = os.path.join(self.path, META + '.tmp')
+        with open(temporary, 'w') as output:
+            json.dump(meta, output)
+
+        os.rename(temporary, os.path.join(self.path, META))
+
+    def __check(self):
+        if self.__error is not None:
+            raise self.__error
+
+    def write(self, occupation, density, timestamp=None):
+        self.__check()
+
+        index = self.__buffered
+        self.__buffers['occupation'][index] = densify(occupation)
+        self.__buffers['density'][index] = densify(density)
+        self.__buffer_timestamps[index] = time.time() if timestamp is None else timestamp
+
+        self.__buffered += 1
+        self.frames += 1
+        if self.__buffered == self.chunk_frames:
+            self.__flush()
+
+    def close(self):
+        if self.__thread is None:
+            return
+
+        self.__flush()
+        self.__queue.put(END)
+        self.__thread.join()
+        self.__thread = None
+        self.__timestamps.close()
+
+        if self.written_frames == 0 and self.__error is None:
+            self.__write_meta()
+
+        self.__check()
+
+class ChunkedMatrices(object):
+    """
+    A (frames, rows, columns) array stored as chunks. Indexing with up to
+    three integers or slices only reads the chunks of the selected frames:
+    .npy chunks are memory mapped, .npz chunks are decompressed (the last
+    one is kept).
+    """
+
+    def __init__(self, path, name, frames, n_cells, chunk_frames, compressed):
+        self.path = path
+        self.name = name
+        self.shape = (frames,) + tuple(n_cells)
+        self.chunk_frames = chunk_frames
+        self.compressed = compressed
+
+        self.__cached_chunk = None
+        self.__cached_data = None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def chunk(self, chunk):
+        if chunk == self.__cached_chunk:
+            return self.__cached_data
+
+        path = chunk_path(self.path, self.name, chunk, self.compressed)
+        if self.compressed:
+            with numpy.load(path) as archive:
+                data = archive['data']
+        else:
+            data = numpy.load(path, mmap_mode='r')
+
+        self.__cached_chunk = chunk
+        self.__cached_data = data
+        return data
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        frames, cells = key[0], key[1:]
+        if isinstance(frames, slice):
+            indices = numpy.arange(*frames.indices(self.shape[0]))
+        else:
+            if frames < 0:
+                frames += self.shape[0]
+            if not 0 <= frames < self.shape[0]:
+                raise IndexError('Frame %d out of range' % frames)
+            indices = numpy.array([frames])
+
+        # the indices are monotonic, so each chunk is a contiguous group
+        chunks = indices // self.chunk_frames
+        groups = numpy.split(numpy.arange(len(indices)), numpy.flatnonzero(numpy.diff(chunks)) + 1)
+
+        parts = []
+        for group in groups:
+            if len(group) == 0:
+                continue
+
+            chunk = chunks[group[0]]
+            offsets = indices[group] - chunk * self.chunk_frames
+            parts.append(self.chunk(chunk)[(offsets,) + cells])
+
+        if parts:
+            result = numpy.concatenate(parts)
+        else:
+            result = numpy.zeros((0,) + self.shape[1:])[(slice(None),) + cells]
+
+        return result if isinstance(frames, slice) else result[0]
+
+class DensityStore(object):
+    """
+    Reads a store written by DensityWriter, also while it is being written
+    (up to the frames of its last metadata). The timestamps are memory
+    mapped and occupation and density are ChunkedMatrices, so time and
+    cell slices of long runs are read without loading the whole history.
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, META)) as meta:
+            meta = json.load(meta)
+
+        if meta['version'] != FORMAT_VERSION:
+            raise ValueError('Unsupported store version %s' % meta['version'])
+
+        self.path = path
+        self.frames = meta['frames']
+        self.n_cells = tuple(meta['n_cells'])
+        self.chunk_frames = meta['chunk_frames']
+
+        if self.frames == 0:
+            self.timestamps = numpy.zeros(0, dtype=TIMESTAMP_DTYPE)
+        else:
+            self.timestamps = numpy.memmap(os.path.join(path, TIMESTAMPS), dtype=TIMESTAMP_DTYPE, mode='r',
+                shape=(self.frames,))
+
+        for name in MATRICES:
+            setattr(self, name, ChunkedMatrices(path, name, self.frames, self.n_cells, self.chunk_frames,
+                meta['compressed']))
+
+    def __len__(self):
+        return self.frames
+
+    def time_slice(self, start=None, end=None):
+        """
+        Returns the slice of the frames with start <= timestamp < end.
+        Timestamps must be increasing.
+        """
+        first = 0 if start is None else int(numpy.searchsorted(self.timestamps, start, side='left'))
+        last = self.frames if end is None else int(numpy.searchsorted(self.timestamps, end, side='left'))
+        return slice(first, last)
@@ -0,0 +1,250 @@
+from collections import namedtuple
+import argparse
+import socket
+import time
+
+from .device_gen import DeviceFrame
+
+# timestamps are seconds since the epoch, latency is measured against them
+Record = namedtuple('Record', ['timestamp', 'id', 'x', 'y', 'accuracy'])
+
+Alert = namedtuple('Alert', ['window_start', 'window_end', 'devices', 'cells', 'densities'])
+
+BatchStats = namedtuple('BatchStats', [
+    'batch', 'records', 'late_records', 'windows', 'alerts',
+    'processing_time', 'throughput', 'latency'
+])
+
+def parse_record(line):
+    timestamp, device_id, x, y, accuracy = line.strip().split(',')
+    return Record(float(timestamp), device_id, float(x), float(y), float(accuracy))
+
+def format_records(frame, timestamp):
+    return [
+        '%.6f,%s,%.6f,%.6f,%.6f' % (timestamp, frame.ids[i], frame.positions[i, 0],
+            frame.positions[i, 1], frame.accuracies[i])
+        for i in range(len(frame))
+    ]
+
+def print_alert(alert):
+    print('Window [%.2f, %.2f): %d devices, %d overcrowded cells %s' % (
+        alert.window_start, alert.window_end, alert.devices, len(alert.cells), alert.cells))
+
+def print_stats(stats):
+    print('Batch %d: %d records (%d late), %d windows, %d alerts, %.4f s, %.1f records/s, latency %.4f s' % stats)
+
+class OvercrowdingDetector(object):
+    """
+    Groups device position records into tumbling event time windows, computes
+    the occupation of each window with a GridManager (the latest record of
+    each device in the window is used) and sends the cells whose density
+    satisfies predicate to sink. A window is emitted once a record from a
+    later window has been seen; records arriving after their window was
+    emitted are dropped.
+    """
+
+    def __init__(self, grid_manager, predicate, window=1.0, sink=print_alert, stats_sink=print_stats):
+        self.grid_manager = grid_manager
+        self.predicate = predicate
+        self.window = window
+        self.sink = sink
+        self.stats_sink = stats_sink
+
+        self.pending = {}
+        self.watermark = None
+        self.batches = 0
+
+    def __window_index(self, timestamp):
+        return int(timestamp // self.window)
+
+    def process(self, records):
+        start_time = time.time()
+
+        late_records = 0
+        last_timestamp = None
+        for record in records:
+            index = self.__window_index(record.timestamp)
+            if self.watermark is not None and index < self.watermark:
+                late_records += 1
+                continue
+
+            self.pending.setdefault(index, {})[record.id] = record
+            last_timestamp = max(last_timestamp, record.timestamp) if last_timestamp is not None else record.timestamp
+
+        complete = []
+        if self.pending:
+            current = max(self.pending)
+            complete = sorted(index for index in self.pending if index < current)
+
+        alerts = sum(self.__emit(index) for index in complete)
+
+        processing_time = time.time() - start_time
+        n_records = len(records)
+        stats = BatchStats(
+            batch=self.batches,
+            records=n_records,
+            late_records=late_records,
+            windows=len(complete),
+            alerts=alerts,
+            processing_time=processing_time,
+            throughput=n_records / processing_time if processing_time > 0 else float('inf'),
+            latency=time.time() - last_timestamp if last_timestamp is not None else 0.0
+        )
+
+        self.batches += 1
+        if self.stats_sink is not None:
+            self.stats_sink(stats)
+
+        return stats
+
+    def flush(self):
+        return sum(self.__emit(index) for index in sorted(self.pending))
+
+    def __emit(self, index):
+        records = list(self.pending.pop(index).values())
+        self.watermark = index + 1
+
+        frame = DeviceFrame(
+            [record.id for record in records],
+            [(record.x, record.y) for record in records],
+            [record.accuracy for record in records]
+        )
+
+        self.grid_manager.update(frame)
+        cells = self.grid_manager.check_density(self.predicate)
+        if len(cells) == 0:
+            return 0
+
+        densities = self.grid_manager.density_matrix[cells[:, 0], cells[:, 1]]
+        cells = [tuple(cell) for cell in cells.tolist()]
+        self.sink(Alert(index * self.window, (index + 1) * self.window, len(frame), cells, densities))
+        return 1
+
+def file_source(path, batch_interval=1.0, follow=True):
+    """
+    Reads records from a text file, one micro-batch every batch_interval
+    seconds. With follow the file is tailed until the caller stops iterating.
+    """
+    buffered = ''
+    with open(path) as source:
+        while True:
+            deadline = time.time() + batch_interval
+            lines = (buffered + source.read()).split('\n')
+            buffered = lines.pop()
+            if not follow and buffered.strip():
+                lines.append(buffered)
+                buffered = ''
+
+            records = [parse_record(line) for line in lines if line.strip()]
+            if records:
+                yield records
+            elif not follow:
+                return
+
+            time.sleep(max(0.0, deadline - time.time()))
+
+def socket_source(host, port, batch_interval=1.0):
+    """
+    Reads records from a TCP socket, one micro-batch every batch_interval
+    seconds, until the connection is closed.
+    """
+    connection = socket.create_connection((host, port))
+    connection.settimeout(batch_interval)
+
+    buffered = ''
+    closed = False
+    try:
+        while not closed:
+            deadline = time.time() + batch_interval
+            while time.time() < deadline:
+                try:
+                    data = connection.recv(65536)
+                except socket.timeout:
+                    break
+
+                if not data:
+                    closed = True
+                    break
+
+                buffered += data.decode('utf-8')
+
+            lines = buffered.split('\n')
+            buffered = lines.pop()
+            yield [parse_record(line) for line in lines if line.strip()]
+    finally:
+        connection.close()
+
+def produce_records(devices_gen, path, frames, interval=1.0):
+    """
+    Appends the records of frames consecutive frames of devices_gen to path,
+    one frame every interval seconds, stamped with the current time.
+    """
+    for i in range(frames):
+        records = format_records(next(devices_gen), time.time())
+        with open(path, 'a') as output:
+            output.write('\n'.join(records) + '\n')
+
+        time.sleep(interval)
+
+def run_local(detector, batches):
+    for records in batches:
+        detector.process(records)
+
+    detector.flush()
+
+def run_spark(spark, detector, source, batch_interval=1.0):
+    """
+    Runs the detector on Spark Structured Streaming. source is either
+    'socket:host:port' or a directory path monitored for new text files.
+    Requires Spark 2.4+ (foreachBatch).
+    """
+    if source.startswith('socket:'):
+        _, host, port = source.split(':')
+        lines = spark.readStream.format('socket').option('host', host).option('port', int(port)).load()
+    else:
+        lines = spark.readStream.text(source)
+
+    def process_batch(batch, batch_id):
+        detector.process([parse_record(row.value) for row in batch.collect() if row.value.strip()])
+
+    query = lines.writeStream \
+        .foreachBatch(process_batch) \
+        .trigger(processingTime='%d milliseconds' % int(batch_interval * 1000)) \
+        .start()
+
+    query.awaitTermination()
+
+if __name__ == '__main__':
+    from .grid_manager import GridManager
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source", required=True, help="record file, socket:host:port or, with --spark, a directory")
+    parser.add_argument("--dimensions", type=float, nargs=2, default=(100, 100), help="grid dimensions")
+    parser.add_argument("--cells", type=int, nargs=2, default=(6, 6), help="number of cells")
+    parser.add_argument("--window", type=float, default=1.0, help="window length in seconds")
+    parser.add_argument("--batch-interval", type=float, default=1.0, help="micro-batch interval in seconds")
+    parser.add_argument("--threshold", type=float, default=0.2, help="overcrowding density (devices/m^2)")
+    parser.add_argument("--follow", action='store_true', help="keep reading the record file as it grows")
+    parser.add_argument("--spark", action='store_true', help="use Spark Structured Streaming")
+
+    args = parser.parse_args()
+
+    if args.spark:
+        from pyspark.sql import SparkSession
+
+        spark = SparkSession.builder.appName('OvercrowdingStream').getOrCreate()
+        g_manager = GridManager(spark_context=spark.sparkContext, dimensions=args.dimensions,
+            n_cells=args.cells, method='numpy')
+        detector = OvercrowdingDetector(g_manager, lambda density: density > args.threshold, args.window)
+        run_spark(spark, detector, args.source, args.batch_interval)
+    else:
+        g_manager = GridManager(dimensions=args.dimensions, n_cells=args.cells, method='numpy')
+        detector = OvercrowdingDetector(g_manager, lambda density: density > args.threshold, args.window)
+
+        if args.source.startswith('socket:'):
+            _, host, port = args.source.split(':')
+            batches = socket_source(host, int(port), args.batch_interval)
+        else:
+            batches = file_source(args.source, args.batch_interval, follow=args.follow)
+
+        run_local(detector, batches)
@@ -0,0 +1,84 @@
+import numpy
+
+class TemporalDensity(object):
+    """
+    Time aggregated views of the density matrices of consecutive frames: an
+    exponentially weighted moving average, the mean and maximum of the last
+    window frames and, for each cell, the number of consecutive frames its
+    density has been above threshold.
+
+    The last window matrices are kept in a ring buffer. The rolling mean is
+    a running sum and the rolling maximum combines the running maximum of
+    the current block of window frames with the suffix maxima of the
+    previous block (van Herk/Gil-Werman). Both are rebuilt from the ring
+    buffer once per block, so every frame costs a constant amount of work
+    per cell and memory does not grow with the number of frames.
+    """
+
+    def __init__(self, window=10, alpha=0.2, threshold=None):
+        if window < 1:
+            raise ValueError('The rolling window must contain at least one frame')
+
+        if not 0 < alpha <= 1:
+            raise ValueError('alpha must be in (0, 1]')
+
+        self.window = window
+        self.alpha = alpha
+        self.threshold = threshold
+        self.reset()
+
+    def reset(self):
+        self.frames = 0
+        self.ring = None
+        self.ewma = None
+        self.time_above = None
+
+        self.__sum = None
+        self.__prefix_max = None
+        self.__suffix_max = None
+
+    def update(self, density_matrix):
+        position = self.frames % self.window
+
+        if self.ring is None:
+            self.ring = numpy.zeros((self.window,) + density_matrix.shape)
+            self.ewma = density_matrix.copy()
+            self.time_above = numpy.zeros(density_matrix.shape, dtype=int)
+            self.__sum = numpy.zeros(density_matrix.shape)
+        else:
+            self.ewma *= 1 - self.alpha
+            self.ewma += self.alpha * density_matrix
+
+        self.__sum -= self.ring[position]
+        self.__sum += density_matrix
+        self.ring[position] = density_matrix
+
+        if position == 0:
+            self.__prefix_max = density_matrix.copy()
+        else:
+            numpy.maximum(self.__prefix_max, density_matrix, out=self.__prefix_max)
+
+        if self.threshold is not None:
+            above = density_matrix > self.threshold
+            self.time_above += above
+            self.time_above[~above] = 0
+
+        self.frames += 1
+
+        if position == self.window - 1:
+            # the block is complete: keep its suffix maxima for the next block
+            # and rebuild the sum to discard the floating point drift
+            self.__suffix_max = numpy.maximum.accumulate(self.ring[::-1], axis=0)[::-1]
+            self.__sum = self.ring.sum(axis=0)
+
+    @property
+    def rolling_mean(self):
+        return self.__sum / min(self.frames, self.window)
+
+    @property
+    def rolling_max(self):
+        position = (self.frames - 1) % self.window
+        if self.__suffix_max is None or position == self.window - 1:
+            return self.__prefix_max.copy()
+
+        return numpy.maximum(self.__prefix_max, self.__suffix_max[position + 1])
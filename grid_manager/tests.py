@@ -1,9 +1,62 @@
 import sparkunittest
 import unittest
-from device_gen import devices_generator, Device
-from grid_manager import GridManager
+from device_gen import devices_generator, Device, DeviceFrame
+from mobility import RandomWaypoint, RandomWalk
+from grid_manager import GridManager, GridLayout, Cell, cell_range
+from backends import TiledSparkBackend
+from overlap import disc_weights, gaussian_weights, corner_area, accumulate, erf, ACCURACY_SIGMAS, ACCURACY_CONFIDENCE
+from lut import OverlapTable
+from histogram import ConvolutionTable
+from incremental import match_ids
+from queries import evaluate, greater, between, top_k, label_regions
+from metrics import FrameStats
+from sparse import SparseMatrix
+from pyramid import level_cells, touching
+from temporal import TemporalDensity
+from recording import FrameRecorder, FrameReplay
+from store import DensityWriter, DensityStore
+from venue import redistribute
+from tiles import Tiling, tile_edges
+from pipeline import FramePipeline
+import shapely.geometry as geometry
+from streaming import OvercrowdingDetector, Record, parse_record, format_records
 import numpy
 import random
+import pickle
+import shutil
+import tempfile
+import time
+import math
+import warnings
+import cProfile
+import pstats
+
+def dataframe_support():
+    try:
+        import pandas
+        import pyarrow
+        from pyspark.sql import functions
+    except ImportError:
+        return False
+
+    return hasattr(functions, 'pandas_udf')
+
+def random_devices(n, dimensions=(40, 30), accuracy=(0.5, 5.0), origin=(0, 0), first_id=0, seed=1):
+    """
+    Seeded devices spread uniformly over the rectangle of the given
+    dimensions that starts at origin.
+    """
+    random_state = numpy.random.RandomState(seed)
+    positions = numpy.add(origin, random_state.uniform(0, 1, (n, 2)) * dimensions)
+    accuracies = random_state.uniform(accuracy[0], accuracy[1], n)
+    return [Device(str(first_id + i), tuple(positions[i]), accuracies[i]) for i in range(n)]
+
+def random_frames(n_frames, n, dimensions=(40, 30), accuracy=(0.5, 5.0), origin=(0, 0)):
+    # the same device ids in every frame
+    return [
+        DeviceFrame.from_devices(random_devices(n, dimensions, accuracy, origin, seed=t))
+        for t in range(n_frames)
+    ]
 
 class MockPositionGenerator():
 
@@ -43,6 +96,977 @@ class TestDeviceGenerator(unittest.TestCase):
             self.assertEquals(200, len(devices.keys()))
             self.assertEquals(200, len(device_ids))
 
+            self.assertEquals((200, 2), devices.positions.shape)
+            self.assertEquals((200,), devices.accuracies.shape)
+
+    def test_seed(self):
+        model = MockPositionGenerator(nr_nodes=10, dimensions=(128, 128))
+
+        first = next(devices_generator(model, accuracy=(20.0, 30.0), seed=1))
+        second = next(devices_generator(model, accuracy=(20.0, 30.0), seed=1))
+
+        self.assertTrue(numpy.array_equal(first.accuracies, second.accuracies))
+
+class TestMobility(unittest.TestCase):
+
+    def test_bounds(self):
+        for model in (RandomWaypoint(500, (100.0, 50.0), wt_max=5.0, seed=1),
+                RandomWalk(500, (100.0, 50.0), velocity=(1.0, 5.0), seed=1)):
+            model_iter = iter(model)
+            for i in range(50):
+                positions = next(model_iter)
+                self.assertEquals((500, 2), positions.shape)
+                self.assertTrue(numpy.all(positions >= 0.0))
+                self.assertTrue(numpy.all(positions <= (100.0, 50.0)))
+
+    def test_seed(self):
+        first = iter(RandomWaypoint(100, (100.0, 100.0), seed=1, chunk_size=30))
+        second = iter(RandomWaypoint(100, (100.0, 100.0), seed=1, chunk_size=30))
+
+        for i in range(10):
+            self.assertTrue(numpy.array_equal(next(first), next(second)))
+
+    def test_waypoint(self):
+        model = RandomWaypoint(1, (100.0, 100.0), velocity=(1.0, 1.0), wt_max=3.0, seed=1)
+        model.positions[:] = (10.0, 10.0)
+        model.waypoints[:] = (10.0, 12.5)
+
+        model_iter = iter(model)
+        self.assertTrue(numpy.allclose([[10.0, 11.0]], next(model_iter)))
+        self.assertTrue(numpy.allclose([[10.0, 12.0]], next(model_iter)))
+        self.assertTrue(numpy.allclose([[10.0, 12.5]], next(model_iter)))
+
+        # pauses at the waypoint before leaving towards the next one
+        self.assertTrue(0.0 <= model.wait[0] <= 3.0)
+        while model.wait[0] > 0:
+            self.assertTrue(numpy.allclose([[10.0, 12.5]], next(model_iter)))
+
+        self.assertAlmostEqual(1.0, numpy.hypot(*(next(model_iter)[0] - (10.0, 12.5))))
+
+    def test_frames_independent(self):
+        model_iter = iter(RandomWalk(10, (100.0, 100.0), seed=1))
+
+        first = next(model_iter)
+        copy = first.copy()
+        next(model_iter)
+
+        self.assertTrue(numpy.array_equal(copy, first))
+
+    def test_devices_generator(self):
+        devices_gen = devices_generator(RandomWaypoint(200, (128.0, 128.0), seed=1), accuracy=(20.0, 30.0))
+
+        devices = next(devices_gen)
+        self.assertEquals(200, len(devices))
+        self.assertEquals((200, 2), devices.positions.shape)
+
+class TestDeviceFrame(unittest.TestCase):
+
+    def test_frame(self):
+        devices = [
+            Device("0", (1.0, 1.0), 1.0),
+            Device("1", (3.0, 3.0), 2.0),
+            Device("2", (5.0, 5.0), 3.0),
+        ]
+
+        frame = DeviceFrame.from_devices(devices)
+
+        self.assertEquals(3, len(frame))
+        self.assertEquals(["0", "1", "2"], frame.keys())
+        self.assertTrue(numpy.array_equal([[1.0, 1.0], [3.0, 3.0], [5.0, 5.0]], frame.positions))
+        self.assertTrue(numpy.array_equal([1.0, 2.0, 3.0], frame.accuracies))
+
+        device = frame["1"]
+        self.assertEquals("1", device.id)
+        self.assertEquals((3.0, 3.0), tuple(device.position))
+        self.assertEquals(2.0, device.accuracy)
+
+        self.assertEquals(["0", "1", "2"], [device.id for device in frame.values()])
+        self.assertEquals(["2"], frame[2:].keys())
+
+        shards = frame.split(2)
+        self.assertEquals([2, 1], [len(shard) for shard in shards])
+
+class TestRecording(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_record_replay(self):
+        ids = numpy.array(['a', 'b', 'c'])
+        frames = [
+            DeviceFrame(ids, [[1.0, 2.0], [3.0, 4.0], [5.0, 6.0]], [0.5, 1.0, 1.5]),
+            DeviceFrame(ids, [[1.5, 2.5], [3.5, 4.5], [5.5, 6.5]], [0.5, 1.0, 1.5]),
+            DeviceFrame(['c', 'd'], [[7.0, 8.0], [9.0, 10.0]], [2.0, 2.5]),
+            DeviceFrame([], numpy.zeros((0, 2)), []),
+        ]
+
+        with FrameRecorder(self.path) as recorder:
+            for frame in frames:
+                recorder.write(frame)
+
+        replay = FrameReplay(self.path)
+        self.assertEquals(4, len(replay))
+        for frame, replayed in zip(frames, replay):
+            self.assertEquals(list(frame.ids), list(replayed.ids))
+            self.assertTrue(numpy.array_equal(frame.positions, replayed.positions))
+            self.assertTrue(numpy.array_equal(frame.accuracies, replayed.accuracies))
+
+        self.assertEquals(['c', 'd'], list(replay[-2].ids))
+        self.assertRaises(IndexError, replay.__getitem__, 4)
+
+        looped = iter(FrameReplay(self.path, loop=True))
+        self.assertEquals([3, 3, 2, 0, 3], [len(next(looped)) for i in range(5)])
+
+class TestDensityStore(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_store(self):
+        matrices = numpy.random.RandomState(1).poisson(1.0, (23, 4, 3)).astype(float)
+
+        for compressed in (True, False):
+            with DensityWriter(self.path, (4, 3), chunk_frames=5, compressed=compressed) as writer:
+                for index, matrix in enumerate(matrices):
+                    occupation = SparseMatrix.from_dense(matrix) if index % 2 else matrix
+                    writer.write(occupation, matrix / 2.0, 100.0 + index)
+
+            store = DensityStore(self.path)
+            self.assertEquals(23, len(store))
+            self.assertEquals((23, 4, 3), store.occupation.shape)
+            self.assertTrue(numpy.array_equal(100.0 + numpy.arange(23), store.timestamps))
+
+            self.assertTrue(numpy.array_equal(matrices, store.occupation[:]))
+            self.assertTrue(numpy.array_equal(matrices[-1], store.occupation[-1]))
+            self.assertTrue(numpy.array_equal(matrices[3:19:4, 1:3, 2], store.occupation[3:19:4, 1:3, 2]))
+            self.assertTrue(numpy.array_equal(matrices[::-3] / 2.0, store.density[::-3]))
+            self.assertEquals((0, 4, 3), store.density[7:7].shape)
+            self.assertRaises(IndexError, lambda: store.density[23])
+
+            self.assertEquals(slice(4, 11), store.time_slice(103.5, 111.0))
+            self.assertEquals(slice(0, 23), store.time_slice())
+
+    def test_partial(self):
+        writer = DensityWriter(self.path, (2, 2), chunk_frames=4)
+        for index in range(6):
+            writer.write(numpy.ones((2, 2)) * index, numpy.ones((2, 2)))
+
+        # only the complete chunks are visible while writing
+        for i in range(100):
+            if writer.written_frames == 4:
+                break
+            time.sleep(0.01)
+        self.assertEquals(4, len(DensityStore(self.path)))
+
+        writer.close()
+        self.assertEquals([0.0, 5.0], list(DensityStore(self.path).occupation[::5, 0, 0]))
+
+    def test_empty(self):
+        DensityWriter(self.path, (2, 2)).close()
+
+        store = DensityStore(self.path)
+        self.assertEquals(0, len(store))
+        self.assertEquals((0, 2, 2), store.occupation[:].shape)
+
+class TestOverlap(unittest.TestCase):
+
+    def test_corner_area(self):
+        self.assertTrue(numpy.isclose(numpy.pi / 4, corner_area(1.0, 1.0, 1.0)))
+        self.assertTrue(numpy.isclose(-numpy.pi / 4, corner_area(-2.0, 2.0, 1.0)))
+        self.assertTrue(numpy.isclose(0.25, corner_area(0.5, 0.5, 1.0)))
+        self.assertEquals(0.0, corner_area(1.0, 1.0, 0.0))
+
+    def test_disc_weights(self):
+        positions = numpy.array([[2.0, 2.0], [5.5, 5.5], [3.0, 3.0], [20.0, 20.0]])
+        accuracies = numpy.array([1.0, 0.25, 0.0, 1.0])
+
+        devices, cells, weights = disc_weights(positions, accuracies, (1.0, 1.0), (8, 8))
+
+        self.assertEquals([0, 0, 0, 0, 1, 2], sorted(devices))
+        self.assertTrue(numpy.allclose([0.25] * 4, weights[devices == 0]))
+        self.assertEquals([5 * 8 + 5], list(cells[devices == 1]))
+        self.assertEquals([3 * 8 + 3], list(cells[devices == 2]))
+
+    def test_shapely_parity(self):
+        devices = [
+            Device("0", (3.5, 4.2), 1.5),
+            Device("1", (2.5, 2.5), 0.0),
+            Device("2", (20.0, 12.0), 0.0),
+            Device("3", (8.0, 15.0), 0.0),
+            Device("4", (-1.0, 5.0), 0.0),
+            Device("5", (-2.0, -2.0), 5.0),
+            Device("6", (19.0, 1.0), 2.0),
+            Device("7", (40.0, 40.0), 1.0),
+        ]
+
+        shapely_manager = GridManager(dimensions=(20, 12), n_cells=(5, 4))
+        numpy_manager = GridManager(dimensions=(20, 12), n_cells=(5, 4), method='numpy')
+        shapely_manager.update(devices)
+        numpy_manager.update(devices)
+
+        self.assertTrue(numpy.isclose(5, numpy_manager.occupation_matrix.sum()))
+        self.assertEquals(1.0, shapely_manager.occupation_matrix[4, 3])
+        self.assertTrue(numpy.allclose(shapely_manager.occupation_matrix, numpy_manager.occupation_matrix, atol=1e-2))
+
+    def test_erf(self):
+        x = numpy.linspace(-5.0, 5.0, 201)
+        self.assertTrue(numpy.allclose([math.erf(v) for v in x], erf(x), atol=1.5e-7))
+
+    def test_accuracy_sigmas(self):
+        # the accuracy circle holds ACCURACY_CONFIDENCE of the gaussian
+        self.assertTrue(numpy.isclose(ACCURACY_CONFIDENCE, 1.0 - numpy.exp(-ACCURACY_SIGMAS ** 2 / 2)))
+
+    def test_gaussian_weights(self):
+        positions = numpy.array([[4.5, 4.5], [0.5, 4.5], [3.0, 3.0], [40.0, 40.0]])
+        accuracies = numpy.array([1.0, 1.0, 0.0, 1.0])
+
+        devices, cells, weights = gaussian_weights(positions, accuracies, (1.0, 1.0), (8, 8))
+        self.assertEquals([0, 1, 2], sorted(set(devices)))
+        self.assertTrue(numpy.allclose([1.0, 1.0, 1.0], numpy.bincount(devices, weights)))
+        self.assertEquals([3 * 8 + 3], list(cells[devices == 2]))
+
+        # separable and symmetric around the centre cell
+        matrix = accumulate(cells[devices == 0], weights[devices == 0], (8, 8))
+        self.assertTrue(numpy.allclose(matrix, matrix.T))
+        self.assertTrue(numpy.allclose(matrix[1:, 1:], matrix[:0:-1, :0:-1]))
+        self.assertTrue(numpy.isclose(matrix[4, 4], matrix[4, :].sum() * matrix[:, 4].sum()))
+
+        sigma = 1.0 / ACCURACY_SIGMAS
+        centre = math.erf(0.5 / (sigma * math.sqrt(2))) / math.erf(3.0 / math.sqrt(2))
+        self.assertTrue(numpy.isclose(centre ** 2, matrix[4, 4], atol=1e-6))
+
+        # the mass outside the grid is redistributed among the common cells
+        border = accumulate(cells[devices == 1], weights[devices == 1], (8, 8))
+        rows = matrix.sum(axis=1)
+        self.assertTrue(numpy.allclose(rows[4:] / rows[4:].sum(), border.sum(axis=1)[:4]))
+        self.assertTrue(numpy.allclose(matrix.sum(axis=0), border.sum(axis=0)))
+
+class TestOverlapTable(unittest.TestCase):
+
+    def test_stencil_weights(self):
+        table = OverlapTable((1.0, 1.0), 3.0, 0.05)
+
+        positions = numpy.array([[10.0, 10.0], [6.3, 12.7], [9.21, 8.05], [11.5, 11.5]])
+        accuracies = numpy.array([2.0, 0.7, 2.95, 0.0])
+        self.assertTrue(table.interior(positions, accuracies, (20, 20)).all())
+
+        _, cells, weights = table.stencil_weights(positions, accuracies, (20, 20))
+        _, exact_cells, exact_weights = disc_weights(positions, accuracies, (1.0, 1.0), (20, 20))
+
+        lut_matrix = accumulate(cells, weights, (20, 20))
+        exact_matrix = accumulate(exact_cells, exact_weights, (20, 20))
+        self.assertTrue(numpy.isclose(len(positions), lut_matrix.sum()))
+        self.assertTrue(numpy.allclose(exact_matrix, lut_matrix, atol=0.1))
+
+    def test_interior(self):
+        table = OverlapTable((1.0, 1.0), 3.0, 0.1)
+
+        positions = numpy.array([[10.0, 10.0], [1.0, 10.0], [10.0, 19.8], [10.0, 10.0]])
+        accuracies = numpy.array([2.0, 2.0, 0.2, 4.0])
+        self.assertEquals([True, False, False, False], list(table.interior(positions, accuracies, (20, 20))))
+
+    def test_table_size(self):
+        self.assertRaises(ValueError, OverlapTable, (1.0, 1.0), 100.0, 0.001)
+
+        # large cells get coarser offset bins, with a warning, instead of
+        # exceeding the limit
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            table = OverlapTable((100 / 6.0, 100 / 6.0), 3.0, 0.1)
+
+        self.assertEquals(1, len(caught))
+        self.assertTrue(table.weights.nbytes <= 64 * 1024 * 1024)
+        self.assertTrue(min(table.offset_step) > 0.1)
+        self.assertTrue(table.margin > 0.1)
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            small = OverlapTable((1.0, 1.0), 3.0, 0.1)
+
+        self.assertEquals([], caught)
+        self.assertEquals((10, 10), small.offset_bins)
+        self.assertEquals(0.1, small.margin)
+        self.assertTrue(table.error_bound([2.0]) > small.error_bound([2.0]))
+
+    def test_error_bound(self):
+        table = OverlapTable((1.0, 1.0), 3.0, 0.1)
+
+        random_state = numpy.random.RandomState(1)
+        positions = random_state.uniform(4.0, 16.0, (200, 2))
+        accuracies = random_state.uniform(0.0, 3.0, 200)
+
+        _, cells, weights = table.stencil_weights(positions, accuracies, (20, 20))
+        _, exact_cells, exact_weights = disc_weights(positions, accuracies, (1.0, 1.0), (20, 20))
+
+        error = numpy.abs(accumulate(cells, weights, (20, 20)) - accumulate(exact_cells, exact_weights, (20, 20)))
+        self.assertTrue(error.sum() <= table.error_bound(accuracies))
+
+    def test_lut_method(self):
+        devices = random_devices(200, accuracy=(0.0, 5.0))
+        devices.append(Device("200", (-2.0, -2.0), 5.0))
+
+        numpy_manager = GridManager(dimensions=(40, 30), n_cells=(16, 12), method='numpy')
+        lut_manager = GridManager(dimensions=(40, 30), n_cells=(16, 12), method='lut', lut_quantization=0.05)
+
+        numpy_manager.update(devices)
+        lut_manager.update(devices)
+
+        self.assertTrue(numpy.isclose(len(devices), lut_manager.occupation_matrix.sum()))
+        self.assertTrue(numpy.allclose(numpy_manager.occupation_matrix, lut_manager.occupation_matrix, atol=0.5))
+
+    def test_gaussian_method(self):
+        devices = random_devices(200, accuracy=(0.0, 5.0))
+        devices.append(Device("200", (-2.0, -2.0), 5.0))
+        devices.append(Device("201", (-50.0, -50.0), 5.0))
+
+        gaussian_manager = GridManager(dimensions=(40, 30), n_cells=(16, 12), method='gaussian')
+        gaussian_manager.update(devices)
+
+        # the truncated gaussian of each device with math.erf, normalized
+        # over the cells of the grid
+        expected = numpy.zeros((16, 12))
+        for device in devices:
+            if device.accuracy == 0:
+                expected[int(device.position[0] // 2.5), int(device.position[1] // 2.5)] += 1
+                continue
+
+            sigma = device.accuracy / ACCURACY_SIGMAS
+            axes = []
+            for centre, n in zip(device.position, (16, 12)):
+                low = min(max(centre - 3 * sigma, 0.0), n * 2.5)
+                high = min(max(centre + 3 * sigma, low), n * 2.5)
+                edges = [min(max(i * 2.5, low), high) for i in range(n + 1)]
+                cdf = [math.erf((edge - centre) / (sigma * math.sqrt(2))) for edge in edges]
+                axes.append(numpy.diff(cdf))
+
+            if axes[0].sum() * axes[1].sum() > 0:
+                expected += numpy.outer(axes[0], axes[1]) / (axes[0].sum() * axes[1].sum())
+
+        self.assertTrue(numpy.isclose(201, gaussian_manager.occupation_matrix.sum()))
+        self.assertTrue(numpy.allclose(expected, gaussian_manager.occupation_matrix, rtol=0, atol=1e-5))
+
+class TestConvolutionTable(unittest.TestCase):
+
+    def test_exact_position(self):
+        table = ConvolutionTable((20, 20), (1.0, 1.0), 4, 0.5)
+
+        # devices at sub-cell centres with a radius of the table are not moved
+        positions = numpy.array([[10.125, 10.125], [6.375, 12.625], [8.875, 9.125]])
+        accuracies = numpy.array([2.0, 1.5, 0.0])
+        self.assertTrue(table.interior(positions, accuracies, (20, 20)).all())
+
+        _, cells, weights = disc_weights(positions, accuracies, (1.0, 1.0), (20, 20))
+        self.assertTrue(numpy.allclose(accumulate(cells, weights, (20, 20)), table.convolve(positions, accuracies)))
+
+    def test_error_bound(self):
+        table = ConvolutionTable((16, 12), (2.5, 2.5), 4, 0.5)
+
+        positions = numpy.random.RandomState(1).uniform(0, 30, (500, 2))
+        accuracies = numpy.random.RandomState(2).uniform(0, 6, 500)
+        interior = table.interior(positions, accuracies, (40, 30))
+
+        _, cells, weights = disc_weights(positions[interior], accuracies[interior], (2.5, 2.5), (16, 12))
+        exact = accumulate(cells, weights, (16, 12))
+        approximate = table.convolve(positions[interior], accuracies[interior])
+
+        self.assertTrue(numpy.isclose(interior.sum(), approximate.sum()))
+        self.assertTrue(numpy.abs(exact - approximate).sum() <= table.error_bound(accuracies[interior]))
+        self.assertEquals(0.0, table.error_bound([0.0, 0.0]))
+
+    def test_window(self):
+        table = ConvolutionTable((32, 32), (1.0, 1.0), 4, 0.5)
+
+        random_state = numpy.random.RandomState(1)
+        positions = random_state.uniform(8.0, 16.0, (100, 2))
+        accuracies = random_state.uniform(0.0, 3.0, 100)
+
+        # a window that reaches past the grid, larger than the reach of the
+        # devices around the cells 8 to 16
+        full = table.convolve(positions, accuracies)
+        window = table.convolve(positions, accuracies, (-4, 4, 28, 16))
+
+        self.assertEquals((28, 16), window.shape)
+        self.assertTrue(numpy.allclose(full[8:16, 8:16], window[12:20, 4:12]))
+
+    def test_histogram_method(self):
+        devices = random_devices(200, accuracy=(0.0, 5.0))
+        devices.append(Device("200", (-2.0, -2.0), 5.0))
+
+        numpy_manager = GridManager(dimensions=(40, 30), n_cells=(16, 12), method='numpy')
+        histogram_manager = GridManager(dimensions=(40, 30), n_cells=(16, 12), method='histogram', sparse=True)
+
+        numpy_manager.update(devices)
+        histogram_manager.update(devices)
+
+        # the devices close to the borders are exact
+        frame = DeviceFrame.from_devices(devices)
+        table = histogram_manager.layout.table
+        interior = table.interior(frame.positions, frame.accuracies, (40, 30))
+        self.assertTrue(interior.any() and not interior.all())
+
+        error = numpy.abs(numpy_manager.occupation_matrix - histogram_manager.occupation_matrix).sum()
+        self.assertTrue(numpy.isclose(len(devices), histogram_manager.occupation_matrix.sum()))
+        self.assertTrue(error <= table.error_bound(frame.accuracies[interior]))
+
+    def test_venue(self):
+        self.assertRaises(ValueError, GridManager, dimensions=(40, 30), method='histogram',
+            venue=geometry.box(0, 0, 40, 30))
+
+class TestGridLayout(unittest.TestCase):
+
+    def test_box(self):
+        layout = GridLayout((4, 8), (2.5, 1.5))
+
+        for i in range(4):
+            for j in range(8):
+                cell = Cell((i * 2.5, j * 1.5), (2.5, 1.5))
+                self.assertEquals(cell.box.bounds, layout.box(i, j).bounds)
+
+    def test_cell_range(self):
+        rows, columns = cell_range((1.5, 0.5, 3.5, 2.5), (1.0, 1.0), (4, 8))
+        self.assertEquals([1, 2, 3], list(rows))
+        self.assertEquals([0, 1, 2], list(columns))
+
+        rows, columns = cell_range((-3.0, 6.0, 10.0, 12.0), (1.0, 1.0), (4, 8))
+        self.assertEquals([0, 1, 2, 3], list(rows))
+        self.assertEquals([6, 7], list(columns))
+
+        rows, columns = cell_range((-3.0, -3.0, -1.0, -1.0), (1.0, 1.0), (4, 8))
+        self.assertEquals([], list(rows))
+        self.assertEquals([], list(columns))
+
+class TestGrid(unittest.TestCase):
+
+    def test_cells_on_demand(self):
+        # cells are not created upfront, so large grids are cheap to build
+        grid_manager = GridManager(dimensions=(4096, 4096), n_cells=(4096, 4096), method='numpy', sparse=True)
+        self.assertEquals(0, len(grid_manager.cells))
+        self.assertEquals((4095.0, 0.0, 4096.0, 1.0), grid_manager[-1, 0].box.bounds)
+        self.assertRaises(IndexError, lambda: grid_manager[4096, 0])
+
+        cell = Cell((0.0, 0.0), (1.0, 1.0))
+        grid_manager[1, 2] = cell
+        self.assertTrue(grid_manager[1, 2] is cell)
+
+    def test_unknown_method(self):
+        self.assertRaises(ValueError, GridManager, dimensions=(8, 8), method='unknown')
+
+class TestIncremental(unittest.TestCase):
+
+    def test_match_ids(self):
+        previous_common, common, removed, added = match_ids(numpy.array(["0", "1", "2"]), numpy.array(["3", "2", "0"]))
+
+        self.assertEquals([2, 0], list(previous_common))
+        self.assertEquals([1, 2], list(common))
+        self.assertEquals([1], list(removed))
+        self.assertEquals([0], list(added))
+
+    def test_incremental_update(self):
+        random_state = numpy.random.RandomState(1)
+        positions = random_state.uniform(0, 30, (50, 2))
+        accuracies = random_state.uniform(0.5, 3.0, 50)
+        ids = numpy.array([str(i) for i in range(50)])
+
+        for method in ['shapely', 'numpy']:
+            full_manager = GridManager(dimensions=(30, 30), n_cells=(10, 10), method=method)
+            incremental_manager = GridManager(dimensions=(30, 30), n_cells=(10, 10), method=method,
+                incremental=True, refresh_interval=3)
+
+            frame_positions = positions.copy()
+            for i in range(6):
+                frame_positions[:5] += 1.0
+                frame = DeviceFrame(ids, frame_positions, accuracies)
+
+                full_manager.update(frame)
+                incremental_manager.update(frame)
+
+                self.assertTrue(numpy.allclose(full_manager.occupation_matrix, incremental_manager.occupation_matrix))
+
+            self.assertEquals(10, incremental_manager.incremental.changes)
+
+            frame = DeviceFrame(ids[10:], frame_positions[10:], accuracies[10:])
+            full_manager.update(frame)
+            incremental_manager.update(frame)
+
+            self.assertTrue(numpy.allclose(full_manager.occupation_matrix, incremental_manager.occupation_matrix))
+            self.assertTrue(numpy.isclose(40, incremental_manager.occupation_matrix.sum()))
+
+    def test_empty_frame(self):
+        for method in ['shapely', 'numpy']:
+            grid_manager = GridManager(dimensions=(8, 8), n_cells=(8, 8), method=method, incremental=True)
+
+            grid_manager.update(DeviceFrame([], [], []))
+            self.assertEquals(0, grid_manager.occupation_matrix.sum())
+
+            grid_manager.update([Device("0", (3.0, 3.0), 1.0)])
+            self.assertTrue(numpy.isclose(1, grid_manager.occupation_matrix.sum()))
+
+    def test_epsilon(self):
+        devices = [Device("0", (3.0, 3.0), 1.0)]
+        moved_devices = [Device("0", (3.1, 3.0), 1.0)]
+
+        grid_manager = GridManager(dimensions=(8, 8), n_cells=(8, 8), method='numpy', incremental=True, epsilon=0.5)
+
+        grid_manager.update(devices)
+        expected_matrix = grid_manager.occupation_matrix
+
+        grid_manager.update(moved_devices)
+        self.assertEquals(0, grid_manager.incremental.changes)
+        self.assertTrue(numpy.array_equal(expected_matrix, grid_manager.occupation_matrix))
+
+class TestStreaming(unittest.TestCase):
+
+    def test_records(self):
+        frame = DeviceFrame(["0", "1"], [(1.0, 2.0), (3.0, 4.0)], [1.0, 2.0])
+        records = [parse_record(line) for line in format_records(frame, 10.0)]
+
+        self.assertEquals([Record(10.0, "0", 1.0, 2.0, 1.0), Record(10.0, "1", 3.0, 4.0, 2.0)], records)
+
+    def test_detector(self):
+        grid_manager = GridManager(dimensions=(8, 8), n_cells=(4, 4), method='numpy')
+        alerts = []
+        stats = []
+        detector = OvercrowdingDetector(grid_manager, lambda x: x > 0.3, window=1.0,
+            sink=alerts.append, stats_sink=stats.append)
+
+        detector.process([
+            Record(10.1, "0", 3.0, 3.0, 1.0),
+            Record(10.2, "1", 3.0, 3.0, 1.0),
+            Record(10.5, "0", 3.0, 3.0, 1.0),
+        ])
+        self.assertEquals([], alerts)
+
+        detector.process([Record(11.2, "0", 7.0, 7.0, 1.0)])
+        detector.process([Record(10.9, "2", 3.0, 3.0, 1.0)])
+
+        self.assertEquals(1, len(alerts))
+        self.assertEquals((10.0, 11.0), (alerts[0].window_start, alerts[0].window_end))
+        self.assertEquals(2, alerts[0].devices)
+        self.assertEquals([(1, 1)], alerts[0].cells)
+        self.assertEquals([0, 0, 1], [s.late_records for s in stats])
+
+        self.assertEquals(0, detector.flush())
+
+class TestQueries(unittest.TestCase):
+
+    def test_evaluate(self):
+        matrix = numpy.array([[0.1, 0.5], [0.3, numpy.nan]])
+
+        self.assertTrue(numpy.array_equal([[False, True], [False, False]], evaluate(greater(0.3), matrix)))
+        self.assertTrue(numpy.array_equal([[False, False], [True, False]], evaluate(between(0.2, 0.5), matrix)))
+        self.assertTrue(numpy.array_equal([[False, False], [False, True]], evaluate(numpy.isnan, matrix)))
+        self.assertTrue(numpy.array_equal([[True, False], [False, False]], evaluate(lambda x: x < 0.2 if x else False, matrix)))
+
+    def test_top_k(self):
+        matrix = numpy.array([[0.1, 0.5, 0.2], [0.3, 0.0, 0.4]])
+
+        cells, values = top_k(matrix, 3)
+
+        self.assertTrue(numpy.array_equal([[0, 1], [1, 2], [1, 0]], cells))
+        self.assertTrue(numpy.allclose([0.5, 0.4, 0.3], values))
+        self.assertEquals(6, len(top_k(matrix, 10)[0]))
+
+    def test_label_regions(self):
+        mask = numpy.array([
+            [True, True, False, False],
+            [False, False, False, True],
+            [False, False, True, True],
+            [True, False, False, False],
+        ])
+
+        labels, n_regions = label_regions(mask)
+        self.assertEquals(3, n_regions)
+        self.assertEquals(labels[0, 0], labels[0, 1])
+        self.assertEquals(labels[1, 3], labels[2, 2])
+        self.assertEquals(0, labels[1, 0])
+
+        labels, n_regions = label_regions(mask, connectivity=8)
+        self.assertEquals(3, n_regions)
+
+    def test_hotspots(self):
+        grid_manager = GridManager(dimensions=(8, 8), n_cells=(8, 8), method='numpy')
+
+        grid_manager.update([
+            Device("0", (1.0, 1.0), 1.0),
+            Device("1", (1.5, 1.5), 0.25),
+            Device("2", (6.0, 6.0), 1.0),
+        ])
+
+        regions = grid_manager.hotspots(greater(0.2))
+
+        self.assertEquals(2, len(regions))
+        self.assertTrue(numpy.isclose(2.0, regions[0].occupation))
+        self.assertTrue(numpy.isclose(1.25, regions[0].max_density))
+        self.assertEquals(4, len(regions[0].cells))
+        self.assertTrue(numpy.isclose(1.0, regions[1].occupation))
+
+        cells, values = grid_manager.most_crowded(1)
+        self.assertTrue(numpy.array_equal([[1, 1]], cells))
+
+class TestMetrics(unittest.TestCase):
+
+    def test_frame_stats(self):
+        stats = FrameStats()
+        stats.add_time('compute', 1.0)
+        stats.count('devices', 10)
+
+        other = FrameStats()
+        other.add_time('compute', 0.5)
+        other.count('devices', 5)
+
+        stats.merge(other)
+
+        self.assertEquals(1.5, stats.times['compute'])
+        self.assertEquals(15, stats.counters['devices'])
+        self.assertEquals(1.5, stats.as_dict()['time_compute'])
+        self.assertEquals(0, stats.as_dict()['shard_bytes'])
+
+    def test_update_stats(self):
+        devices = random_devices(20)
+
+        grid_manager = GridManager(dimensions=(40, 30), n_cells=(8, 6))
+        grid_manager.update(devices)
+        self.assertEquals(None, grid_manager.stats)
+
+        for backend in ['local', 'process']:
+            with GridManager(dimensions=(40, 30), n_cells=(8, 6), backend=backend, metrics=True) as grid_manager:
+                grid_manager.update(devices)
+
+            self.assertEquals(20, grid_manager.stats.counters['devices'])
+            self.assertTrue(grid_manager.stats.counters['candidate_cells'] >= 20)
+            self.assertTrue(grid_manager.stats.times['intersection'] > 0)
+
+    def test_profiler(self):
+        profiler = cProfile.Profile()
+        grid_manager = GridManager(dimensions=(8, 8), n_cells=(4, 4), profiler=profiler)
+        grid_manager.update([Device("0", (3.0, 3.0), 1.0)])
+
+        functions = [function for _, _, function in pstats.Stats(profiler).stats]
+        self.assertTrue('device_weights' in functions)
+
+class TestBackends(unittest.TestCase):
+
+    def test_local_process_backends(self):
+        devices = random_devices(100)
+
+        for method in ['shapely', 'numpy']:
+            with GridManager(dimensions=(40, 30), n_cells=(8, 6), method=method, backend='local') as local_manager:
+                local_manager.update(devices)
+
+            with GridManager(dimensions=(40, 30), n_cells=(8, 6), method=method, backend='process') as process_manager:
+                process_manager.update(devices)
+                process_manager.update(devices)
+
+            self.assertTrue(numpy.isclose(len(devices), local_manager.occupation_matrix.sum()))
+            self.assertTrue(numpy.allclose(local_manager.occupation_matrix, process_manager.occupation_matrix))
+            self.assertTrue(numpy.allclose(local_manager.density_matrix, process_manager.density_matrix))
+
+    def test_frame_update(self):
+        devices = random_devices(20)
+
+        for method in ['shapely', 'numpy']:
+            grid_manager = GridManager(dimensions=(40, 30), n_cells=(8, 6), method=method)
+
+            grid_manager.update(devices)
+            expected_matrix = grid_manager.occupation_matrix
+
+            grid_manager.update(DeviceFrame.from_devices(devices))
+            self.assertTrue(numpy.allclose(expected_matrix, grid_manager.occupation_matrix))
+
+    def test_update_many(self):
+        frames = random_frames(5, 30, accuracy=(0.0, 5.0))
+
+        for backend in ['local', 'process']:
+            with GridManager(dimensions=(40, 30), n_cells=(8, 6), method='numpy', backend=backend,
+                    sparse=True) as grid_manager:
+                tensor = grid_manager.update_many(frames)
+
+            self.assertEquals((5, 8, 6), tensor.shape)
+            for frame, matrix in zip(frames, tensor):
+                grid_manager.update(frame)
+                self.assertTrue(numpy.allclose(grid_manager.occupation_matrix, matrix))
+
+        grid_manager = GridManager(dimensions=(40, 30), n_cells=(8, 6), incremental=True)
+        self.assertRaises(ValueError, grid_manager.update_many, frames)
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, GridManager, dimensions=(8, 8), backend='unknown')
+        self.assertRaises(ValueError, GridManager, dimensions=(8, 8), backend='spark')
+
+class TestSparse(unittest.TestCase):
+
+    def test_sparse_matrix(self):
+        matrix = SparseMatrix.from_cells([5, 1, 5, 7], [1.0, 2.0, 0.5, 1.0], (2, 4))
+        self.assertEquals([1, 5, 7], list(matrix.cells))
+        self.assertEquals([2.0, 1.5, 1.0], list(matrix.values))
+        self.assertEquals([[0, 1], [1, 1], [1, 3]], matrix.coordinates.tolist())
+
+        other = SparseMatrix.from_dense(numpy.array([[0.0, 1.0, 0.0, 0.0], [0.0, 0.0, 3.0, 0.0]]))
+        self.assertEquals([1, 6], list(other.cells))
+
+        expected = numpy.array([[0.0, 3.0, 0.0, 0.0], [0.0, 1.5, 3.0, 1.0]])
+        self.assertTrue(numpy.allclose(expected, (matrix + other).toarray()))
+        self.assertTrue(numpy.allclose(expected / 2, ((matrix + other) / 2).toarray()))
+        self.assertTrue(numpy.allclose(matrix.toarray(), (matrix + other - other).toarray()))
+        self.assertTrue(numpy.isclose(8.5, (matrix + other).sum()))
+
+        copy = pickle.loads(pickle.dumps(matrix))
+        self.assertTrue(numpy.allclose(matrix.toarray(), copy.toarray()))
+
+    def test_sparse_update(self):
+        devices = random_devices(50, accuracy=(0.0, 5.0))
+        devices.append(Device("50", (-2.0, -2.0), 5.0))
+
+        for method in ['shapely', 'numpy', 'lut']:
+            for backend in ['local', 'process']:
+                dense_manager = GridManager(dimensions=(40, 30), n_cells=(80, 60), method=method)
+                with GridManager(dimensions=(40, 30), n_cells=(80, 60), method=method, backend=backend,
+                        incremental=True, sparse=True) as sparse_manager:
+                    dense_manager.update(devices)
+                    sparse_manager.update(devices)
+                    sparse_manager.update(devices[1:])
+                    sparse_manager.update(devices)
+
+                self.assertTrue(isinstance(sparse_manager.occupation, SparseMatrix))
+                self.assertTrue(sparse_manager.occupation.nnz < 80 * 60)
+                self.assertTrue(numpy.allclose(dense_manager.occupation_matrix, sparse_manager.occupation_matrix))
+                self.assertTrue(numpy.allclose(dense_manager.density_matrix, sparse_manager.density_matrix))
+
+                threshold = dense_manager.density_matrix.max() / 2
+                for f in [lambda density: density > threshold, lambda density: density < threshold]:
+                    self.assertEquals(sorted(dense_manager.check_density(f).tolist()),
+                        sorted(sparse_manager.check_density(f).tolist()))
+
+class TestPyramid(unittest.TestCase):
+
+    def test_level_cells(self):
+        self.assertEquals([(2, 3), (4, 6), (8, 12)], level_cells((8, 12), 3))
+        self.assertRaises(ValueError, level_cells, (8, 10), 3)
+
+    def test_touching(self):
+        mask = numpy.zeros((4, 4), dtype=bool)
+        mask[1, 2] = True
+
+        positions = numpy.array([[1.5, 2.5], [0.5, 0.5], [0.5, 0.5], [3.5, 1.5]])
+        accuracies = numpy.array([0.1, 0.4, 1.6, 0.5])
+        self.assertEquals([0, 2], list(touching(positions, accuracies, mask, (1.0, 1.0))))
+
+    def test_multi_resolution(self):
+        devices = random_devices(100, (10, 10), accuracy=(0.0, 2.0))
+        devices += random_devices(5, (10, 10), accuracy=(0.0, 2.0), origin=(30, 20), first_id=100)
+
+        full_manager = GridManager(dimensions=(40, 32), n_cells=(32, 32), method='numpy')
+        multi_manager = GridManager(dimensions=(40, 32), n_cells=(32, 32), method='numpy', levels=3,
+            refine_density=0.1)
+
+        full_manager.update(devices)
+        multi_manager.update(devices)
+
+        self.assertEquals([(8, 8), (16, 16), (32, 32)], [matrix.shape for matrix in multi_manager.density_pyramid])
+        for density, refined in zip(multi_manager.density_pyramid, multi_manager.refined_cells):
+            self.assertTrue(numpy.isclose(len(devices), density.sum() * (40 * 32) / density.size))
+            self.assertTrue(refined.any())
+
+        refined = multi_manager.refined_cells[-1]
+        self.assertFalse(refined.all())
+        self.assertTrue(numpy.allclose(full_manager.occupation_matrix[refined], multi_manager.occupation_matrix[refined]))
+
+        # the gaussian kernel reaches further than the accuracy circle
+        devices = random_devices(300, (40, 32), accuracy=(0.0, 3.0))
+
+        full_manager = GridManager(dimensions=(40, 32), n_cells=(32, 32), method='gaussian')
+        multi_manager = GridManager(dimensions=(40, 32), n_cells=(32, 32), method='gaussian', levels=3,
+            refine_density=0.3)
+
+        full_manager.update(devices)
+        multi_manager.update(devices)
+
+        refined = multi_manager.refined_cells[-1]
+        self.assertTrue(refined.any())
+        self.assertTrue(numpy.isclose(len(devices), multi_manager.occupation_matrix.sum()))
+        self.assertTrue(numpy.allclose(full_manager.occupation_matrix[refined], multi_manager.occupation_matrix[refined]))
+
+        coarse_manager = GridManager(dimensions=(40, 32), n_cells=(32, 32), method='numpy', levels=2,
+            refine_density=100.0)
+        coarse_manager.update(devices)
+
+        self.assertFalse(coarse_manager.refined_cells[-1].any())
+        self.assertTrue(numpy.allclose(coarse_manager.density_pyramid[0].repeat(2, axis=0).repeat(2, axis=1),
+            coarse_manager.density_matrix))
+
+    def test_unsupported_levels(self):
+        self.assertRaises(ValueError, GridManager, dimensions=(8, 8), n_cells=(6, 6), levels=3)
+        self.assertRaises(ValueError, GridManager, dimensions=(8, 8), n_cells=(8, 8), levels=2, incremental=True)
+
+class TestTemporal(unittest.TestCase):
+
+    def test_temporal_density(self):
+        random_state = numpy.random.RandomState(0)
+        matrices = random_state.random_sample((11, 3, 4))
+        temporal = TemporalDensity(window=4, alpha=0.5, threshold=0.5)
+
+        ewma = matrices[0]
+        time_above = numpy.zeros((3, 4), dtype=int)
+        for i, matrix in enumerate(matrices):
+            temporal.update(matrix)
+
+            ewma = 0.5 * matrix + 0.5 * ewma
+            time_above = numpy.where(matrix > 0.5, time_above + 1, 0)
+            last = matrices[max(0, i - 3):i + 1]
+
+            self.assertTrue(numpy.allclose(ewma if i > 0 else matrix, temporal.ewma))
+            self.assertTrue(numpy.allclose(last.mean(axis=0), temporal.rolling_mean))
+            self.assertTrue(numpy.allclose(last.max(axis=0), temporal.rolling_max))
+            self.assertEquals(time_above.tolist(), temporal.time_above.tolist())
+
+        self.assertEquals((4, 3, 4), temporal.ring.shape)
+
+    def test_temporal_update(self):
+        grid_manager = GridManager(dimensions=(8, 8), n_cells=(4, 4), method='numpy', temporal=True,
+            rolling_frames=2, threshold_density=0.1)
+
+        grid_manager.update([Device("0", (1.0, 1.0), 0.0)])
+        grid_manager.update([Device("0", (7.0, 7.0), 0.0)])
+
+        self.assertEquals(0.25, grid_manager.rolling_max_density[0, 0])
+        self.assertEquals(0.25, grid_manager.rolling_max_density[3, 3])
+        self.assertEquals(0.125, grid_manager.rolling_mean_density[0, 0])
+        self.assertEquals([0, 1], [grid_manager.time_above_threshold[0, 0], grid_manager.time_above_threshold[3, 3]])
+
+        self.assertRaises(ValueError, TemporalDensity, 0)
+
+class TestVenue(unittest.TestCase):
+
+    def setUp(self):
+        # 8x8 square with a 2x2 pillar filling cell (1, 1) and a 2x1 wall
+        # covering half of cell (2, 2)
+        self.venue = geometry.Polygon(
+            [(0, 0), (8, 0), (8, 8), (0, 8)],
+            [[(2, 2), (4, 2), (4, 4), (2, 4)], [(4, 4), (6, 4), (6, 5), (4, 5)]]
+        )
+
+    def test_redistribute(self):
+        devices = numpy.array([0, 0, 1, 1])
+        cells = numpy.array([0, 1, 1, 2])
+        weights = numpy.array([0.5, 0.5, 0.25, 0.75])
+
+        redistributed = redistribute(devices, cells, weights, numpy.array([1.0, 0.0, 0.5]), 2)
+        self.assertTrue(numpy.allclose([1.0, 0.0, 0.0, 1.0], redistributed))
+
+        redistributed = redistribute(devices, cells, weights, numpy.array([0.0, 0.0, 0.0]), 2)
+        self.assertTrue(numpy.allclose(weights, redistributed))
+
+    def test_walkable_area(self):
+        grid_manager = GridManager(dimensions=(8, 8), n_cells=(4, 4), method='numpy', venue=self.venue)
+
+        expected_area = numpy.full((4, 4), 4.0)
+        expected_area[1, 1] = 0.0
+        expected_area[2, 2] = 2.0
+        self.assertTrue(numpy.allclose(expected_area, grid_manager.walkable_area))
+        self.assertEquals(58.0, grid_manager.area)
+
+    def test_venue_occupation(self):
+        devices = [
+            Device("0", (3.0, 3.0), 1.0),
+            Device("1", (4.0, 3.0), 1.0),
+            Device("2", (5.0, 4.0), 1.0),
+            Device("3", (6.5, 6.5), 0.5),
+        ]
+
+        for method in ['shapely', 'numpy', 'lut']:
+            for sparse in [False, True]:
+                grid_manager = GridManager(dimensions=(8, 8), n_cells=(4, 4), method=method, venue=self.venue,
+                    sparse=sparse)
+                grid_manager.update(devices)
+
+                occupation_matrix = grid_manager.occupation_matrix
+                self.assertTrue(numpy.isclose(len(devices), occupation_matrix.sum()))
+                self.assertEquals(0.0, grid_manager.density_matrix[1, 1])
+
+                if method == 'lut':
+                    continue
+
+                # the device inside the pillar keeps its weight, the others
+                # only occupy walkable space
+                self.assertTrue(numpy.isclose(1.0, occupation_matrix[1, 1]))
+                self.assertTrue(numpy.isclose(5 / 3.0, occupation_matrix[2, 1]))
+                self.assertTrue(numpy.isclose(1 / 3.0, occupation_matrix[2, 2]))
+                self.assertTrue(numpy.isclose(1 / 6.0, grid_manager.density_matrix[2, 2]))
+
+class TestTiles(unittest.TestCase):
+
+    def test_tile_edges(self):
+        self.assertEquals([0, 3, 6, 10], tile_edges(10, 3))
+        self.assertEquals([0, 1, 2], tile_edges(2, 4))
+
+    def test_assign(self):
+        tiling = Tiling((8, 8), (1.0, 1.0), (2, 2))
+        self.assertEquals(4, len(tiling))
+        self.assertEquals((4, 8, 0, 4), tiling.bounds(2))
+
+        positions = numpy.array([[1.0, 1.0], [3.9, 3.9], [6.0, 2.0], [-5.0, 20.0]])
+        accuracies = numpy.array([0.5, 0.5, 1.0, 1.0])
+
+        devices = tiling.assign(positions, accuracies)
+        self.assertEquals([[0, 1], [1, 3], [1, 2], [1]], [list(tile) for tile in devices])
+
+    def test_block(self):
+        tiling = Tiling((4, 6), (1.0, 1.0), (2, 3))
+        matrix = SparseMatrix.from_cells([0, 8, 9, 23], [1.0, 2.0, 3.0, 4.0], (4, 6))
+
+        self.assertEquals([[1.0, 0.0], [0.0, 0.0]], tiling.block(matrix, 0).tolist())
+        self.assertEquals([[0.0, 0.0], [2.0, 3.0]], tiling.block(matrix, 1).tolist())
+        self.assertEquals([[0.0, 0.0], [0.0, 4.0]], tiling.block(matrix, 5).tolist())
+
+class TestPipeline(unittest.TestCase):
+
+    def test_pipeline(self):
+        def produce():
+            for i in range(10):
+                time.sleep(0.02)
+                yield i
+
+        def compute(i):
+            time.sleep(0.02)
+            return i * i
+
+        results = []
+        def consume(result):
+            time.sleep(0.02)
+            results.append(result)
+
+        stats = FramePipeline(produce(), compute, consume, depth=2).run()
+
+        self.assertEquals([i * i for i in range(10)], results)
+        self.assertEquals(10, stats.frames)
+        self.assertTrue(stats.depth_max['frames'] <= 2 and stats.depth_max['results'] <= 2)
+        # the stages overlap, a sequential loop would take 0.6 s
+        self.assertTrue(stats.elapsed < 0.45)
+
+        results = []
+        FramePipeline(iter(range(100)), compute, consume).run(3)
+        self.assertEquals([0, 1, 4], results)
+
+    def test_pipeline_error(self):
+        def compute(i):
+            if i == 3:
+                raise ValueError('compute failed')
+            return i
+
+        results = []
+        pipeline = FramePipeline(iter(range(100)), compute, results.append)
+        self.assertRaises(ValueError, pipeline.run)
+        self.assertEquals([0, 1, 2], results)
+
+        pipeline = FramePipeline(iter(range(100)), lambda i: i, lambda i: 1 / 0)
+        self.assertRaises(ZeroDivisionError, pipeline.run, 10)
+
 class TestGridManager(sparkunittest.SparkTestCase):
 
     def test_grid_manager(self):
@@ -145,6 +1169,157 @@ class TestGridManager(sparkunittest.SparkTestCase):
 
         self.assertTrue(numpy.allclose(expected_matrix, grid_manager.occupation_matrix))
 
+    def test_non_square_grid(self):
+        grid_manager = GridManager(spark_context=self.sc, dimensions=(4, 8), n_cells=(4, 8))
+
+        devices = [
+            Device("0", (1.0, 6.0), 1.0),
+            Device("1", (3.5, 0.5), 0.25)
+        ]
+
+        grid_manager.update(devices)
+
+        expected_matrix = numpy.zeros((4, 8))
+        expected_matrix[0:2, 5:7] = 0.25
+        expected_matrix[3, 0] = 1.0
+
+        self.assertTrue(numpy.allclose(expected_matrix, grid_manager.occupation_matrix))
+
+    def test_close(self):
+        devices = [
+            Device("0", (3.0, 3.0), 1.0),
+        ]
+
+        with GridManager(spark_context=self.sc, dimensions=(8, 8), n_cells=(4, 4)) as grid_manager:
+            for i in range(3):
+                grid_manager.update(devices)
+                self.assertTrue(numpy.isclose(1.0, grid_manager.occupation_matrix.sum()))
+
+        grid_manager.update(devices)
+        grid_manager.close()
+        grid_manager.close()
+
+    def test_numpy_method(self):
+        dimensions_list = [(8, 8), (100, 60), (20, 20)]
+        cell_sizes = [(8, 8), (6, 10), (7, 5)]
+        for dimensions, n_cells in zip(dimensions_list, cell_sizes):
+            shapely_manager = GridManager(spark_context=self.sc, dimensions=dimensions, n_cells=n_cells)
+            numpy_manager = GridManager(spark_context=self.sc, dimensions=dimensions, n_cells=n_cells, method='numpy')
+
+            devices = random_devices(50, dimensions)
+            devices.append(Device("50", (-2.0, -2.0), 5.0))
+
+            shapely_manager.update(devices)
+            numpy_manager.update(devices)
+
+            self.assertTrue(numpy.isclose(len(devices), numpy_manager.occupation_matrix.sum()))
+            self.assertTrue(numpy.allclose(shapely_manager.occupation_matrix, numpy_manager.occupation_matrix, atol=1e-2))
+            self.assertTrue(numpy.allclose(shapely_manager.density_matrix, numpy_manager.density_matrix, atol=1e-2))
+
+    def test_spark_backend(self):
+        devices = random_devices(100)
+
+        spark_manager = GridManager(spark_context=self.sc, dimensions=(40, 30), n_cells=(8, 6))
+        local_manager = GridManager(dimensions=(40, 30), n_cells=(8, 6), backend='local')
+
+        spark_manager.update(devices)
+        local_manager.update(devices)
+
+        self.assertTrue(numpy.allclose(local_manager.occupation_matrix, spark_manager.occupation_matrix))
+
+    def test_spark_stats(self):
+        grid_manager = GridManager(spark_context=self.sc, dimensions=(8, 8), n_cells=(4, 4), metrics=True)
+
+        grid_manager.update([Device("0", (3.0, 3.0), 1.0), Device("1", (5.0, 5.0), 1.0)])
+
+        self.assertEquals(2, grid_manager.stats.counters['devices'])
+        self.assertTrue(grid_manager.stats.counters['broadcast_bytes'] > 0)
+        self.assertTrue(grid_manager.stats.counters['result_bytes'] > 0)
+        self.assertTrue(grid_manager.stats.times['compute'] > 0)
+
+        # the executor stats of each frame only count that frame
+        candidate_cells = grid_manager.stats.counters['candidate_cells']
+        grid_manager.update([Device("0", (3.0, 3.0), 1.0), Device("1", (5.0, 5.0), 1.0)])
+        self.assertEquals(candidate_cells, grid_manager.stats.counters['candidate_cells'])
+
+    def test_spark_sparse(self):
+        devices = random_devices(100)
+
+        spark_manager = GridManager(spark_context=self.sc, dimensions=(40, 30), n_cells=(80, 60), method='numpy',
+            sparse=True)
+        local_manager = GridManager(dimensions=(40, 30), n_cells=(80, 60), method='numpy')
+
+        spark_manager.update(devices)
+        local_manager.update(devices)
+
+        self.assertTrue(isinstance(spark_manager.occupation, SparseMatrix))
+        self.assertTrue(numpy.allclose(local_manager.occupation_matrix, spark_manager.occupation_matrix))
+
+    def test_spark_levels(self):
+        devices = random_devices(100)
+
+        spark_manager = GridManager(spark_context=self.sc, dimensions=(40, 30), n_cells=(16, 12), levels=2)
+        local_manager = GridManager(dimensions=(40, 30), n_cells=(16, 12), levels=2, backend='local')
+
+        spark_manager.update(devices)
+        spark_manager.update(devices)
+        local_manager.update(devices)
+
+        self.assertTrue(numpy.allclose(local_manager.occupation_matrix, spark_manager.occupation_matrix))
+        spark_manager.close()
+
+    def test_spark_update_many(self):
+        frames = random_frames(6, 50)
+
+        spark_manager = GridManager(spark_context=self.sc, dimensions=(40, 30), n_cells=(8, 6), metrics=True)
+        local_manager = GridManager(dimensions=(40, 30), n_cells=(8, 6), backend='local')
+
+        tensor = spark_manager.update_many(frames)
+
+        self.assertEquals(300, spark_manager.stats.counters['devices'])
+        self.assertTrue(numpy.allclose(local_manager.update_many(frames), tensor))
+        self.assertTrue(numpy.allclose(tensor[-1], spark_manager.occupation_matrix))
+
+    @unittest.skipUnless(dataframe_support(), 'requires Spark 2.3+, pandas and pyarrow')
+    def test_dataframe_backend(self):
+        frames = random_frames(3, 50, (44, 30), accuracy=(0.0, 5.0), origin=(-2, 0))
+
+        for method in ['shapely', 'numpy']:
+            dataframe_manager = GridManager(spark_context=self.sc, dimensions=(40, 30), n_cells=(8, 6), method=method,
+                backend='dataframe')
+            local_manager = GridManager(dimensions=(40, 30), n_cells=(8, 6), method=method, backend='local')
+
+            dataframe_manager.update(frames[0])
+            local_manager.update(frames[0])
+            self.assertTrue(numpy.allclose(local_manager.occupation_matrix, dataframe_manager.occupation_matrix))
+            self.assertTrue(numpy.allclose(local_manager.update_many(frames), dataframe_manager.update_many(frames)))
+
+            self.assertEquals((0, 8, 6), dataframe_manager.update_many([]).shape)
+            dataframe_manager.update(DeviceFrame([], [], []))
+            self.assertEquals(0, dataframe_manager.occupation_matrix.sum())
+
+            dataframe_manager.close()
+
+    def test_tiled_backend(self):
+        frames = random_frames(3, 80, (44, 30), accuracy=(0.0, 5.0), origin=(-2, 0))
+
+        # the halo covers the circles moved by the tables
+        for method in ['shapely', 'numpy', 'lut', 'histogram', 'gaussian']:
+            for sparse in [False, True]:
+                tiled_manager = GridManager(spark_context=self.sc, dimensions=(40, 30), n_cells=(16, 12),
+                    method=method, backend=TiledSparkBackend(self.sc, (3, 2)), sparse=sparse, metrics=True)
+                local_manager = GridManager(dimensions=(40, 30), n_cells=(16, 12), method=method, backend='local')
+
+                tiled_manager.update(frames[0])
+                local_manager.update(frames[0])
+
+                self.assertEquals(6, tiled_manager.stats.counters['shards'])
+                self.assertTrue(tiled_manager.stats.counters['halo_devices'] > 0)
+                self.assertTrue(numpy.allclose(local_manager.occupation_matrix, tiled_manager.occupation_matrix))
+                self.assertTrue(numpy.allclose(local_manager.update_many(frames), tiled_manager.update_many(frames)))
+
+                tiled_manager.close()
+
     def test_check_density(self):
         grid_manager = GridManager(spark_context=self.sc, dimensions=(8, 8), n_cells=(8, 8))
 
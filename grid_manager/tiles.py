@@ -0,0 +1,74 @@
+import numpy
+
+def tile_edges(n_cells, n_tiles):
+    """
+    Returns the first cell of each tile along one axis, plus n_cells.
+    """
+    n_tiles = max(1, min(n_tiles, n_cells))
+    return [i * n_cells // n_tiles for i in range(n_tiles + 1)]
+
+def default_tiles(n_cells, n_partitions):
+    # square-ish tiles, about one per partition
+    tile_rows = max(1, int(numpy.sqrt(n_partitions * n_cells[0] / float(n_cells[1]))))
+    tile_columns = max(1, n_partitions // tile_rows)
+    return tile_rows, tile_columns
+
+class Tiling(object):
+    """
+    Splits the cells of a grid layout into rectangular tiles. A device
+    belongs to every tile the bounding box of its reach overlaps (the halo),
+    so the owner of a tile sees all the devices that can reach its cells.
+    """
+
+    def __init__(self, n_cells, cell_dimensions, tiles):
+        self.n_cells = tuple(n_cells)
+        self.cell_dimensions = tuple(cell_dimensions)
+        self.row_edges = tile_edges(self.n_cells[0], tiles[0])
+        self.column_edges = tile_edges(self.n_cells[1], tiles[1])
+        self.shape = (len(self.row_edges) - 1, len(self.column_edges) - 1)
+
+    def __len__(self):
+        return self.shape[0] * self.shape[1]
+
+    def bounds(self, tile):
+        row, column = divmod(tile, self.shape[1])
+        return (self.row_edges[row], self.row_edges[row + 1],
+            self.column_edges[column], self.column_edges[column + 1])
+
+    def assign(self, positions, radii):
+        """
+        Returns the indices of the devices of each tile, radii is the reach
+        of each device (GridLayout.reach).
+        """
+        ranges = []
+        for axis, edges in ((0, self.row_edges), (1, self.column_edges)):
+            first = numpy.floor((positions[:, axis] - radii) / self.cell_dimensions[axis]).astype(int)
+            last = numpy.floor((positions[:, axis] + radii) / self.cell_dimensions[axis]).astype(int)
+            first = numpy.clip(first, 0, self.n_cells[axis] - 1)
+            last = numpy.clip(last, 0, self.n_cells[axis] - 1)
+
+            # tile of the first and last cell of each bounding box
+            ranges.append((numpy.searchsorted(edges, first, side='right') - 1,
+                numpy.searchsorted(edges, last, side='right') - 1))
+
+        (first_rows, last_rows), (first_columns, last_columns) = ranges
+
+        devices = []
+        for tile in range(len(self)):
+            row, column = divmod(tile, self.shape[1])
+            inside = (first_rows <= row) & (last_rows >= row) & (first_columns <= column) & (last_columns >= column)
+            devices.append(numpy.flatnonzero(inside))
+
+        return devices
+
+    def block(self, matrix, tile):
+        """
+        Returns the dense cells of tile from a sparse matrix of the grid.
+        """
+        first_row, last_row, first_column, last_column = self.bounds(tile)
+        rows, columns = numpy.unravel_index(matrix.cells, matrix.shape)
+        inside = (rows >= first_row) & (rows < last_row) & (columns >= first_column) & (columns < last_column)
+
+        block = numpy.zeros((last_row - first_row, last_column - first_column))
+        block[rows[inside] - first_row, columns[inside] - first_column] = matrix.values[inside]
+        return block
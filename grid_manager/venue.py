@@ -0,0 +1,37 @@
+from shapely.prepared import prep
+import numpy
+
+def walkable_area(venue, layout):
+    """
+    Returns the area of each cell of layout that lies inside the venue
+    polygon (holes are obstacles). Only the cells crossed by the venue
+    boundary need an intersection.
+    """
+    prepared = prep(venue)
+    cell_area = layout.cell_dimensions[0] * layout.cell_dimensions[1]
+
+    area = numpy.zeros(layout.n_cells)
+    for row in range(layout.n_cells[0]):
+        for column in range(layout.n_cells[1]):
+            box = layout.box(row, column)
+            if prepared.contains(box):
+                area[row, column] = cell_area
+            elif prepared.intersects(box):
+                area[row, column] = box.intersection(venue).area
+
+    return area
+
+def redistribute(devices, cells, weights, fractions, n_devices):
+    """
+    Moves the weight of each device that falls on non-walkable space to the
+    walkable part of its cells, assuming the walkable area of a cell is
+    evenly spread. fractions is the walkable fraction of each flat cell.
+    Devices that only reach non-walkable space keep their weights.
+    """
+    walkable = weights * fractions[cells]
+    totals = numpy.bincount(devices, weights=walkable, minlength=n_devices)
+    originals = numpy.bincount(devices, weights=weights, minlength=n_devices)
+
+    lost = totals[devices] <= 0
+    scale = originals[devices] / numpy.where(lost, 1.0, totals[devices])
+    return numpy.where(lost, weights, walkable * scale)
@@ -1,9 +1,9 @@
 from grid_manager.device_gen import devices_generator
-from pymobility.models.mobility import RandomWaypoint
+from grid_manager.mobility import RandomWaypoint
 from grid_manager.grid_manager import GridManager
-
-from pyspark import SparkContext
-from pyspark import SparkConf
+from grid_manager.backends import SPARK_BACKENDS
+from grid_manager.pipeline import FramePipeline
+from grid_manager.store import DensityWriter
 
 ################################################################################
 ### Simulation configuration
@@ -14,6 +14,9 @@ ACCURACY = (0.0, 3.0)
 MAX_PAUSE_TIME = 10.0  # 10 seconds
 N_CELLS = (6, 6)
 DENSITY_SCALE = (0.0, 0.2)
+BACKEND = 'local'  # local, process, spark, dataframe or tiled
+METHOD = 'numpy'  # numpy, lut, gaussian, histogram or shapely
+STORE = None  # directory to archive the density matrices, None to disable
 
 if __name__ == '__main__':
     description = 'Agglomeration simulator v0.1'
@@ -26,20 +29,42 @@ if __name__ == '__main__':
     print(description)
     print("============================")
 
-    conf = SparkConf().setAppName('GridManager')
-    sc = SparkContext(conf=conf)
+    sc = None
+    if BACKEND in SPARK_BACKENDS:
+        from pyspark import SparkContext
+        from pyspark import SparkConf
+
+        conf = SparkConf().setAppName('GridManager')
+        sc = SparkContext(conf=conf)
 
-    g_manager = GridManager(spark_context=sc, dimensions=DIMENSIONS, n_cells=N_CELLS)
+    g_manager = GridManager(spark_context=sc, dimensions=DIMENSIONS, n_cells=N_CELLS,
+        method=METHOD, backend=BACKEND)
 
     print("Avg. density %.5f devices/m^2" % (N_DEVICES / g_manager.area))
     print("Cell area: %.3f m^2" % g_manager.cell_area)
 
-    exit = False
-    while not exit:
-        devices = next(devices_gen)
-        g_manager.update(devices.values())
+    store = None
+    if STORE is not None:
+        store = DensityWriter(STORE, N_CELLS)
+
+    def compute(devices):
+        g_manager.update(devices)
+        return g_manager.occupation_matrix, g_manager.density_matrix
 
-        density_matrix = g_manager.density_matrix
+    def show(result):
+        occupation_matrix, density_matrix = result
         print density_matrix
 
-    sc.stop()
+        if store is not None:
+            store.write(occupation_matrix, density_matrix)
+
+    # the next frame is generated while the current one is computed
+    try:
+        FramePipeline(devices_gen, compute, show).run()
+    finally:
+        if store is not None:
+            store.close()
+
+    g_manager.close()
+    if sc is not None:
+        sc.stop()